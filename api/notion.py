@@ -2,9 +2,17 @@
 封装notion相关操作
 """
 
+import asyncio
+import json
+import logging
 from datetime import datetime
 
-from notion_client import AsyncClient
+import httpx
+from notion_client import AsyncClient, APIErrorCode, APIResponseError
+
+from config import CONFIG
+from lib.metrics import METRICS
+from lib.rate_limiter import TokenBucket
 
 
 # class NotionAPI:
@@ -263,6 +271,93 @@ class BlockHelper:
         return {"type": "external", "external": {"url": img}}
 
 
+# Append block children limits, see https://developers.notion.com/reference/request-limits
+NOTION_MAX_CHILDREN = 100  # elements of any children array
+NOTION_MAX_BLOCKS = 1000  # blocks per request, nested children included
+NOTION_MAX_PAYLOAD = 500 * 1000  # bytes per request
+PAYLOAD_RESERVED = 2 * 1000  # request envelope, e.g. {"children": [...], "after": ...}
+
+
+def count_blocks(block: dict) -> int:
+    """number of blocks in block, nested children included"""
+    children = block.get(block.get("type"), {}).get("children", [])
+    return 1 + sum(count_blocks(child) for child in children)
+
+
+def payload_size(block: dict) -> int:
+    """bytes of block once serialized in the request body"""
+    return len(json.dumps(block, ensure_ascii=False).encode("utf-8")) + 1
+
+
+def nest_children(block: dict, children: list, limit=NOTION_MAX_CHILDREN):
+    """
+    将children内嵌到block中一次创建，block本身不会被修改
+    return: (内嵌后的block, 放不下需要另行追加的children)
+    """
+    if not children:
+        return block, []
+    block_type = block.get("type")
+    content = block.get(block_type, {})
+    existing = content.get("children", [])
+    room = max(limit - len(existing), 0)
+    nested = {**block, block_type: {**content, "children": existing + children[:room]}}
+    return nested, children[room:]
+
+
+def pack_blocks(
+    blocks: list,
+    max_children=NOTION_MAX_CHILDREN,
+    max_blocks=NOTION_MAX_BLOCKS,
+    max_payload=NOTION_MAX_PAYLOAD - PAYLOAD_RESERVED,
+) -> list[list]:
+    """
+    按notion单次请求的block数量及大小限制，将blocks切分为若干次请求
+    单个block超限时独占一次请求
+    """
+    chunks = []
+    batch, batch_blocks, batch_size = [], 0, 0
+    for block in blocks:
+        num, size = count_blocks(block), payload_size(block)
+        if batch and (
+            len(batch) >= max_children
+            or batch_blocks + num > max_blocks
+            or batch_size + size > max_payload
+        ):
+            chunks.append(batch)
+            batch, batch_blocks, batch_size = [], 0, 0
+        batch.append(block)
+        batch_blocks += num
+        batch_size += size
+    if batch:
+        chunks.append(batch)
+    return chunks
+
+
+async def query_all(client: AsyncClient, data_source_id: str, **kwargs) -> list:
+    """分页查询data source，返回全部结果"""
+    response = await client.data_sources.query(
+        data_source_id=data_source_id, page_size=100, **kwargs
+    )
+    results = list(response.get("results", []))
+    while response.get("has_more"):
+        response = await client.data_sources.query(
+            data_source_id=data_source_id,
+            page_size=100,
+            start_cursor=response["next_cursor"],
+            **kwargs,
+        )
+        results.extend(response.get("results", []))
+    return results
+
+
+def plain_text(prop: dict | None) -> str:
+    """title / rich_text 属性的纯文本"""
+    if not prop:
+        return ""
+    items = prop.get(prop.get("type") or "rich_text") or []
+    return "".join(item.get("plain_text", "") for item in items)
+
+
 async def get_datasource_id(client: AsyncClient, database_id: str) -> str:
     """获取data source"""
     db = await client.databases.retrieve(database_id=database_id)
@@ -270,3 +365,86 @@ async def get_datasource_id(client: AsyncClient, database_id: str) -> str:
     if not data_sources:
         return ""
     return data_sources[0]["id"]
+
+
+class RateLimitedClient(AsyncClient):
+    """AsyncClient whose requests all go through one token bucket.
+
+    429 responses pause the whole bucket for Retry-After seconds and the request
+    is retried; the SDK's own retry is turned off so every attempt is counted.
+    """
+
+    # 服务端错误仅对幂等请求重试
+    RETRY_SERVER_ERRORS = (
+        APIErrorCode.InternalServerError,
+        APIErrorCode.ServiceUnavailable,
+        APIErrorCode.GatewayTimeout,
+    )
+
+    def __init__(self, limiter: TokenBucket, max_retries: int = 3, **kwargs):
+        kwargs.setdefault("retry", False)
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.max_retries = max_retries
+
+    def _retry_delay(self, error: APIResponseError, method: str, attempt: int):
+        """seconds to wait before retrying, None if not retryable"""
+        if attempt >= self.max_retries:
+            return None
+        if error.code == APIErrorCode.RateLimited:
+            try:
+                return float(error.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                return 2.0**attempt
+        if error.code in self.RETRY_SERVER_ERRORS and method.upper() in (
+            "GET",
+            "DELETE",
+        ):
+            return 2.0**attempt
+        return None
+
+    async def request(self, path, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                return await super().request(path, method, *args, **kwargs)
+            except APIResponseError as error:
+                delay = self._retry_delay(error, method, attempt)
+                if delay is None:
+                    raise
+                METRICS.incr("notion.retries")
+                if error.code == APIErrorCode.RateLimited:
+                    METRICS.incr("notion.rate_limited")
+                logging.warning(
+                    "notion %s %s failed (%s), retry in %.1fs",
+                    method,
+                    path,
+                    error.code,
+                    delay,
+                )
+                if error.code == APIErrorCode.RateLimited:
+                    self.limiter.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                attempt += 1
+
+
+def create_client(notion_token: str, transport=None) -> RateLimitedClient:
+    """创建notion客户端，请求速率由[notion.api]配置
+    transport: 可替换为本地模拟的httpx transport，用于测试及压测
+    """
+    client = httpx.AsyncClient(
+        transport=transport, event_hooks=METRICS.httpx_hooks("notion")
+    )
+    limiter = TokenBucket(
+        CONFIG.getfloat("notion.api", "RateLimit", fallback=3),
+        CONFIG.getint("notion.api", "Burst", fallback=3),
+    )
+    return RateLimitedClient(
+        limiter,
+        max_retries=CONFIG.getint("notion.api", "MaxRetries", fallback=3),
+        auth=notion_token,
+        log_level=logging.ERROR,
+        client=client,
+    )
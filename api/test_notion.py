@@ -0,0 +1,59 @@
+"""unit test for notion request packing"""
+
+import unittest
+
+from api.notion import (
+    BlockHelper,
+    count_blocks,
+    nest_children,
+    pack_blocks,
+    payload_size,
+)
+
+
+class TestPackBlocks(unittest.TestCase):
+    """test nest_children / pack_blocks"""
+
+    def test_nest_children(self):
+        """children are embedded without touching the original block"""
+        block = BlockHelper.quote("mark")
+        nested, rest = nest_children(block, [BlockHelper.quote("abstract")])
+        self.assertEqual(rest, [])
+        self.assertNotIn("children", block["quote"])
+        self.assertEqual(len(nested["quote"]["children"]), 1)
+        self.assertEqual(count_blocks(nested), 2)
+
+    def test_nest_table_overflow(self):
+        """table rows beyond the children limit are returned for a later append"""
+        table = BlockHelper.table(2, ["日期", "阅读时长"], True)
+        rows = [BlockHelper.table_row([str(i), "1分"]) for i in range(150)]
+        nested, rest = nest_children(table, rows)
+        self.assertEqual(len(nested["table"]["children"]), 100)
+        self.assertEqual(len(table["table"]["children"]), 1)
+        self.assertEqual(rest, rows[99:])
+
+    def test_no_empty_request(self):
+        """exact multiples of 100 don't produce an empty request"""
+        self.assertEqual(pack_blocks([]), [])
+        blocks = [BlockHelper.divider() for _ in range(200)]
+        self.assertEqual([len(chunk) for chunk in pack_blocks(blocks)], [100, 100])
+
+    def test_block_limit(self):
+        """nested children count towards the per request block limit"""
+        parent, _ = nest_children(
+            BlockHelper.quote("mark"), [BlockHelper.quote("x")] * 99
+        )
+        chunks = pack_blocks([parent] * 25)  # 100 blocks each
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+
+    def test_payload_limit(self):
+        """requests stay under the payload limit"""
+        blocks = [BlockHelper.quote("字" * 1500) for _ in range(200)]
+        chunks = pack_blocks(blocks, max_payload=50 * 1000)
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 200)
+        for chunk in chunks:
+            self.assertLessEqual(sum(payload_size(b) for b in chunk), 50 * 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+"""unit test for weread response parsing"""
+
+import unittest
+from unittest import mock
+
+import httpx
+
+from api.weread import BaseWeReadAPI, Chapter, Mark, merge_marks
+from lib import fastjson
+
+
+def response(data, status=200) -> httpx.Response:
+    return httpx.Response(status, json=data)
+
+
+class TestParse(unittest.TestCase):
+    """test BaseWeReadAPI parsing into Chapter / Mark records"""
+
+    def setUp(self):
+        self.api = BaseWeReadAPI()
+
+    def test_decode_once(self):
+        """every response body is decoded a single time"""
+        r = response({"updated": [{"bookmarkId": "b1", "range": "1-2"}]})
+        with mock.patch.object(fastjson, "loads", wraps=fastjson.loads) as loads:
+            self.api._bookmark_delta(r)
+        self.assertEqual(loads.call_count, 1)
+
+    def test_bookmark_list_sorted(self):
+        """bookmarks come back ordered by chapter and start position"""
+        r = response(
+            {
+                "updated": [
+                    {"bookmarkId": "c", "chapterUid": 2, "range": "5-9"},
+                    {"bookmarkId": "b", "chapterUid": 1, "range": "100-120"},
+                    {"bookmarkId": "a", "chapterUid": 1, "range": "20-30"},
+                    {"bookmarkId": "d", "range": "0-1"},
+                ]
+            }
+        )
+        marks = self.api._bookmark_list(r)
+        self.assertEqual([m.id for m in marks], ["d", "a", "b", "c"])
+        self.assertEqual(marks[1].start, 20)
+        self.assertEqual(self.api._bookmark_list(response({}, status=500)), [])
+
+    def test_split_reviews(self):
+        """type 4 is the summary, type 1 the chapter reviews, others dropped"""
+        r = response(
+            {
+                "synckey": 7,
+                "reviews": [
+                    {"review": {"reviewId": "s", "content": "sum", "type": 4}},
+                    {
+                        "review": {
+                            "reviewId": "r",
+                            "content": "note",
+                            "abstract": "quote",
+                            "chapterUid": 3,
+                            "range": "8-9",
+                            "type": 1,
+                        }
+                    },
+                    {"review": {"reviewId": "x", "type": 2}},
+                ],
+            }
+        )
+        delta = self.api._review_delta(r)
+        self.assertEqual(delta["synckey"], 7)
+        self.assertEqual([m.id for m in delta["summary"]], ["s"])
+        review = delta["updated"][0]
+        self.assertEqual(len(delta["updated"]), 1)
+        self.assertEqual((review.text, review.abstract), ("note", "quote"))
+        self.assertEqual(review.key, (3, 8))
+        self.assertIsNone(review.bookmark_id)
+
+    def test_merge(self):
+        """sorted streams merge by position, ties keep bookmarks first"""
+        bookmarks = [
+            Mark.from_bookmark({"bookmarkId": i, "chapterUid": c, "range": r})
+            for i, c, r in (("b1", 1, "5-6"), ("b2", 2, "0-1"), ("b3", 2, "9-9"))
+        ]
+        reviews = [
+            Mark.from_review({"reviewId": i, "chapterUid": c, "range": r})
+            for i, c, r in (("r1", 1, "1-2"), ("r2", 2, "0-3"))
+        ]
+        merged = merge_marks(bookmarks, reviews)
+        self.assertEqual([m.id for m in merged], ["r1", "b1", "b2", "r2", "b3"])
+        self.assertEqual(bookmarks[1].key, (2, 0))
+
+    def test_chapters(self):
+        r = response(
+            {
+                "data": [
+                    {"bookId": "1", "updated": [{"chapterUid": 1, "title": "c1"}]},
+                    {"bookId": 2, "updated": [{"chapterUid": 9, "level": 2}]},
+                ]
+            }
+        )
+        lists = self.api._chapter_lists(r)
+        self.assertEqual(lists["1"][0].title, "c1")
+        self.assertEqual((lists["2"][0].uid, lists["2"][0].level), (9, 2))
+
+    def test_round_trip(self):
+        """records survive to_dict / fastjson / from_dict as used by cache and plan"""
+        chapter = Chapter(3, 3, "第三章", 2)
+        mark = Mark.from_bookmark(
+            {"bookmarkId": "b", "chapterUid": 3, "range": "10-20", "markText": "划线"}
+        )
+        data = fastjson.loads(
+            fastjson.dumps([chapter, mark], default=lambda record: record.to_dict())
+        )
+        self.assertEqual(Chapter.from_dict(data[0]).to_dict(), chapter.to_dict())
+        restored = Mark.from_dict(data[1])
+        self.assertEqual(restored.to_dict(), mark.to_dict())
+        self.assertEqual(restored.key, (3, 10))
+        self.assertNotIn("reviewId", data[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
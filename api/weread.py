@@ -1,12 +1,167 @@
 """封装微信api的调用"""
 
+import asyncio
+import itertools
+import operator
 from http.cookies import SimpleCookie
 from requests.utils import cookiejar_from_dict
 import requests
+import httpx
 
+from lib import fastjson
+from lib.metrics import METRICS
 
-class WeReadAPI:
-    """微信读书API"""
+
+def range_start(mark_range) -> int:
+    """划线位置 "start-end" 的起始位置，无法解析时为0"""
+    start = (mark_range or "").split("-", 1)[0]
+    return int(start) if start.isdigit() else 0
+
+
+class Chapter(object):
+    """章节，只保留同步用到的字段"""
+
+    __slots__ = ("uid", "idx", "title", "level", "marks")
+
+    def __init__(self, uid, idx=0, title="", level=1):
+        self.uid = uid
+        self.idx = idx
+        self.title = title
+        self.level = level
+        # 挂载到该章节下的划线、笔记
+        self.marks = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Chapter":
+        return cls(
+            data.get("chapterUid"),
+            data.get("chapterIdx", 0),
+            data.get("title", ""),
+            data.get("level", 1),
+        )
+
+    def to_dict(self) -> dict:
+        """微信读书的字段名，from_dict的逆操作"""
+        return {
+            "chapterUid": self.uid,
+            "chapterIdx": self.idx,
+            "title": self.title,
+            "level": self.level,
+        }
+
+
+class Mark(object):
+    """划线或笔记（评语、总结），笔记的content统一为text"""
+
+    __slots__ = (
+        "bookmark_id",
+        "review_id",
+        "chapter_uid",
+        "range",
+        "start",
+        "key",
+        "text",
+        "style",
+        "color",
+        "abstract",
+    )
+
+    # 排序键 Mark.key，按章节、划线位置排序时使用
+    KEY = operator.attrgetter("key")
+
+    def __init__(
+        self,
+        bookmark_id=None,
+        review_id=None,
+        chapter_uid=None,
+        mark_range="",
+        text="",
+        style=None,
+        color=None,
+        abstract=None,
+    ):
+        self.bookmark_id = bookmark_id
+        self.review_id = review_id
+        self.chapter_uid = chapter_uid
+        self.range = mark_range
+        self.start = range_start(mark_range)
+        # 排序键：所在章节(缺省为1)、划线起始位置，构造时计算一次
+        self.key = (1 if chapter_uid is None else chapter_uid, self.start)
+        self.text = text
+        self.style = style
+        self.color = color
+        self.abstract = abstract
+
+    @property
+    def id(self):
+        """划线为bookmarkId，笔记为reviewId"""
+        return self.bookmark_id or self.review_id
+
+    @classmethod
+    def from_bookmark(cls, data: dict) -> "Mark":
+        return cls(
+            bookmark_id=data.get("bookmarkId"),
+            chapter_uid=data.get("chapterUid"),
+            mark_range=data.get("range", ""),
+            text=data.get("markText", ""),
+            style=data.get("style"),
+            color=data.get("colorStyle"),
+        )
+
+    @classmethod
+    def from_review(cls, data: dict) -> "Mark":
+        return cls(
+            review_id=data.get("reviewId"),
+            chapter_uid=data.get("chapterUid"),
+            mark_range=data.get("range", ""),
+            text=data.get("content", ""),
+            abstract=data.get("abstract"),
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Mark":
+        """to_dict的逆操作"""
+        return cls(
+            data.get("bookmarkId"),
+            data.get("reviewId"),
+            data.get("chapterUid"),
+            data.get("range", ""),
+            data.get("markText", ""),
+            data.get("style"),
+            data.get("colorStyle"),
+            data.get("abstract"),
+        )
+
+    def to_dict(self) -> dict:
+        """微信读书的字段名，省略空值"""
+        fields = (
+            ("bookmarkId", self.bookmark_id),
+            ("reviewId", self.review_id),
+            ("chapterUid", self.chapter_uid),
+            ("range", self.range),
+            ("markText", self.text),
+            ("style", self.style),
+            ("colorStyle", self.color),
+            ("abstract", self.abstract),
+        )
+        return {key: value for key, value in fields if value is not None}
+
+
+def sort_marks(marks: list[Mark]) -> list[Mark]:
+    """按章节、划线位置原地排序"""
+    marks.sort(key=Mark.KEY)
+    return marks
+
+
+def merge_marks(*streams) -> list[Mark]:
+    """合并已按章节、划线位置排好序的多组划线、笔记，位置相同时保持参数顺序
+    拼接后排序：timsort识别出各组有序段，只做一次线性归并，比heapq.merge快
+    """
+    return sorted(itertools.chain(*streams), key=Mark.KEY)
+
+
+class BaseWeReadAPI:
+    """微信读书API地址及响应解析，同步、异步客户端共用"""
 
     # 全量书籍笔记信息列表
     WEREAD_NOTEBOOKS_URL = "https://weread.qq.com/api/user/notebook"
@@ -28,30 +183,24 @@ class WeReadAPI:
 
     WEREAD_URL = "https://weread.qq.com/"
 
-    def __init__(self, cookie):
-        session = requests.Session()
-        session.cookies = self._parse_cookie(cookie)
-        session.get(self.WEREAD_URL)
-        self.session = session
-
-    def _parse_cookie(self, cookie_string):
+    def _parse_cookie(self, cookie_string) -> dict:
         cookie = SimpleCookie()
         cookie.load(cookie_string)
-        cookies_dict = {}
-        cookiejar = None
-        for key, morsel in cookie.items():
-            cookies_dict[key] = morsel.value
-            cookiejar = cookiejar_from_dict(
-                cookies_dict, cookiejar=None, overwrite=True
-            )
-        return cookiejar
+        return {key: morsel.value for key, morsel in cookie.items()}
 
-    def get_notebooklist(self):
-        """全量书籍笔记信息列表，仅包括笔记更新时间、数量等，不包括笔记明细"""
-        r = self.session.get(self.WEREAD_NOTEBOOKS_URL)
-        if r.ok:
-            data = r.json()
-            books = data.get("books")
+    @staticmethod
+    def _ok(r) -> bool:
+        # requests.Response.ok / httpx.Response.is_success
+        return r.status_code < 400
+
+    @staticmethod
+    def _json(r):
+        """响应内容只解析一次"""
+        return fastjson.loads(r.content)
+
+    def _notebooklist(self, r):
+        if self._ok(r):
+            books = self._json(r).get("books")
             books.sort(
                 key=lambda x: x["sort"]
             )  # 最近更新（划线、评语以及推荐都算更新）时间
@@ -60,69 +209,103 @@ class WeReadAPI:
             print(f"get notesbook failed: {r.text}")
             return []
 
-    def get_chapter_list(self, bookId):
-        """获取章节信息列表"""
-        body = {"bookIds": [bookId]}
-        r = self.session.post(self.WEREAD_CHAPTER_INFO, json=body)
-        if (
-            r.ok
-            and "data" in r.json()
-            and len(r.json()["data"]) == 1
-            and "updated" in r.json()["data"][0]
-        ):
-            update = r.json()["data"][0]["updated"]
-            # d = {item["chapterUid"]: item for item in update}
-            return update
-        else:
-            print(r.text)
+    def _chapter_list(self, r):
+        data = self._json(r).get("data") if self._ok(r) else None
+        if data and len(data) == 1 and "updated" in data[0]:
+            return [Chapter.from_dict(item) for item in data[0]["updated"]]
+        print(r.text)
         return []
 
-    def get_bookmark_list(self, bookId):
-        """获取书籍划线列表"""
-        params = dict(bookId=bookId)
-        r = self.session.get(self.WEREAD_BOOKMARKLIST_URL, params=params)
-        if r.ok:
-            updated = r.json().get("updated")
-            updated = sorted(
-                updated,
-                key=lambda x: (
-                    x.get("chapterUid", 1),
-                    int(x.get("range").split("-")[0]),
-                ),
-            )
-            return r.json()["updated"]
+    def _chapter_lists(self, r):
+        """批量接口的响应，{bookId: 章节列表}"""
+        data = self._json(r).get("data") if self._ok(r) else None
+        if data is not None:
+            return {
+                str(item.get("bookId")): [
+                    Chapter.from_dict(chapter) for chapter in item["updated"]
+                ]
+                for item in data
+                if "updated" in item
+            }
+        print(r.text)
+        return {}
+
+    @staticmethod
+    def _chunks(items, size):
+        size = max(1, size)
+        return [items[i : i + size] for i in range(0, len(items), size)]
+
+    @staticmethod
+    def _marks(bookmarks):
+        return sort_marks([Mark.from_bookmark(item) for item in bookmarks])
+
+    def _bookmark_list(self, r):
+        if self._ok(r):
+            return self._marks(self._json(r).get("updated") or [])
         else:
-            print("get bookmarklist failed: {r.text}")
+            print(f"get bookmarklist failed: {r.text}")
         return []
 
-    def get_review_list(self, bookId):
-        """获取笔记列表，包括笔记评论、推荐总结"""
-        params = dict(bookId=bookId, listType=11, mine=1, syncKey=0)
-        r = self.session.get(self.WEREAD_REVIEW_LIST_URL, params=params)
-        if r.ok:
-            reviews = r.json().get("reviews")
-            # 总结
-            summary = list(filter(lambda x: x.get("review").get("type") == 4, reviews))
-            # 笔记（评语）
-            reviews = list(filter(lambda x: x.get("review").get("type") == 1, reviews))
-            reviews = list(map(lambda x: x.get("review"), reviews))
-            reviews = list(map(lambda x: {**x, "markText": x.pop("content")}, reviews))
-            return summary, reviews
+    @staticmethod
+    def _split_reviews(reviews):
+        """(总结, 笔记（评语）)，笔记按章节、划线位置排序"""
+        summary = []
+        marks = []
+        for item in reviews:
+            review = item.get("review") or {}
+            kind = review.get("type")
+            if kind == 4:
+                summary.append(Mark.from_review(review))
+            elif kind == 1:
+                marks.append(Mark.from_review(review))
+        return summary, sort_marks(marks)
+
+    def _review_list(self, r):
+        if self._ok(r):
+            return self._split_reviews(self._json(r).get("reviews") or [])
         else:
             print(r.text)
             return [], []
 
-    def get_bookinfo(self, bookId: str) -> list:
-        """获取书的详情"""
-        params = dict(bookId=bookId)
-        r = self.session.get(self.WEREAD_BOOK_INFO, params=params)
+    @staticmethod
+    def _removed_ids(removed, key):
+        # 删除的记录可能只返回id，也可能返回完整记录
+        return [item.get(key) if isinstance(item, dict) else item for item in removed]
+
+    def _bookmark_delta(self, r):
+        """synckey之后变化的划线，请求失败时synckey为None"""
+        if self._ok(r):
+            data = self._json(r)
+            return {
+                "updated": self._marks(data.get("updated") or []),
+                "removed": self._removed_ids(data.get("removed") or [], "bookmarkId"),
+                "synckey": data.get("synckey"),
+            }
+        print(f"get bookmarklist failed: {r.text}")
+        return {"updated": [], "removed": [], "synckey": None}
+
+    def _review_delta(self, r):
+        """synckey之后变化的笔记及总结，请求失败时synckey为None"""
+        if self._ok(r):
+            data = self._json(r)
+            summary, reviews = self._split_reviews(data.get("reviews") or [])
+            return {
+                "summary": summary,
+                "updated": reviews,
+                "removed": self._removed_ids(data.get("removed") or [], "reviewId"),
+                "synckey": data.get("synckey", data.get("syncKey")),
+            }
+        print(r.text)
+        return {"summary": [], "updated": [], "removed": [], "synckey": None}
+
+    def _bookinfo(self, r):
         isbn = ""
         rating = 0
         category = ""
         intro = ""
 
-        if r.ok:
-            data = r.json()
+        if self._ok(r):
+            data = self._json(r)
             isbn = data["isbn"]
             rating = data["newRating"] / 1000
             category = data.get("category", "")
@@ -130,15 +313,158 @@ class WeReadAPI:
 
         return (isbn, rating, category, intro)
 
+    def _read_info(self, r):
+        if self._ok(r):
+            return self._json(r)
+        return {}
+
+    @staticmethod
+    def _read_info_params(bookId):
+        return dict(bookId=bookId, readingDetail=1, readingBookIndex=1, finishedDate=1)
+
+
+class WeReadAPI(BaseWeReadAPI):
+    """微信读书API"""
+
+    def __init__(self, cookie):
+        session = requests.Session()
+        session.cookies = cookiejar_from_dict(self._parse_cookie(cookie))
+        session.get(self.WEREAD_URL)
+        self.session = session
+
+    def get_notebooklist(self):
+        """全量书籍笔记信息列表，仅包括笔记更新时间、数量等，不包括笔记明细"""
+        return self._notebooklist(self.session.get(self.WEREAD_NOTEBOOKS_URL))
+
+    def get_chapter_list(self, bookId):
+        """获取章节信息列表"""
+        body = {"bookIds": [bookId]}
+        return self._chapter_list(
+            self.session.post(self.WEREAD_CHAPTER_INFO, json=body)
+        )
+
+    def get_bookmark_list(self, bookId):
+        """获取书籍划线列表"""
+        params = dict(bookId=bookId)
+        return self._bookmark_list(
+            self.session.get(self.WEREAD_BOOKMARKLIST_URL, params=params)
+        )
+
+    def get_review_list(self, bookId):
+        """获取笔记列表，包括笔记评论、推荐总结"""
+        params = dict(bookId=bookId, listType=11, mine=1, syncKey=0)
+        return self._review_list(
+            self.session.get(self.WEREAD_REVIEW_LIST_URL, params=params)
+        )
+
+    def get_bookinfo(self, bookId: str) -> list:
+        """获取书的详情"""
+        params = dict(bookId=bookId)
+        return self._bookinfo(self.session.get(self.WEREAD_BOOK_INFO, params=params))
+
     def get_read_info(self, bookId):
         """获取书籍的进度"""
-        params = dict(
-            bookId=bookId, readingDetail=1, readingBookIndex=1, finishedDate=1
+        params = self._read_info_params(bookId)
+        return self._read_info(
+            self.session.get(self.WEREAD_READ_INFO_URL, params=params)
+        )
+
+
+class AsyncWeReadAPI(BaseWeReadAPI):
+    """微信读书API，基于httpx连接池的异步版本
+
+    usage:
+        async with AsyncWeReadAPI(cookie) as wreader:
+            books = await wreader.get_notebooklist()
+    """
+
+    def __init__(self, cookie, max_connections=10, timeout=30, transport=None):
+        """transport: 可替换为本地模拟的httpx transport，用于测试及压测"""
+        self.client = httpx.AsyncClient(
+            transport=transport,
+            cookies=self._parse_cookie(cookie),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+            follow_redirects=True,
+            event_hooks=METRICS.httpx_hooks("weread"),
+        )
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def open(self):
+        """访问首页，刷新cookie"""
+        await self.client.get(self.WEREAD_URL)
+
+    async def aclose(self):
+        """关闭连接池"""
+        await self.client.aclose()
+
+    async def get_notebooklist(self):
+        """全量书籍笔记信息列表，仅包括笔记更新时间、数量等，不包括笔记明细"""
+        return self._notebooklist(await self.client.get(self.WEREAD_NOTEBOOKS_URL))
+
+    async def get_chapter_list(self, bookId):
+        """获取章节信息列表"""
+        body = {"bookIds": [bookId]}
+        return self._chapter_list(
+            await self.client.post(self.WEREAD_CHAPTER_INFO, json=body)
+        )
+
+    async def get_chapter_lists(self, bookIds, chunk_size=50):
+        """批量获取多本书的章节信息列表，每次请求chunk_size本，各批并发
+        return: {bookId: 章节列表}，请求失败的书籍不在结果中
+        """
+        chunks = self._chunks(list(bookIds), chunk_size)
+        responses = await asyncio.gather(
+            *(
+                self.client.post(self.WEREAD_CHAPTER_INFO, json={"bookIds": chunk})
+                for chunk in chunks
+            ),
+            return_exceptions=True,
+        )
+        result = {}
+        for chunk, r in zip(chunks, responses):
+            if isinstance(r, BaseException):
+                print(f"get chapter infos of {len(chunk)} books failed: {r}")
+                continue
+            result.update(self._chapter_lists(r))
+        return result
+
+    async def get_bookmark_delta(self, bookId, synckey=0):
+        """获取synckey之后变化的划线，synckey为0时为全量"""
+        params = dict(bookId=bookId, synckey=synckey)
+        return self._bookmark_delta(
+            await self.client.get(self.WEREAD_BOOKMARKLIST_URL, params=params)
+        )
+
+    async def get_review_delta(self, bookId, synckey=0):
+        """获取synckey之后变化的笔记及总结，synckey为0时为全量"""
+        params = dict(bookId=bookId, listType=11, mine=1, syncKey=synckey)
+        return self._review_delta(
+            await self.client.get(self.WEREAD_REVIEW_LIST_URL, params=params)
+        )
+
+    async def get_bookinfo(self, bookId: str) -> list:
+        """获取书的详情"""
+        params = dict(bookId=bookId)
+        return self._bookinfo(
+            await self.client.get(self.WEREAD_BOOK_INFO, params=params)
+        )
+
+    async def get_read_info(self, bookId):
+        """获取书籍的进度"""
+        params = self._read_info_params(bookId)
+        return self._read_info(
+            await self.client.get(self.WEREAD_READ_INFO_URL, params=params)
         )
-        r = self.session.get(self.WEREAD_READ_INFO_URL, params=params)
-        if r.ok:
-            return r.json()
-        return {}
 
 
 def str_reading_time(reading_time: int):
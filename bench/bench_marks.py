@@ -0,0 +1,143 @@
+"""
+Micro-benchmark of parsing and ordering the highlights of one large account.
+
+usage:
+    python -m bench.bench_marks --highlights=50000 --reviews=5000
+
+Compares the former dict pipeline (extend, then re-sort with a key that
+splits "range" on every call) against Mark records whose sort key is
+computed once, with the two sorted streams combined by a linear merge.
+Building the records is reported on its own as `parse`.
+"""
+
+import random
+import time
+
+import fire
+
+from api.weread import Mark, merge_marks, sort_marks
+
+
+def make_payloads(highlights=50000, reviews=5000, chapters=200, seed=0):
+    """bookmarklist and review/list payloads in WeRead's (unsorted) order"""
+    rnd = random.Random(seed)
+    bookmarks = []
+    for seq in range(highlights):
+        start = rnd.randint(0, 200000)
+        bookmarks.append(
+            {
+                "bookmarkId": f"b_{seq}",
+                "chapterUid": rnd.randint(1, chapters),
+                "range": f"{start}-{start + 30}",
+                "markText": f"highlight {seq}",
+                "style": seq % 3,
+                "colorStyle": seq % 5,
+            }
+        )
+    review_list = [{"review": {"reviewId": "summary", "content": "summary", "type": 4}}]
+    for seq in range(reviews):
+        start = rnd.randint(0, 200000)
+        review_list.append(
+            {
+                "review": {
+                    "reviewId": f"r_{seq}",
+                    "chapterUid": rnd.randint(1, chapters),
+                    "range": f"{start}-{start + 10}",
+                    "content": f"thoughts {seq}",
+                    "abstract": f"quoted {seq}",
+                    "type": 1,
+                }
+            }
+        )
+    return bookmarks, review_list
+
+
+def legacy_order(bookmarks: list, review_list: list) -> list:
+    """the dict pipeline: sort bookmarks, append reviews, sort everything again"""
+
+    def key(x):
+        return (
+            x.get("chapterUid", 1),
+            (
+                0
+                if (x.get("range", "") == "" or x.get("range").split("-")[0] == "")
+                else int(x.get("range").split("-")[0])
+            ),
+        )
+
+    marks = list(bookmarks)
+    marks.sort(key=key)
+    marks.extend(
+        item["review"] for item in review_list if item["review"].get("type") == 1
+    )
+    return sorted(marks, key=key)
+
+
+def parse_records(bookmarks: list, review_list: list) -> tuple:
+    """one Mark per highlight / review, unsorted; sort keys are computed here"""
+    marks = [Mark.from_bookmark(item) for item in bookmarks]
+    reviews = [
+        Mark.from_review(item["review"])
+        for item in review_list
+        if item["review"].get("type") == 1
+    ]
+    return marks, reviews
+
+
+def record_order(marks: list, reviews: list) -> list:
+    """sort each stream on the precomputed key, then merge the two runs"""
+    return merge_marks(sort_marks(list(marks)), sort_marks(list(reviews)))
+
+
+def timed(func, *args, repeat=3):
+    """best of `repeat` runs, (seconds, result)"""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_bench(highlights=50000, reviews=5000, chapters=200, repeat=3, seed=0):
+    """
+    time both orderings on the same payloads and check they agree
+    parse: building the records, paid once per response and shared by every
+    later step (ordering, mounting to chapters, block making, cache)
+    """
+    bookmarks, review_list = make_payloads(highlights, reviews, chapters, seed)
+    legacy_s, legacy = timed(legacy_order, bookmarks, review_list, repeat=repeat)
+    parse_s, streams = timed(parse_records, bookmarks, review_list, repeat=repeat)
+    order_s, records = timed(record_order, *streams, repeat=repeat)
+    legacy_ids = [x.get("bookmarkId") or x.get("reviewId") for x in legacy]
+    return {
+        "marks": len(records),
+        "legacy": legacy_s,
+        "parse": parse_s,
+        "order": order_s,
+        "speedup": legacy_s / order_s if order_s else 0.0,
+        "same_order": legacy_ids == [mark.id for mark in records],
+    }
+
+
+def report(result: dict) -> str:
+    """result as a text table"""
+    return "\n".join(
+        [
+            f"{'marks':>8} {'legacy(ms)':>11} {'order(ms)':>10} {'speedup':>8} "
+            f"{'parse(ms)':>10} {'same':>5}",
+            f"{result['marks']:>8} {result['legacy'] * 1000:>11.1f} "
+            f"{result['order'] * 1000:>10.1f} {result['speedup']:>8.2f} "
+            f"{result['parse'] * 1000:>10.1f} {str(result['same_order']):>5}",
+        ]
+    )
+
+
+def main(**kwargs):
+    """run the benchmark and print the report, see run_bench for the options"""
+    print(report(run_bench(**kwargs)))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,109 @@
+"""
+Micro-benchmark of the chapter position lookup of PageBlockList.
+
+usage:
+    python -m bench.bench_page_block_list --blocks=5000 --lookups=200
+
+Compares the bisect lookup on the heading index against the original scan
+over every block of the page, on a synthetic page of synced chapters.
+"""
+
+import random
+import time
+
+import fire
+
+from lib.db_weread_record import BookRecord
+from lib.page_block_list import PageBlockList, safe_cast
+
+
+def linear_chapter_position(blocks, chapter_uid):
+    """the original O(blocks) scan, used as reference"""
+    chapter, block_id, block_idx = -1, None, -1
+    for idx, block in enumerate(blocks):
+        if block["bookmark_id"] is not None and block["type"].startswith("heading_"):
+            _cuid = safe_cast(block["bookmark_id"], int, 0)
+            if _cuid < chapter_uid and _cuid > chapter:
+                chapter = _cuid
+                block_id = block["id"]
+                block_idx = idx
+    if not block_id:
+        return blocks[0]["id"] if len(blocks) > 0 else None
+    while block_idx < len(blocks) - 1:
+        block = blocks[block_idx + 1]
+        if block["type"].startswith("heading_"):
+            return block_id
+        block_idx += 1
+        block_id = block["id"]
+    return block_id
+
+
+def synthetic_page(num_blocks=5000, seed=7):
+    """
+    headings with even chapter uids followed by highlights, plus untracked blocks
+    :return: (blocks, records, largest chapter uid)
+    """
+    rnd = random.Random(seed)
+    records = BookRecord("book_bench")
+    blocks = [{"id": "toc", "type": "table_of_contents"}]
+    chapter_uid = 0
+    while len(blocks) < num_blocks:
+        chapter_uid += 2
+        heading_id = f"heading_{chapter_uid}"
+        blocks.append({"id": heading_id, "type": f"heading_{rnd.randint(1, 3)}"})
+        records.add(chapter_uid, heading_id)
+        if rnd.random() < 0.05:  # heading added by the user, not synced
+            blocks.append({"id": f"user_{chapter_uid}", "type": "heading_2"})
+        for i in range(rnd.randint(0, 18)):
+            block_id = f"mark_{chapter_uid}_{i}"
+            blocks.append({"id": block_id, "type": "bulleted_list_item"})
+            records.add(f"bookmark_{chapter_uid}_{i}", block_id)
+    blocks.append({"id": "comment", "type": "heading_1"})
+    records.add("_comment_", "comment")
+    return blocks[:num_blocks], records, chapter_uid
+
+
+def lookups(max_uid: int, count: int) -> list:
+    """chapter uids spread over the page, including ones before and after it"""
+    return list(range(-1, max_uid + 3, max(1, max_uid // count)))
+
+
+def run_bench(blocks=5000, lookups_per_page=200, seed=7) -> dict:
+    """time both lookups on the same page, check they agree"""
+    page, records, max_uid = synthetic_page(blocks, seed)
+    queries = lookups(max_uid, lookups_per_page)
+
+    start = time.perf_counter()
+    page_block_list = PageBlockList(None, "book_bench", page, records=records)
+    indexed = [page_block_list.found_chapter_position(uid) for uid in queries]
+    indexed_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    linear = [linear_chapter_position(page_block_list.blocks, uid) for uid in queries]
+    linear_cost = time.perf_counter() - start
+
+    return {
+        "blocks": len(page),
+        "lookups": len(queries),
+        "indexed": indexed_cost,
+        "linear": linear_cost,
+        "same": indexed == linear,
+    }
+
+
+def report(result: dict) -> str:
+    """result as a text line"""
+    return (
+        f"{result['blocks']} blocks, {result['lookups']} lookups: "
+        f"indexed {result['indexed'] * 1000:.2f}ms, "
+        f"linear {result['linear'] * 1000:.2f}ms, same: {result['same']}"
+    )
+
+
+def main(blocks=5000, lookups=200, seed=7):
+    """run the benchmark and print the report"""
+    print(report(run_bench(blocks, lookups, seed)))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,142 @@
+"""
+End-to-end throughput benchmark of sync_read against the local stand-ins.
+
+usage:
+    python -m bench.bench_sync_read --books=50 --chapters=30 --highlights=40
+
+The first round syncs the whole library into an empty database, the next
+rounds add `new_highlights` to every book and sync incrementally.
+"""
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import fire
+
+from api import notion, weread
+from bench.fake_notion import FakeNotion
+from bench.fake_weread import FakeWeRead
+from config import CONFIG
+from lib.db_weread_record import DBWeReadCache, DBWeReadRecord
+import sync_read
+
+
+@contextmanager
+def config_override(settings: dict):
+    """
+    set {(section, option): value} in the global CONFIG, restore it on exit
+    options missing before are removed again
+    """
+    saved = {key: CONFIG.get(*key, fallback=None) for key in settings}
+    for (section, option), value in settings.items():
+        CONFIG.set(section, option, str(value))
+    try:
+        yield
+    finally:
+        for (section, option), value in saved.items():
+            if value is None:
+                CONFIG.remove_option(section, option)
+            else:
+                CONFIG.set(section, option, value)
+
+
+async def run_bench(
+    books=20,
+    chapters=20,
+    highlights=30,
+    new_highlights=5,
+    rounds=2,
+    latency=0.02,
+    rate_limit_every=0,
+    rate=1000.0,
+    concurrency=None,
+    seed=0,
+) -> list[dict]:
+    """
+    run sync_books round by round, return the stats of each round
+    rate: notion requests per second of the client token bucket ([notion.api] RateLimit)
+    concurrency: books in flight, [weread.sync] Concurrency if None
+    """
+    settings = {
+        ("notion.api", "RateLimit"): rate,
+        ("notion.api", "Burst"): max(int(rate), 1),
+    }
+    if concurrency is not None:
+        settings[("weread.sync", "Concurrency")] = concurrency
+    with config_override(settings):
+        fake_notion = FakeNotion(latency=latency, rate_limit_every=rate_limit_every)
+        fake_weread = FakeWeRead(
+            books, chapters, highlights, latency=latency, seed=seed
+        )
+        database_id = fake_notion.add_database()
+        client = notion.create_client("bench", transport=fake_notion.transport())
+
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            store = DBWeReadRecord(os.path.join(tmp, "bench.db"))
+            cache = DBWeReadCache(os.path.join(tmp, "cache.db"))
+            for idx in range(rounds):
+                if idx > 0:
+                    fake_weread.add_highlights(new_highlights)
+                notion_before = fake_notion.total_requests()
+                limited_before = fake_notion.rate_limited
+                fetched_before = fake_weread.requests["/web/book/bookmarklist"]
+
+                wreader = weread.AsyncWeReadAPI(
+                    "wr_skey=bench", transport=fake_weread.transport()
+                )
+                start = time.perf_counter()
+                await wreader.open()
+                try:
+                    await sync_read.sync_books(
+                        client, wreader, store, database_id, cache=cache
+                    )
+                finally:
+                    await wreader.aclose()
+                wall = time.perf_counter() - start
+
+                synced = fake_weread.requests["/web/book/bookmarklist"] - fetched_before
+                requests = fake_notion.total_requests() - notion_before
+                results.append(
+                    {
+                        "round": idx + 1,
+                        "books": synced,
+                        "wall": wall,
+                        "books_per_s": synced / wall if wall else 0.0,
+                        "requests": requests,
+                        "requests_per_book": requests / synced if synced else 0.0,
+                        "rate_limited": fake_notion.rate_limited - limited_before,
+                    }
+                )
+            del store
+            del cache
+        return results
+
+
+def report(results: list[dict]) -> str:
+    """results as a text table"""
+    lines = [
+        f"{'round':>5} {'books':>6} {'wall(s)':>8} {'books/s':>8} "
+        f"{'requests':>9} {'req/book':>9} {'429':>5}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r['round']:>5} {r['books']:>6} {r['wall']:>8.2f} "
+            f"{r['books_per_s']:>8.2f} {r['requests']:>9} "
+            f"{r['requests_per_book']:>9.1f} {r['rate_limited']:>5}"
+        )
+    return "\n".join(lines)
+
+
+def main(**kwargs):
+    """run the benchmark and print the report, see run_bench for the options"""
+    logging.basicConfig(level=logging.WARNING)
+    print(report(asyncio.run(run_bench(**kwargs))))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,335 @@
+"""In-process stand-in for the Notion API, used as an httpx transport"""
+
+import asyncio
+import itertools
+import json
+import re
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import httpx
+
+
+class FakeNotion(object):
+    """Pages, blocks and data sources kept in memory.
+
+    Plugged into the real SDK client through `transport()`, so the request
+    building, rate limiter and 429 retry path all run as against Notion.
+
+    latency: seconds every request takes
+    rate_limit_every: answer every n-th request with 429 (0: never)
+    retry_after: Retry-After of the injected 429 responses
+    """
+
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=0.0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+
+        self.databases = {}  # database id -> data source id
+        self.pages = {}  # page id -> page
+        self.blocks = {}  # block id -> block
+        self.children = defaultdict(list)  # parent id -> child block ids
+        self.parents = {}  # block id -> parent id
+
+        self.requests = Counter()  # endpoint -> requests answered
+        self.rate_limited = 0
+        # endpoint -> number of upcoming requests answered with 500
+        self.fail_next = Counter()
+        self._total = 0
+        self._ids = itertools.count(1)
+        self._clock = datetime(2024, 1, 1)
+
+        self._routes = [
+            (
+                "GET",
+                r"databases/([^/]+)",
+                "databases.retrieve",
+                self._retrieve_database,
+            ),
+            ("POST", r"data_sources/([^/]+)/query", "data_sources.query", self._query),
+            ("POST", r"pages", "pages.create", self._create_page),
+            ("GET", r"pages/([^/]+)", "pages.retrieve", self._retrieve_page),
+            ("PATCH", r"pages/([^/]+)", "pages.update", self._update_page),
+            (
+                "GET",
+                r"blocks/([^/]+)/children",
+                "blocks.children.list",
+                self._list_children,
+            ),
+            (
+                "PATCH",
+                r"blocks/([^/]+)/children",
+                "blocks.children.append",
+                self._append_children,
+            ),
+            ("PATCH", r"blocks/([^/]+)", "blocks.update", self._update_block),
+            ("DELETE", r"blocks/([^/]+)", "blocks.delete", self._delete_block),
+        ]
+
+    def transport(self) -> httpx.MockTransport:
+        """httpx transport answering from memory"""
+        return httpx.MockTransport(self.handle)
+
+    def add_database(self) -> str:
+        """create an empty database with one data source, return the database id"""
+        database_id = self._new_id()
+        self.databases[database_id] = self._new_id()
+        return database_id
+
+    def total_requests(self) -> int:
+        """requests answered, injected 429 excluded"""
+        return sum(self.requests.values())
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        """route a request of the SDK"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._total += 1
+        if self.rate_limit_every and self._total % self.rate_limit_every == 0:
+            self.rate_limited += 1
+            return self._error(
+                429,
+                "rate_limited",
+                "rate limited",
+                headers={"retry-after": str(self.retry_after)},
+            )
+
+        path = request.url.path.removeprefix("/v1/").rstrip("/")
+        body = json.loads(request.content) if request.content else {}
+        for method, pattern, endpoint, handler in self._routes:
+            match = re.fullmatch(pattern, path)
+            if method == request.method and match:
+                if self.fail_next[endpoint] > 0:
+                    self.fail_next[endpoint] -= 1
+                    return self._error(500, "internal_server_error", "injected")
+                self.requests[endpoint] += 1
+                return handler(request, body, *match.groups())
+        return self._error(400, "invalid_request_url", f"{request.method} {path}")
+
+    # responses
+
+    def _new_id(self) -> str:
+        return f"{next(self._ids):032x}"
+
+    def _now(self) -> str:
+        """every write moves the clock, so last_edited_time always increases"""
+        self._clock += timedelta(seconds=1)
+        return self._clock.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    @staticmethod
+    def _ok(data) -> httpx.Response:
+        return httpx.Response(200, json=data)
+
+    @staticmethod
+    def _error(status, code, message, headers=None) -> httpx.Response:
+        return httpx.Response(
+            status,
+            json={
+                "object": "error",
+                "status": status,
+                "code": code,
+                "message": message,
+            },
+            headers=headers,
+        )
+
+    def _not_found(self, object_id) -> httpx.Response:
+        return self._error(404, "object_not_found", f"Could not find {object_id}")
+
+    @staticmethod
+    def _paginate(items: list, query) -> dict:
+        start = int(query.get("start_cursor") or 0)
+        size = int(query.get("page_size") or 100)
+        end = start + size
+        return {
+            "object": "list",
+            "results": items[start:end],
+            "has_more": end < len(items),
+            "next_cursor": str(end) if end < len(items) else None,
+        }
+
+    # rich text as notion returns it: typed properties, plain_text filled
+
+    @staticmethod
+    def _with_plain_text(items: list) -> list:
+        return [
+            {**item, "plain_text": item.get("text", {}).get("content", "")}
+            for item in items
+        ]
+
+    def _property(self, value: dict) -> dict:
+        kind = next(iter(value))
+        if kind in ("title", "rich_text"):
+            value = {kind: self._with_plain_text(value[kind])}
+        return {"type": kind, **value}
+
+    def _content(self, block_type: str, content: dict) -> dict:
+        content = {k: v for k, v in content.items() if k != "children"}
+        if "rich_text" in content:
+            content["rich_text"] = self._with_plain_text(content["rich_text"])
+        if block_type == "table_row":
+            content["cells"] = [
+                self._with_plain_text(cell) for cell in content.get("cells", [])
+            ]
+        return content
+
+    # databases & pages
+
+    def _retrieve_database(self, request, body, database_id):
+        if database_id not in self.databases:
+            return self._not_found(database_id)
+        return self._ok(
+            {
+                "object": "database",
+                "id": database_id,
+                "data_sources": [{"id": self.databases[database_id]}],
+            }
+        )
+
+    def _match(self, page: dict, flt: dict) -> bool:
+        if not flt:
+            return True
+        if "and" in flt:
+            return all(self._match(page, f) for f in flt["and"])
+        if "or" in flt:
+            return any(self._match(page, f) for f in flt["or"])
+
+        prop = page["properties"].get(flt["property"], {})
+        for kind in ("rich_text", "title"):
+            if kind in flt:
+                text = "".join(i["plain_text"] for i in prop.get(kind, []))
+                return text == flt[kind].get("equals", text)
+        if "number" in flt:
+            number = prop.get("number")
+            if flt["number"].get("is_not_empty"):
+                return number is not None
+            return number == flt["number"].get("equals")
+        if "date" in flt:
+            start = ((prop.get("date") or {}).get("start") or "")[:10]
+            cond = flt["date"]
+            return bool(start) and (
+                start >= cond.get("on_or_after", start)
+                and start <= cond.get("on_or_before", start)
+                and start == cond.get("equals", start)
+            )
+        return True
+
+    def _query(self, request, body, data_source_id):
+        pages = [
+            page
+            for page in self.pages.values()
+            if page["parent"].get("data_source_id") == data_source_id
+            and not page["in_trash"]
+            and self._match(page, body.get("filter"))
+        ]
+        for sort in reversed(body.get("sorts", [])):
+            pages.sort(
+                key=lambda p: p["properties"].get(sort["property"], {}).get("number")
+                or 0,
+                reverse=sort.get("direction") == "descending",
+            )
+        return self._ok(self._paginate(pages, body))
+
+    def _create_page(self, request, body):
+        page_id = self._new_id()
+        page = {
+            "object": "page",
+            "id": page_id,
+            "parent": body.get("parent", {}),
+            "icon": body.get("icon"),
+            "properties": {
+                k: self._property(v) for k, v in body.get("properties", {}).items()
+            },
+            "in_trash": False,
+            "archived": False,
+            "last_edited_time": self._now(),
+        }
+        self.pages[page_id] = page
+        return self._ok(page)
+
+    def _retrieve_page(self, request, body, page_id):
+        if page_id not in self.pages:
+            return self._not_found(page_id)
+        return self._ok(self.pages[page_id])
+
+    def _update_page(self, request, body, page_id):
+        page = self.pages.get(page_id)
+        if page is None:
+            return self._not_found(page_id)
+        for key, value in body.get("properties", {}).items():
+            page["properties"][key] = self._property(value)
+        if "icon" in body:
+            page["icon"] = body["icon"]
+        page["last_edited_time"] = self._now()
+        return self._ok(page)
+
+    def _touch(self, block_id):
+        """edits of blocks show up in the last_edited_time of their page"""
+        while block_id in self.parents:
+            block_id = self.parents[block_id]
+        if block_id in self.pages:
+            self.pages[block_id]["last_edited_time"] = self._now()
+
+    # blocks
+
+    def _exists(self, block_id) -> bool:
+        return block_id in self.pages or block_id in self.blocks
+
+    def _list_children(self, request, body, block_id):
+        if not self._exists(block_id):
+            return self._not_found(block_id)
+        children = [self.blocks[bid] for bid in self.children[block_id]]
+        return self._ok(self._paginate(children, request.url.params))
+
+    def _add_block(self, parent_id, block: dict) -> dict:
+        block_type = block["type"]
+        content = block.get(block_type, {})
+        stored = {
+            "object": "block",
+            "id": self._new_id(),
+            "type": block_type,
+            block_type: self._content(block_type, content),
+            "has_children": bool(content.get("children")),
+        }
+        self.blocks[stored["id"]] = stored
+        self.parents[stored["id"]] = parent_id
+        for child in content.get("children", []):
+            self.children[stored["id"]].append(
+                self._add_block(stored["id"], child)["id"]
+            )
+        return stored
+
+    def _append_children(self, request, body, block_id):
+        if not self._exists(block_id):
+            return self._not_found(block_id)
+        siblings = self.children[block_id]
+        pos = len(siblings)
+        if body.get("after"):
+            if body["after"] not in siblings:
+                return self._error(
+                    400, "validation_error", f"block {body['after']} not found"
+                )
+            pos = siblings.index(body["after"]) + 1
+        added = [self._add_block(block_id, block) for block in body.get("children", [])]
+        siblings[pos:pos] = [block["id"] for block in added]
+        self._touch(block_id)
+        return self._ok({"object": "list", "results": added, "has_more": False})
+
+    def _update_block(self, request, body, block_id):
+        block = self.blocks.get(block_id)
+        if block is None:
+            return self._not_found(block_id)
+        block_type = block["type"]
+        if block_type in body:
+            block[block_type] = self._content(block_type, body[block_type])
+        self._touch(block_id)
+        return self._ok(block)
+
+    def _delete_block(self, request, body, block_id):
+        block = self.blocks.pop(block_id, None)
+        if block is None:
+            return self._not_found(block_id)
+        self._touch(block_id)
+        self.children[self.parents.pop(block_id)].remove(block_id)
+        return self._ok({**block, "in_trash": True, "archived": True})
@@ -0,0 +1,237 @@
+"""In-process stand-in for the WeRead web API, serving a synthetic library"""
+
+import asyncio
+import json
+import random
+from collections import Counter
+
+import httpx
+
+DAY = 24 * 3600
+START = 1700000000  # first reading day of the synthetic library
+
+
+class FakeWeRead(object):
+    """books x chapters x highlights, generated from a seed.
+
+    Plugged into AsyncWeReadAPI through `transport()`. `add_highlights`
+    simulates a reading session on every book, so the next sync is
+    incremental.
+
+    Bookmarks and reviews carry a synckey, requests with a synckey only get
+    the ones added after it. `reset_synckeys` restarts the numbering, like a
+    server side reset.
+
+    latency: seconds every request takes
+    """
+
+    def __init__(self, books=10, chapters=20, highlights=30, latency=0.0, seed=0):
+        self.latency = latency
+        self.requests = Counter()  # endpoint -> requests answered
+        self._rnd = random.Random(seed)
+        self._sort = START
+        self._synckey = 0
+        self.synckeys = {}  # bookmark / review id -> synckey
+        self.books = {}
+        for idx in range(books):
+            book_id = str(10000 + idx)
+            self.books[book_id] = {
+                "book": {
+                    "bookId": book_id,
+                    "title": f"Book {idx}",
+                    "author": f"Author {idx % 7}",
+                    "cover": f"https://example.com/cover/{book_id}.jpg",
+                },
+                "chapters": [
+                    {
+                        "chapterUid": uid,
+                        "chapterIdx": uid,
+                        "title": f"Chapter {uid}",
+                        "level": 1 if uid % 5 == 1 else 2,
+                    }
+                    for uid in range(1, chapters + 1)
+                ],
+                "bookmarks": [],
+                "reviews": [],
+                "days": [],
+                "sort": 0,
+            }
+            self._read(book_id, highlights)
+
+    def add_highlights(self, count: int):
+        """a new reading day with `count` highlights (and a review) on every book"""
+        for book_id in self.books:
+            self._read(book_id, count)
+
+    def add_chapter(self, book_id: str, title: str, review_only=False):
+        """publish a new chapter and highlight it, or only review it"""
+        chapters = self.books[book_id]["chapters"]
+        uid = len(chapters) + 1
+        chapters.append(
+            {"chapterUid": uid, "chapterIdx": uid, "title": title, "level": 1}
+        )
+        if review_only:
+            self._review(book_id, uid)
+            self._read(book_id, 0)
+        else:
+            self._read(book_id, 1, chapter_uid=uid)
+
+    def _read(self, book_id: str, count: int, chapter_uid=None):
+        book = self.books[book_id]
+        num_chapters = len(book["chapters"])
+        for _ in range(count):
+            seq = len(book["bookmarks"])
+            if chapter_uid is None:
+                chapter_uid = self._rnd.randint(1, max(num_chapters, 1))
+            start = self._rnd.randint(0, 20000)
+            self._synckey += 1
+            self.synckeys[f"{book_id}_{chapter_uid}_{seq}"] = self._synckey
+            book["bookmarks"].append(
+                {
+                    "bookId": book_id,
+                    "bookmarkId": f"{book_id}_{chapter_uid}_{seq}",
+                    "chapterUid": chapter_uid,
+                    "range": f"{start}-{start + 30}",
+                    "markText": f"highlight {seq} of book {book_id} " * 3,
+                    "style": seq % 3,
+                    "colorStyle": seq % 5,
+                }
+            )
+        if count:
+            self._review(book_id)
+        book["days"].append(
+            {"readDate": START + len(book["days"]) * DAY, "readTime": 600 + count * 60}
+        )
+        self._sort += 1
+        book["sort"] = self._sort
+
+    def _review(self, book_id: str, chapter_uid=None):
+        book = self.books[book_id]
+        if chapter_uid is None:
+            chapter_uid = self._rnd.randint(1, max(len(book["chapters"]), 1))
+        seq = len(book["reviews"])
+        self._synckey += 1
+        self.synckeys[f"review_{book_id}_{seq}"] = self._synckey
+        book["reviews"].append(
+            {
+                "reviewId": f"review_{book_id}_{seq}",
+                "chapterUid": chapter_uid,
+                "range": f"{seq}-{seq + 10}",
+                "content": f"thoughts {seq}",
+                "abstract": f"quoted text {seq}",
+                "type": 1,
+            }
+        )
+
+    def reset_synckeys(self):
+        """restart synckeys from 0, the ones held by clients are ahead of the server"""
+        self._synckey = 0
+        self.synckeys = dict.fromkeys(self.synckeys, 0)
+
+    def _since(self, items: list, key: str, params) -> list:
+        synckey = int(params.get("synckey") or params.get("syncKey") or 0)
+        if not synckey:
+            return items
+        return [item for item in items if self.synckeys.get(item[key], 0) > synckey]
+
+    def transport(self) -> httpx.MockTransport:
+        """httpx transport answering from memory"""
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        """route a request of AsyncWeReadAPI"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        path = request.url.path
+        params = request.url.params
+        self.requests[path] += 1
+        if path == "/":
+            return httpx.Response(200, text="<html></html>")
+        if path == "/api/user/notebook":
+            return httpx.Response(200, json={"books": self._notebooks()})
+        if path == "/web/book/chapterInfos":
+            book_ids = json.loads(request.content).get("bookIds", [])
+            return httpx.Response(
+                200,
+                json={
+                    "data": [
+                        {"bookId": i, "updated": self.books[i]["chapters"]}
+                        for i in book_ids
+                    ]
+                },
+            )
+
+        book = self.books.get(params.get("bookId"))
+        if book is None:
+            return httpx.Response(404, json={"errcode": -2010, "errmsg": "not found"})
+        if path == "/web/book/bookmarklist":
+            return httpx.Response(
+                200,
+                json={
+                    "synckey": self._synckey,
+                    "updated": self._since(book["bookmarks"], "bookmarkId", params),
+                    "removed": [],
+                },
+            )
+        if path == "/web/review/list":
+            reviews = [
+                {"review": dict(review)}
+                for review in self._since(book["reviews"], "reviewId", params)
+            ]
+            reviews.append(
+                {
+                    "review": {
+                        "reviewId": f"summary_{params.get('bookId')}",
+                        "content": "summary",
+                        "type": 4,
+                    }
+                }
+            )
+            return httpx.Response(
+                200, json={"synckey": self._synckey, "reviews": reviews}
+            )
+        if path == "/web/book/info":
+            return httpx.Response(
+                200,
+                json={
+                    "isbn": f"978{params.get('bookId')}",
+                    "newRating": 850,
+                    "category": "bench",
+                    "intro": "synthetic book",
+                },
+            )
+        if path == "/web/book/readinfo":
+            return httpx.Response(200, json=self._read_info(params.get("bookId")))
+        return httpx.Response(404, json={"errcode": -1, "errmsg": path})
+
+    def _notebooks(self) -> list:
+        return [
+            {
+                "bookId": book_id,
+                "book": dict(book["book"]),
+                "sort": book["sort"],
+                "noteCount": len(book["bookmarks"]),
+                "reviewCount": len(book["reviews"]),
+            }
+            for book_id, book in self.books.items()
+        ]
+
+    def _read_info(self, book_id: str) -> dict:
+        book = self.books[book_id]
+        days = book["days"]
+        longest = max(days, key=lambda day: day["readTime"])
+        return {
+            "bookId": book_id,
+            "markedStatus": 2,
+            "readingTime": sum(day["readTime"] for day in days),
+            "readDetail": {
+                "totalReadDay": len(days),
+                "continueReadDays": len(days),
+                "longestReadingTime": longest["readTime"],
+                "longestReadingDate": longest["readDate"],
+                "lastReadingDate": days[-1]["readDate"],
+                "data": [dict(day) for day in days],
+            },
+            "bookInfo": {"bookId": book_id, "title": book["book"]["title"]},
+        }
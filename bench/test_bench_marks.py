@@ -0,0 +1,19 @@
+"""unit test for the highlight ordering micro-benchmark"""
+
+import unittest
+
+from bench.bench_marks import run_bench
+
+
+class TestBenchMarks(unittest.TestCase):
+    """benchmark harness"""
+
+    def test_run_bench(self):
+        """records come out in the order of the former dict pipeline"""
+        result = run_bench(highlights=300, reviews=40, chapters=5, repeat=1)
+        self.assertEqual(result["marks"], 340)
+        self.assertTrue(result["same_order"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,275 @@
+"""end-to-end test of sync_read against the local stand-ins"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+from collections import Counter
+from contextlib import ExitStack
+from unittest import mock
+
+from api import notion, weread
+from bench.bench_sync_read import config_override, run_bench
+from bench.fake_notion import FakeNotion
+from bench.fake_weread import FakeWeRead
+from config import CONFIG
+from lib.metrics import METRICS
+from lib.db_weread_record import DBWeReadCache, DBWeReadRecord
+import sync_read
+
+
+def page_texts(fake: FakeNotion, page_id: str) -> Counter:
+    """plain text of every top-level block of a page"""
+    texts = Counter()
+    for block_id in fake.children[page_id]:
+        block = fake.blocks[block_id]
+        rich_text = block[block["type"]].get("rich_text", [])
+        texts["".join(item["plain_text"] for item in rich_text)] += 1
+    return texts
+
+
+def note_count(fake: FakeNotion, page_id: str) -> str:
+    """阅读笔记条数 in the reading detail table of a page"""
+    for block_id, parent in fake.parents.items():
+        block = fake.blocks[block_id]
+        if block["type"] != "table_row":
+            continue
+        cells = [
+            "".join(i["plain_text"] for i in c) for c in block["table_row"]["cells"]
+        ]
+        if cells[0] == "阅读笔记条数" and fake.parents[parent] == page_id:
+            return cells[1]
+    return None
+
+
+class TestSyncRead(unittest.TestCase):
+    """sync a synthetic library twice, with injected 429s"""
+
+    def setUp(self):
+        config = ExitStack()
+        config.enter_context(
+            config_override(
+                {("notion.api", "RateLimit"): 1000, ("notion.api", "Burst"): 1000}
+            )
+        )
+        self.addCleanup(config.close)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = DBWeReadRecord(os.path.join(self.tmp.name, "test.db"))
+        self.cache = DBWeReadCache(os.path.join(self.tmp.name, "cache.db"))
+        self.notion = FakeNotion(rate_limit_every=7)
+        self.weread = FakeWeRead(books=3, chapters=6, highlights=8, seed=1)
+        self.database_id = self.notion.add_database()
+
+    def tearDown(self):
+        del self.store
+        del self.cache
+        self.tmp.cleanup()
+
+    def sync(self):
+        """one sync_read run, with clients bound to its own event loop"""
+
+        async def run():
+            client = notion.create_client("test", transport=self.notion.transport())
+            async with weread.AsyncWeReadAPI(
+                "wr_skey=test", transport=self.weread.transport()
+            ) as wreader:
+                await sync_read.sync_books(
+                    client, wreader, self.store, self.database_id, cache=self.cache
+                )
+
+        asyncio.run(run())
+
+    def assert_synced(self):
+        """every highlight and review shows up exactly once on its book page"""
+        pages = [p for p in self.notion.pages.values() if not p["in_trash"]]
+        self.assertEqual(len(pages), len(self.weread.books))
+        for page in pages:
+            book_id = notion.plain_text(page["properties"]["BookId"])
+            book = self.weread.books[book_id]
+            texts = page_texts(self.notion, page["id"])
+            for mark in book["bookmarks"]:
+                self.assertEqual(texts[mark["markText"]], 1)
+            for review in book["reviews"]:
+                self.assertEqual(texts[review["content"]], 1)
+
+    def test_initial_and_incremental(self):
+        """full sync, no-op sync, then only the new highlights are appended"""
+        self.sync()
+        self.assert_synced()
+        self.assertGreater(self.notion.rate_limited, 0)
+
+        appends = self.notion.requests["blocks.children.append"]
+        pages = {k: tuple(row) for k, row in self.store.query_pages().items()}
+        self.sync()
+        self.assertEqual(self.notion.requests["blocks.children.append"], appends)
+        # the page index of a no-op run leaves the recorded pages untouched
+        self.assertEqual(
+            {k: tuple(row) for k, row in self.store.query_pages().items()}, pages
+        )
+
+        fetched = self.weread.requests["/web/book/info"]
+        self.weread.add_highlights(3)
+        self.sync()
+        self.assert_synced()
+        # chapters and book info come from the local cache
+        self.assertEqual(self.weread.requests["/web/book/info"], fetched)
+
+    def test_delta(self):
+        """only new highlights are fetched, the note count stays exact"""
+        self.sync()
+        self.weread.add_highlights(2)
+        METRICS.reset()
+        self.sync()
+        self.assert_synced()
+        books = len(self.weread.books)
+        self.assertEqual(METRICS.get("weread.delta", result="delta"), books)
+        for book_id, book in self.weread.books.items():
+            page_id = self.store.query_page(book_id)["page_id"]
+            marks = len(book["bookmarks"]) + len(book["reviews"])
+            self.assertEqual(note_count(self.notion, page_id), f"{marks}条")
+
+    def test_delta_reset(self):
+        """a reset synckey falls back to a full fetch"""
+        self.sync()
+        self.weread.reset_synckeys()
+        self.weread.add_highlights(2)
+        METRICS.reset()
+        self.sync()
+        self.assert_synced()
+        self.assertEqual(
+            METRICS.get("weread.delta", result="reset"), len(self.weread.books)
+        )
+
+    def test_delta_new_page(self):
+        """a page recreated from a delta fetch is completed by the next run"""
+        self.sync()
+        book_id = next(iter(self.weread.books))
+        self.notion.pages[self.store.query_page(book_id)["page_id"]]["in_trash"] = True
+        self.weread.add_highlights(2)
+        self.sync()
+        self.assertEqual(list(self.store.journal_pending()), [book_id])
+
+        self.sync()
+        self.assert_synced()
+        self.assertEqual(self.store.journal_pending(), {})
+
+    def test_recorded_page_ids(self):
+        """without the page index, recorded page ids are used as is"""
+        prefetch = CONFIG.get("weread.sync", "PrefetchPages", fallback="true")
+        CONFIG.set("weread.sync", "PrefetchPages", "false")
+        try:
+            self.sync()
+            queries = self.notion.requests["data_sources.query"]
+            book_id = next(iter(self.weread.books))
+            trashed = self.store.query_page(book_id)["page_id"]
+            self.notion.pages[trashed]["in_trash"] = True
+            self.weread.add_highlights(2)
+            self.sync()
+        finally:
+            CONFIG.set("weread.sync", "PrefetchPages", prefetch)
+        self.assertEqual(self.notion.requests["pages.retrieve"], 0)
+        # latest Sort only, no per-book lookup
+        self.assertEqual(self.notion.requests["data_sources.query"], queries + 1)
+        # the trashed page was found by the failed write and created again
+        self.assertNotEqual(self.store.query_page(book_id)["page_id"], trashed)
+        self.assertEqual(self.store.journal_pending(), {book_id: mock.ANY})
+
+    def test_chapter_batches(self):
+        """chapter lists of all books come in chunks of ChapterBatch"""
+        batch = CONFIG.get("weread.sync", "ChapterBatch", fallback="50")
+        CONFIG.set("weread.sync", "ChapterBatch", "2")
+        try:
+            self.sync()
+        finally:
+            CONFIG.set("weread.sync", "ChapterBatch", batch)
+        self.assert_synced()
+        self.assertEqual(self.weread.requests["/web/book/chapterInfos"], 2)
+
+    def test_new_chapter(self):
+        """a highlight in a chapter missing from the cached list refetches chapters"""
+        self.sync()
+        book = next(iter(self.weread.books.values()))
+        self.weread.add_chapter(book["book"]["bookId"], "New chapter")
+        self.sync()
+        self.assert_synced()
+        page_id = self.store.query_page(book["book"]["bookId"])["page_id"]
+        self.assertEqual(page_texts(self.notion, page_id)["New chapter"], 1)
+
+    def test_new_chapter_review(self):
+        """a review alone in a chapter missing from the cached list refetches too"""
+        self.sync()
+        book_id = next(iter(self.weread.books))
+        self.weread.add_chapter(book_id, "Reviewed chapter", review_only=True)
+        self.sync()
+        self.assert_synced()
+        page_id = self.store.query_page(book_id)["page_id"]
+        self.assertEqual(page_texts(self.notion, page_id)["Reviewed chapter"], 1)
+
+    def test_orphan_mark(self):
+        """a highlight in a chapter no list has refetches chapters only on a cache hit"""
+        book_id = next(iter(self.weread.books))
+        self.weread._read(book_id, 1, chapter_uid=999)
+        self.sync()
+        # chapter lists came fresh from the batch request
+        self.assertEqual(self.weread.requests["/web/book/chapterInfos"], 1)
+        # the mark was not written, no synckey so the next run fetches it again
+        self.assertIsNone(self.store.query_sync_key(book_id))
+        self.assertEqual(self.store.journal_pending(), {})
+
+        self.weread.books[book_id]["sort"] += 1
+        METRICS.reset()
+        self.sync()
+        self.assertEqual(METRICS.get("weread.delta", result="delta"), 0)
+        # cached list: one refetch of the book, the others stay cached
+        self.assertEqual(self.weread.requests["/web/book/chapterInfos"], 2)
+
+    def test_resume(self):
+        """a book that failed after its page got the new Sort is resumed next run"""
+        concurrency = CONFIG.get("weread.sync", "Concurrency", fallback="4")
+        # one book at a time: the first book fails, the later ones move the watermark
+        CONFIG.set("weread.sync", "Concurrency", "1")
+        try:
+            self.notion.fail_next["blocks.children.append"] = 1
+            self.sync()
+            self.assertEqual(len(self.notion.pages), len(self.weread.books))
+            self.assertEqual(len(self.store.journal_pending()), 1)
+
+            fetched = self.weread.requests["/web/book/bookmarklist"]
+            self.sync()
+            self.assertEqual(
+                self.weread.requests["/web/book/bookmarklist"], fetched + 1
+            )
+            self.assert_synced()
+            self.assertEqual(self.store.journal_pending(), {})
+        finally:
+            CONFIG.set("weread.sync", "Concurrency", concurrency)
+
+
+class TestBench(unittest.TestCase):
+    """benchmark harness"""
+
+    def test_run_bench(self):
+        """every round syncs every book"""
+        results = asyncio.run(
+            run_bench(books=2, chapters=4, highlights=5, rounds=2, latency=0)
+        )
+        self.assertEqual([r["books"] for r in results], [2, 2])
+        self.assertTrue(all(r["requests"] > 0 for r in results))
+
+    def test_config_restored(self):
+        """the settings of a run do not leak into the global CONFIG"""
+        before = {
+            key: CONFIG.get(*key, fallback=None)
+            for key in (
+                ("notion.api", "RateLimit"),
+                ("notion.api", "Burst"),
+                ("weread.sync", "Concurrency"),
+            )
+        }
+        asyncio.run(run_bench(books=1, rounds=1, latency=0, rate=5, concurrency=1))
+        for key, value in before.items():
+            self.assertEqual(CONFIG.get(*key, fallback=None), value)
+
+
+if __name__ == "__main__":
+    unittest.main()
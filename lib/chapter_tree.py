@@ -0,0 +1,92 @@
+"""Lightweight chapter tree used to organize bookmarks by chapter"""
+
+
+class ChapterNode(object):
+    """A chapter in the tree. data is the api.weread.Chapter record"""
+
+    __slots__ = ("uid", "data", "children")
+
+    def __init__(self, uid, data):
+        self.uid = uid
+        self.data = data
+        self.children = []
+
+    def is_leaf(self):
+        """no child chapters"""
+        return not self.children
+
+
+class ChapterTree(object):
+    """Chapter tree with an uid index.
+
+    Produces the same depth-first order as treelib's expand_tree (siblings
+    sorted by chapter uid) in linear time for the usual, already sorted,
+    chapter lists.
+    """
+
+    def __init__(self):
+        self.root = ChapterNode(None, None)
+        self._nodes = {}
+
+    @classmethod
+    def from_chapters(cls, chapter_list, max_level):
+        """build the tree from the flat chapter list, levels clamped to [1, max_level].
+        A chapter hangs under the latest chapter seen one level above it.
+        """
+        tree = cls()
+        latest = {}
+        for chapter in chapter_list:
+            level = chapter.level
+            if level <= 0:
+                level = 1
+            elif level > max_level:
+                level = max_level
+
+            parent = latest.get(level - 1, tree.root)
+            latest[level] = tree.add(chapter.uid, chapter, parent)
+        return tree
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, uid):
+        return uid in self._nodes
+
+    def add(self, uid, data, parent=None) -> ChapterNode:
+        """add a chapter under parent (root by default)"""
+        if uid in self._nodes:
+            raise ValueError(f"duplicated chapter uid: {uid}")
+        node = ChapterNode(uid, data)
+        (parent or self.root).children.append(node)
+        self._nodes[uid] = node
+        return node
+
+    def get_node(self, uid) -> ChapterNode | None:
+        """chapter node by uid"""
+        return self._nodes.get(uid)
+
+    def _preorder(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            # reversed, so the smallest uid is popped first
+            stack.extend(sorted(node.children, key=lambda x: x.uid, reverse=True))
+
+    def walk(self):
+        """depth-first traversal, root excluded, siblings in chapter uid order"""
+        nodes = self._preorder()
+        next(nodes)  # root
+        yield from nodes
+
+    def prune(self, keep):
+        """remove every subtree that has no node satisfying keep(node)"""
+        # descendants come after their ancestors in preorder
+        for node in reversed(list(self._preorder())):
+            alive = []
+            for child in node.children:
+                if child.children or keep(child):
+                    alive.append(child)
+                else:
+                    del self._nodes[child.uid]
+            node.children = alive
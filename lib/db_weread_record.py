@@ -2,27 +2,83 @@
 封装存储相关操作
 """
 
+import logging
 import sqlite3
 import datetime
+from contextlib import contextmanager
 
+from lib.metrics import METRICS
 
-class DBWeReadRecord(object):
-    """存储微信读书同步记录"""
 
-    TabName = "weread_sync_record"
-    SqlCreate = f"""create table if not exists {TabName}
-    (book_id VARCHAR(255), bookmark_id varchar(255), block_id VARCHAR(255),
-    op_time TIMESTAMP, resv VARCHAR(255),
-    PRIMARY KEY (book_id, bookmark_id, block_id))"""
+class BookRecord(object):
+    """某本书的全部同步记录，bookmark_id <-> block_id 双向索引"""
 
-    def __init__(self, db_name):
+    def __init__(self, book_id, rows=()):
+        """
+        :param book_id: 书籍ID
+        :param rows: [(bookmark_id, block_id[, resv]), ...]
+        """
+        self.book_id = book_id
+        self.blocks = {}  # bookmark_id -> block_id
+        self.bookmarks = {}  # block_id -> bookmark_id
+        self.resvs = {}  # bookmark_id -> resv，如表格行内容摘要
+        for row in rows:
+            self.add(*row)
+
+    def add(self, bookmark_id, block_id, resv=None):
+        """
+        添加记录，与db一致，bookmark_id统一按字符串存储（章节ID为int）
+        同一个bookmark/block存在多条记录时，保留最早写入的一条
+        """
+        bookmark_id = str(bookmark_id)
+        if bookmark_id not in self.blocks:
+            self.resvs[bookmark_id] = resv
+        self.blocks.setdefault(bookmark_id, block_id)
+        self.bookmarks.setdefault(block_id, bookmark_id)
+
+    def remove(self, bookmark_id):
+        """删除bookmark_id的记录"""
+        self.resvs.pop(str(bookmark_id), None)
+        block_id = self.blocks.pop(str(bookmark_id), None)
+        if block_id is not None:
+            self.bookmarks.pop(block_id, None)
+
+    def block_of(self, bookmark_id):
+        """bookmark_id对应的block_id，不存在时返回None"""
+        return self.blocks.get(str(bookmark_id))
+
+    def bookmark_of(self, block_id):
+        """block_id对应的bookmark_id，不存在时返回None"""
+        return self.bookmarks.get(block_id)
+
+    def resv_of(self, bookmark_id):
+        """bookmark_id记录的resv，不存在时返回None"""
+        return self.resvs.get(str(bookmark_id))
+
+
+class SqliteStore(object):
+    """sqlite本地库：连接参数、事务作用域及按版本执行的表结构变更"""
+
+    # 表结构变更，按顺序执行，已执行到的版本号记录在 PRAGMA user_version
+    # 只能追加，不得修改已发布的版本
+    Migrations = []
+
+    JournalModes = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+    SynchronousModes = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+    def __init__(self, db_name, journal_mode=None, synchronous=None):
         """
         :param db_name: 数据库名称
+        :param journal_mode: 可选，如WAL，默认沿用sqlite设置
+        :param synchronous: 可选，如NORMAL，默认沿用sqlite设置
         """
         self.connection = sqlite3.connect(
             db_name, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
         )
         self.connection.row_factory = sqlite3.Row  # use dictionary to return row
+        self.connection.set_trace_callback(METRICS.count_sql)
+        self._tx_depth = 0
+        self.set_pragmas(journal_mode, synchronous)
         self.create_table()
 
     def __del__(self):
@@ -30,16 +86,165 @@ class DBWeReadRecord(object):
         析构函数
         :return:
         """
+        self.close()
+
+    def close(self):
+        """
+        关闭连接。WAL模式下先把-wal文件中的内容写回库文件并清空，
+        只提交库文件(如Github Action)时不会丢失最近的写入
+        :return:
+        """
+        if self.connection is None:
+            return
         print("closing db connection")
+        mode = self.connection.execute("PRAGMA journal_mode").fetchone()[0]
+        if mode.lower() == "wal":
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
         self.connection.close()
+        self.connection = None
+
+    def set_pragmas(self, journal_mode=None, synchronous=None):
+        """
+        设置日志模式及同步级别，WAL + NORMAL可大幅减少提交时的fsync
+        :return:
+        """
+        if journal_mode:
+            journal_mode = journal_mode.upper()
+            if journal_mode not in self.JournalModes:
+                raise ValueError(f"invalid journal_mode: {journal_mode}")
+            self.connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        if synchronous:
+            synchronous = synchronous.upper()
+            if synchronous not in self.SynchronousModes:
+                raise ValueError(f"invalid synchronous: {synchronous}")
+            self.connection.execute(f"PRAGMA synchronous={synchronous}")
+
+    def _commit(self):
+        """事务作用域外立即提交，作用域内延迟到最外层退出时提交"""
+        if self._tx_depth == 0:
+            self.connection.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        事务作用域，可嵌套。作用域内的写操作在最外层退出时一次提交。
+        记录对应的notion block已经写入，所以异常退出时同样提交已写入的记录。
+        作用域内不要await其他协程，避免与其他书籍的写入交织。
+        """
+        self._tx_depth += 1
+        try:
+            yield self
+        finally:
+            self._tx_depth -= 1
+            self._commit()
 
     def create_table(self):
         """
-        创建表
+        创建表，已有的库升级到最新版本
+        :return:
+        """
+        self.migrate()
+
+    def schema_version(self):
+        """
+        当前库的表结构版本
         :return:
         """
+        return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        """
+        执行未执行过的表结构变更，每个版本一个事务
+        :return: 升级后的版本
+        """
+        version = self.schema_version()
+        if version > len(self.Migrations):
+            logging.warning(
+                "db schema version %d is newer than %d", version, len(self.Migrations)
+            )
+            return version
+
+        self.connection.commit()
         cursor = self.connection.cursor()
-        cursor.execute(self.SqlCreate)
+        for idx in range(version, len(self.Migrations)):
+            cursor.execute("begin")
+            try:
+                for sql in self.Migrations[idx]:
+                    cursor.execute(sql)
+                cursor.execute(f"PRAGMA user_version={idx + 1}")
+            except sqlite3.Error:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+            logging.info("db schema migrated to version %d", idx + 1)
+        return len(self.Migrations)
+
+
+class DBWeReadRecord(SqliteStore):
+    """存储微信读书同步记录"""
+
+    TabName = "weread_sync_record"
+    SqlCreate = f"""create table if not exists {TabName}
+    (book_id VARCHAR(255), bookmark_id varchar(255), block_id VARCHAR(255),
+    op_time TIMESTAMP, resv VARCHAR(255),
+    PRIMARY KEY (book_id, bookmark_id, block_id))"""
+
+    # BookId -> notion page
+    PageTabName = "weread_page"
+    # 页面顶层block结构
+    LayoutTabName = "weread_layout"
+    # 未写完的书籍及已完成的写入阶段，中断后下次运行续写
+    JournalTabName = "weread_journal"
+    # 旧版本建在同步记录库中的接口响应缓存，已移至DBWeReadCache的独立库
+    CacheTabName = "weread_cache"
+    # 划线、笔记接口的synckey，下次只拉取增量
+    SyncKeyTabName = "weread_synckey"
+
+    # 只能追加，不得修改已发布的版本
+    Migrations = [
+        # 1: 初始表结构
+        [SqlCreate],
+        # 2: query_by_block / load_book 按 block 反查
+        [
+            f"create index if not exists idx_{TabName}_block \
+            on {TabName}(book_id, block_id)"
+        ],
+        # 3: BookId -> page_id 缓存，避免每本书查询一次database
+        [
+            f"""create table if not exists {PageTabName}
+            (book_id VARCHAR(255) PRIMARY KEY, page_id VARCHAR(255),
+            last_edited_time VARCHAR(64), op_time TIMESTAMP)"""
+        ],
+        # 4: 上次写入的page属性摘要(JSON, key -> hash)，属性未变时跳过更新
+        [f"alter table {PageTabName} add column fingerprint TEXT"],
+        # 5: 页面顶层block结构(JSON)，信任本地记录时不再列出page的全部block
+        [
+            f"""create table if not exists {LayoutTabName}
+            (book_id VARCHAR(255) PRIMARY KEY, page_id VARCHAR(255), blocks TEXT,
+            edited_time VARCHAR(64), verified_at TIMESTAMP)"""
+        ],
+        # 6: 写入日志，运行中断时记录未完成的书籍
+        [
+            f"""create table if not exists {JournalTabName}
+            (book_id VARCHAR(255) PRIMARY KEY, sort INTEGER, stage VARCHAR(32),
+            op_time TIMESTAMP)"""
+        ],
+        # 7: 微信读书接口响应缓存，按书籍更新时间失效
+        [
+            f"""create table if not exists {CacheTabName}
+            (endpoint VARCHAR(64), book_id VARCHAR(255), stamp INTEGER, value TEXT,
+            size INTEGER, op_time TIMESTAMP, PRIMARY KEY (endpoint, book_id))""",
+            f"create index if not exists idx_{CacheTabName}_time on {CacheTabName}(op_time)",
+        ],
+        # 8: 划线、笔记的synckey及当前条数
+        [
+            f"""create table if not exists {SyncKeyTabName}
+            (book_id VARCHAR(255) PRIMARY KEY, bookmark_key INTEGER, review_key INTEGER,
+            marks INTEGER, op_time TIMESTAMP)"""
+        ],
+        # 9: 响应缓存移至独立的缓存库(DBWeReadCache)，同步记录库不再保存
+        [f"drop table if exists {CacheTabName}"],
+    ]
 
     def insert(self, book_id, bookmark_id, block_id):
         """
@@ -56,9 +261,28 @@ class DBWeReadRecord(object):
               values (?, ?, ?, ?)"
         cursor = self.connection.cursor()
         cursor.execute(sql, (book_id, bookmark_id, block_id, now))
-        self.connection.commit()
+        self._commit()
         return cursor.lastrowid
 
+    def insert_many(self, book_id, rows):
+        """
+        批量插入数据，一次提交
+        :param book_id: 书籍ID
+        :param rows: [(bookmark_id, block_id[, resv]), ...]
+        :return: 插入的行数
+        """
+        now = datetime.datetime.now()
+
+        sql = f"insert or ignore into {self.TabName}(book_id, bookmark_id, block_id, op_time, resv)\
+              values (?, ?, ?, ?, ?)"
+        cursor = self.connection.cursor()
+        cursor.executemany(
+            sql,
+            [(book_id, row[0], row[1], now, row[2] if len(row) > 2 else None) for row in rows],
+        )
+        self._commit()
+        return cursor.rowcount
+
     def query(self, book_id, bookmark_id):
         """
         查询是否已经写如果
@@ -70,6 +294,36 @@ class DBWeReadRecord(object):
         cursor.execute(sql, (book_id, bookmark_id))
         return cursor.fetchall()
 
+    def load_book(self, book_id) -> BookRecord:
+        """
+        一次读取整本书的记录，构建bookmark/block双向索引
+        :param book_id: 书籍ID
+        :return: BookRecord
+        """
+        sql = f"select bookmark_id, block_id, resv from {self.TabName} \
+            where book_id=? order by rowid"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        return BookRecord(book_id, cursor.fetchall())
+
+    def update_resv(self, book_id, rows):
+        """
+        批量更新记录的resv，一次提交
+        :param book_id: 书籍ID
+        :param rows: [(bookmark_id, block_id, resv), ...]
+        :return:
+        """
+        now = datetime.datetime.now()
+
+        sql = f"update {self.TabName} set resv=?, op_time=? \
+            where book_id=? and bookmark_id=? and block_id=?"
+        cursor = self.connection.cursor()
+        cursor.executemany(
+            sql,
+            [(resv, now, book_id, bookmark_id, block_id) for bookmark_id, block_id, resv in rows],
+        )
+        self._commit()
+
     def query_by_block(self, book_id, block_id):
         """
         查询是否已经写如果
@@ -81,6 +335,62 @@ class DBWeReadRecord(object):
         cursor.execute(sql, (book_id, block_id))
         return cursor.fetchall()
 
+    def query_page(self, book_id):
+        """
+        查询书籍对应的notion page
+        :return: (book_id, page_id, last_edited_time, op_time, fingerprint)，不存在时返回None
+        """
+        sql = f"select book_id, page_id, last_edited_time, op_time, fingerprint \
+            from {self.PageTabName} where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        return cursor.fetchone()
+
+    def query_pages(self):
+        """
+        全部书籍对应的notion page
+        :return: {book_id: (book_id, page_id, last_edited_time, op_time, fingerprint)}
+        """
+        sql = f"select book_id, page_id, last_edited_time, op_time, fingerprint \
+            from {self.PageTabName}"
+        cursor = self.connection.cursor()
+        cursor.execute(sql)
+        return {row["book_id"]: row for row in cursor.fetchall()}
+
+    def upsert_page(self, book_id, page_id, last_edited_time=None, fingerprint=None):
+        """
+        记录书籍对应的notion page
+        :param book_id: 书籍ID
+        :param page_id: notion page id
+        :param last_edited_time: page最后编辑时间
+        :param fingerprint: page属性摘要，为None时同一page保留原值，page变化时清空
+        :return:
+        """
+        now = datetime.datetime.now()
+
+        sql = f"insert into {self.PageTabName}\
+            (book_id, page_id, last_edited_time, op_time, fingerprint) values (?, ?, ?, ?, ?) \
+            on conflict(book_id) do update set \
+            fingerprint=case when page_id=excluded.page_id \
+                then coalesce(excluded.fingerprint, fingerprint) \
+                else excluded.fingerprint end, \
+            page_id=excluded.page_id, last_edited_time=excluded.last_edited_time, \
+            op_time=excluded.op_time"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id, page_id, last_edited_time, now, fingerprint))
+        self._commit()
+
+    def delete_page(self, book_id):
+        """
+        删除书籍对应的notion page记录
+        :param book_id: 书籍ID
+        :return:
+        """
+        sql = f"delete from {self.PageTabName} where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        self._commit()
+
     def delete_book(self, book_id):
         """
         删除书籍记录
@@ -90,7 +400,7 @@ class DBWeReadRecord(object):
         sql = f"delete from {self.TabName} where book_id=?"
         cursor = self.connection.cursor()
         cursor.execute(sql, (book_id,))
-        self.connection.commit()
+        self._commit()
 
     def delete_bookmark(self, book_id, bookmark_id):
         """
@@ -102,4 +412,202 @@ class DBWeReadRecord(object):
         sql = f"delete from {self.TabName} where book_id=? and bookmark_id=?"
         cursor = self.connection.cursor()
         cursor.execute(sql, (book_id, bookmark_id))
-        self.connection.commit()
\ No newline at end of file
+        self._commit()
+
+    def query_layout(self, book_id):
+        """
+        查询书籍page的顶层block结构
+        :return: (book_id, page_id, blocks, edited_time, verified_at)，不存在时返回None
+        """
+        sql = f"select book_id, page_id, blocks, edited_time, verified_at \
+            from {self.LayoutTabName} where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        return cursor.fetchone()
+
+    def save_layout(self, book_id, page_id, blocks, edited_time, verified_at=None):
+        """
+        记录书籍page的顶层block结构
+        :param blocks: JSON格式的block列表
+        :param edited_time: 本次同步完成后page的last_edited_time
+        :param verified_at: 列出page全部block核对的时间，为None时保留原值
+        :return:
+        """
+        sql = f"insert into {self.LayoutTabName}\
+            (book_id, page_id, blocks, edited_time, verified_at) values (?, ?, ?, ?, ?) \
+            on conflict(book_id) do update set \
+            page_id=excluded.page_id, blocks=excluded.blocks, \
+            edited_time=excluded.edited_time, \
+            verified_at=coalesce(excluded.verified_at, verified_at)"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id, page_id, blocks, edited_time, verified_at))
+        self._commit()
+
+    def delete_layout(self, book_id):
+        """
+        删除书籍page的顶层block结构，下次同步时重新列出
+        :param book_id: 书籍ID
+        :return:
+        """
+        sql = f"delete from {self.LayoutTabName} where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        self._commit()
+
+    def journal_begin(self, books):
+        """
+        登记本次运行要写入的书籍，已登记的保留完成阶段
+        :param books: [(book_id, sort), ...]
+        :return:
+        """
+        now = datetime.datetime.now()
+        sql = f"insert into {self.JournalTabName} (book_id, sort, stage, op_time) \
+            values (?, ?, 'pending', ?) \
+            on conflict(book_id) do update set sort=excluded.sort, op_time=excluded.op_time"
+        cursor = self.connection.cursor()
+        cursor.executemany(sql, [(book_id, sort, now) for book_id, sort in books])
+        self._commit()
+
+    def journal_stage(self, book_id, stage):
+        """
+        记录书籍已完成的写入阶段
+        :param book_id: 书籍ID
+        :param stage: 阶段名，如page、blocks
+        :return:
+        """
+        sql = f"update {self.JournalTabName} set stage=?, op_time=? where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (stage, datetime.datetime.now(), book_id))
+        self._commit()
+
+    def journal_done(self, book_id):
+        """
+        书籍全部写入完成，删除日志
+        :param book_id: 书籍ID
+        :return:
+        """
+        sql = f"delete from {self.JournalTabName} where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        self._commit()
+
+    def journal_pending(self):
+        """
+        上次运行中断时未写完的书籍
+        :return: {book_id: (book_id, sort, stage, op_time)}
+        """
+        sql = f"select book_id, sort, stage, op_time from {self.JournalTabName}"
+        cursor = self.connection.cursor()
+        cursor.execute(sql)
+        return {row["book_id"]: row for row in cursor.fetchall()}
+
+    def query_sync_key(self, book_id):
+        """
+        查询书籍上次写入完成时的synckey
+        :return: (book_id, bookmark_key, review_key, marks, op_time)，不存在时返回None
+        """
+        sql = f"select book_id, bookmark_key, review_key, marks, op_time \
+            from {self.SyncKeyTabName} where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        return cursor.fetchone()
+
+    def save_sync_key(self, book_id, bookmark_key, review_key, marks):
+        """
+        记录划线、笔记的synckey
+        :param marks: 划线及笔记的当前总条数
+        :return:
+        """
+        sql = f"insert or replace into {self.SyncKeyTabName} \
+            (book_id, bookmark_key, review_key, marks, op_time) values (?, ?, ?, ?, ?)"
+        cursor = self.connection.cursor()
+        cursor.execute(
+            sql, (book_id, bookmark_key, review_key, marks, datetime.datetime.now())
+        )
+        self._commit()
+
+    def delete_sync_key(self, book_id):
+        """
+        删除书籍的synckey，下次全量拉取
+        :param book_id: 书籍ID
+        :return:
+        """
+        sql = f"delete from {self.SyncKeyTabName} where book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (book_id,))
+        self._commit()
+
+
+class DBWeReadCache(SqliteStore):
+    """微信读书接口响应缓存(章节列表、书籍详情)，与同步记录分库存放，可随时删除"""
+
+    CacheTabName = "weread_cache"
+
+    Migrations = [
+        # 1: 接口响应，按书籍更新时间失效
+        [
+            f"""create table if not exists {CacheTabName}
+            (endpoint VARCHAR(64), book_id VARCHAR(255), stamp INTEGER, value TEXT,
+            size INTEGER, op_time TIMESTAMP, PRIMARY KEY (endpoint, book_id))""",
+            f"create index if not exists idx_{CacheTabName}_time on {CacheTabName}(op_time)",
+        ],
+    ]
+
+    def query_cache(self, endpoint, book_id, stamp, expire_before=None):
+        """
+        查询缓存的接口响应
+        :param endpoint: 接口名
+        :param stamp: 书籍更新时间，与缓存时不同则视为失效
+        :param expire_before: 早于该时间写入的缓存视为失效
+        :return: 缓存的响应，不存在或已失效时返回None
+        """
+        sql = f"select value, stamp, op_time from {self.CacheTabName} \
+            where endpoint=? and book_id=?"
+        cursor = self.connection.cursor()
+        cursor.execute(sql, (endpoint, book_id))
+        row = cursor.fetchone()
+        if row is None or row["stamp"] != stamp:
+            return None
+        if expire_before is not None and row["op_time"] < expire_before:
+            return None
+        return row["value"]
+
+    def save_cache(self, endpoint, book_id, stamp, value):
+        """
+        缓存接口响应，每本书每个接口只保留最新一份
+        :param value: 响应内容(JSON)
+        :return:
+        """
+        sql = f"insert or replace into {self.CacheTabName} \
+            (endpoint, book_id, stamp, value, size, op_time) values (?, ?, ?, ?, ?, ?)"
+        cursor = self.connection.cursor()
+        cursor.execute(
+            sql,
+            (endpoint, book_id, stamp, value, len(value), datetime.datetime.now()),
+        )
+        self._commit()
+
+    def prune_cache(self, expire_before=None, max_bytes=None):
+        """
+        删除过期的缓存，总大小超过max_bytes时从最早写入的开始淘汰
+        :return: 删除的条数
+        """
+        cursor = self.connection.cursor()
+        deleted = 0
+        if expire_before is not None:
+            sql = f"delete from {self.CacheTabName} where op_time < ?"
+            deleted += cursor.execute(sql, (expire_before,)).rowcount
+        if max_bytes is not None:
+            sql = f"select endpoint, book_id, size from {self.CacheTabName} \
+                order by op_time desc"
+            total = 0
+            evicting = []
+            for row in cursor.execute(sql).fetchall():
+                total += row["size"]
+                if total > max_bytes:
+                    evicting.append((row["endpoint"], row["book_id"]))
+            sql = f"delete from {self.CacheTabName} where endpoint=? and book_id=?"
+            cursor.executemany(sql, evicting)
+            deleted += len(evicting)
+        self._commit()
+        return deleted
@@ -0,0 +1,28 @@
+"""JSON codec, backed by orjson when it is installed"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data):
+    """decode str / bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, default=None) -> str:
+    """compact encoding, non-ascii kept as is
+    default: called for objects the backend can't encode, e.g. records with to_dict
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            obj, default=default, option=orjson.OPT_NON_STR_KEYS
+        ).decode()
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":"))
@@ -0,0 +1,201 @@
+"""Per-phase timers and counters of one sync run, reported when the run ends"""
+
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# notion object ids in a request path, with or without dashes
+_ID_PATTERN = re.compile(
+    r"^[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}$"
+)
+
+
+def endpoint_of(method: str, path: str) -> str:
+    """METHOD /path with object ids replaced by {id}, used as counter label"""
+    parts = ["{id}" if _ID_PATTERN.match(part) else part for part in path.split("/")]
+    return f"{method.upper()} {'/'.join(parts)}"
+
+
+class PhaseTimer(object):
+    """calls, total and max seconds of one phase"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+class Metrics(object):
+    """Timers and counters of the current run.
+
+    Phases that run concurrently (e.g. one per book) add up, so their total
+    can exceed the wall time of the run; `count` and `max` tell them apart.
+    Counters take optional labels, e.g. incr("notion.calls", endpoint="GET /v1/pages/{id}").
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self.command = ""
+        self.phases = defaultdict(PhaseTimer)
+        self.counters = defaultdict(int)  # (name, ((label, value), ...)) -> value
+
+    def reset(self, command: str = ""):
+        """drop everything recorded so far"""
+        self.command = command
+        self.phases.clear()
+        self.counters.clear()
+
+    @contextmanager
+    def timer(self, phase: str):
+        """time the enclosed block as one call of `phase`"""
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.phases[phase].add(self._clock() - start)
+
+    def incr(self, name: str, value: int = 1, **labels):
+        """add value to a counter"""
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def get(self, name: str, **labels) -> int:
+        """counter value, labels must match exactly"""
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def total(self, name: str) -> int:
+        """counter value summed over all labels"""
+        return sum(v for (n, _labels), v in self.counters.items() if n == name)
+
+    def httpx_hooks(self, prefix: str) -> dict:
+        """httpx event hooks counting calls by endpoint and bytes in/out as prefix.*"""
+
+        async def on_request(request):
+            self.incr(
+                f"{prefix}.calls",
+                endpoint=endpoint_of(request.method, request.url.path),
+            )
+            self.incr(f"{prefix}.bytes_out", len(request.content or b""))
+
+        async def on_response(response):
+            await response.aread()
+            self.incr(f"{prefix}.bytes_in", len(response.content))
+            if response.status_code >= 400:
+                self.incr(f"{prefix}.errors", status=str(response.status_code))
+
+        return {"request": [on_request], "response": [on_response]}
+
+    def count_sql(self, statement: str):
+        """sqlite trace callback, counts executed statements by verb"""
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        self.incr("sqlite.ops", op=verb)
+
+    # output
+
+    def to_dict(self) -> dict:
+        return {
+            "command": self.command,
+            "phases": {
+                name: {
+                    "count": t.count,
+                    "total": round(t.total, 6),
+                    "max": round(t.max, 6),
+                }
+                for name, t in sorted(self.phases.items())
+            },
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+        }
+
+    def summary(self) -> str:
+        """phases and counters as a text table"""
+        lines = [
+            f"{'phase':<24} {'count':>7} {'total(s)':>10} {'avg(s)':>9} {'max(s)':>9}"
+        ]
+        for name, t in sorted(self.phases.items()):
+            avg = t.total / t.count if t.count else 0.0
+            lines.append(
+                f"{name:<24} {t.count:>7} {t.total:>10.3f} {avg:>9.3f} {t.max:>9.3f}"
+            )
+        lines.append(f"{'counter':<56} {'value':>12}")
+        for (name, labels), value in sorted(self.counters.items()):
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            key = f"{name}{{{label}}}" if label else name
+            lines.append(f"{key:<56} {value:>12}")
+        return "\n".join(lines)
+
+    def to_prometheus(self, prefix: str = "sync_notion") -> str:
+        """node_exporter textfile format"""
+
+        def metric(name):
+            return f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+        def labels_of(labels):
+            labels = (("command", self.command),) + tuple(labels)
+            escaped = (
+                (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels
+            )
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        lines = []
+        for kind, attr in (("seconds", "total"), ("calls", "count")):
+            name = metric(f"phase_{kind}")
+            lines.append(f"# TYPE {name} gauge")
+            for phase, t in sorted(self.phases.items()):
+                lines.append(
+                    f"{name}{labels_of((('phase', phase),))} {getattr(t, attr)}"
+                )
+
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            name = metric(name) + "_total"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{labels_of(labels)} {value}")
+
+        name = metric("last_run_timestamp_seconds")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{labels_of(())} {time.time():.0f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """write to path, Prometheus textfile for *.prom, JSON otherwise"""
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+# 当前运行的统计，各模块直接记录
+METRICS = Metrics()
+
+
+@contextmanager
+def report_run(command: str, output: str | None = None):
+    """
+    统计一次命令运行：开始时清零，结束时(包括异常退出)输出汇总表
+    output: 另存为JSON，或以.prom结尾时存为Prometheus textfile
+    """
+    METRICS.reset(command)
+    try:
+        with METRICS.timer("total"):
+            yield METRICS
+    finally:
+        logging.info("%s metrics:\n%s", command, METRICS.summary())
+        if output:
+            try:
+                METRICS.write(output)
+            except OSError as _e:
+                logging.error("write metrics to %s failed: %s", output, _e)
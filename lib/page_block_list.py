@@ -1,5 +1,8 @@
 """Orgnize the page blocks in a Notion page"""
 
+import bisect
+
+
 def safe_cast(val, to_type, default=None):
     """
     尝试将输入值 `val` 转换为指定类型 `to_type`，如果转换失败则返回默认值 `default`。
@@ -12,49 +15,61 @@ def safe_cast(val, to_type, default=None):
 class PageBlockList(object):
     """Implements the PageBlockList class."""
 
-    def __init__(self, store, book_id, blocks):
+    def __init__(self, store, book_id, blocks, records=None):
         """Constructor for the PageBlockList class.
         list item format:
         {
             'type': 'paragraph / heading / list / image ....',
             'id': '$block_id',
         }
+        records: BookRecord of the book, loaded from store if not given
         """
         self.book_id = book_id
+        if records is None:
+            records = store.load_book(book_id)
         self.blocks = []
         for block in blocks:
-            bookmark_id = None
-            _result = store.query_by_block(book_id, block['id'])
-            if _result:
-                bookmark_id = _result[0]['bookmark_id']
+            bookmark_id = records.bookmark_of(block['id'])
             self.blocks.append({
                 'type': block['type'],
                 'id': block['id'],
                 'bookmark_id': bookmark_id,
             })
+        self._build_index()
+
+    def _build_index(self):
+        """Index the synced headings once.
+        _chapters: sorted chapter uids of synced headings
+        _chapter_ends: for each uid above, id of the last block before the next heading
+        """
+        size = len(self.blocks)
+        is_heading = [block['type'].startswith('heading_') for block in self.blocks]
+
+        # the last block of the run starting at idx, stopping before any heading
+        ends = [None] * size
+        for idx in range(size - 1, -1, -1):
+            if idx == size - 1 or is_heading[idx + 1]:
+                ends[idx] = self.blocks[idx]['id']
+            else:
+                ends[idx] = ends[idx + 1]
+
+        first = {}  # chapter uid -> first heading index, same as the linear scan
+        for idx, block in enumerate(self.blocks):
+            if block['bookmark_id'] is not None and is_heading[idx]:
+                first.setdefault(safe_cast(block['bookmark_id'], int, 0), idx)
+
+        self._chapters = sorted(first)
+        self._chapter_ends = [ends[first[uid]] for uid in self._chapters]
 
     def found_chapter_position(self, chapter_uid: int) -> str | None:
         """Find the position of a chapter in the list.
-        return true if found, false if not found
+        Returns the last block of the biggest synced chapter in [0, chapter_uid),
+        or the first block of the page if there is no such chapter.
         """
-        chapter, block_id, block_idx = -1, None, -1
-        for idx, block in enumerate(self.blocks):
-            if block['bookmark_id'] is not None and block['type'].startswith('heading_'):
-                _cuid = safe_cast(block['bookmark_id'], int, 0)
-                if _cuid < chapter_uid and _cuid > chapter: # find the biggest one in [0, chapter_uid]
-                    chapter = _cuid
-                    block_id = block['id']
-                    block_idx = idx
+        pos = bisect.bisect_left(self._chapters, chapter_uid) - 1
 
         # push to the first block if not found
-        if not block_id:
+        if pos < 0 or self._chapters[pos] < 0:
             return self.blocks[0]['id'] if len(self.blocks) > 0 else None
-        
-        # iterate to the end of chapter
-        while block_idx < len(self.blocks) - 1:
-            block = self.blocks[block_idx + 1]
-            if block['type'].startswith('heading_'):
-                return block_id
-            block_idx += 1
-            block_id = block['id']
-        return block_id
\ No newline at end of file
+
+        return self._chapter_ends[pos]
@@ -0,0 +1,38 @@
+"""Local copy of the top-level block layout of a Notion page"""
+
+
+class PageLayout(object):
+    """Top-level blocks of a page, kept in sync with the appends done by the
+    sync so the page doesn't have to be listed again. The sync never deletes
+    top-level blocks; pages edited elsewhere are listed again, see stored_layout.
+
+    Blocks use the list_page_blocks format: {'id': ..., 'type': ...}.
+    Once an operation can't be mapped (e.g. appending after an unknown
+    block), the layout is marked invalid and must not be trusted anymore.
+    """
+
+    def __init__(self, blocks=()):
+        self.blocks = [{"id": block["id"], "type": block["type"]} for block in blocks]
+        self.valid = True
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def insert_after(self, after, blocks):
+        """record blocks appended after the block `after`, or at the end if None"""
+        pos = len(self.blocks)
+        if after:
+            pos = self._position(after)
+            if pos is None:
+                self.valid = False
+                return
+            pos += 1
+        self.blocks[pos:pos] = [
+            {"id": block["id"], "type": block["type"]} for block in blocks
+        ]
+
+    def _position(self, block_id):
+        for pos, block in enumerate(self.blocks):
+            if block["id"] == block_id:
+                return pos
+        return None
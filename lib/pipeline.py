@@ -0,0 +1,80 @@
+"""Staged producer/consumer pipeline built on asyncio queues"""
+
+import asyncio
+import logging
+
+from lib.metrics import METRICS
+
+
+class Stage(object):
+    """A named pipeline stage.
+
+    handler: async callable taking one job. Jobs are handed to the next stage
+    once the handler returns, a raising handler drops the job.
+    workers: number of jobs the stage handles concurrently.
+    """
+
+    def __init__(self, name, handler, workers=1):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+
+
+class Pipeline(object):
+    """Run jobs through a list of stages, each stage fed by its own queue.
+
+    At most `in_flight` jobs are inside the pipeline at any time, so a slow
+    last stage holds back the first one instead of buffering the whole input.
+    A single job always goes through the stages in order, while different jobs
+    overlap (e.g. fetching job N+1 while writing job N).
+    """
+
+    def __init__(self, stages: list[Stage], in_flight: int = 1):
+        self.stages = stages
+        self.in_flight = max(1, in_flight)
+        self.failed = []
+
+    async def _work(self, idx, inbox, outbox, slots):
+        stage = self.stages[idx]
+        while True:
+            job = await inbox.get()
+            try:
+                with METRICS.timer(stage.name):
+                    await stage.handler(job)
+            # pylint: disable-next=broad-except
+            except Exception as _e:
+                logging.exception("stage [%s] failed: %s", stage.name, _e)
+                self.failed.append((stage.name, job, _e))
+                slots.release()
+            else:
+                if outbox is not None:
+                    await outbox.put(job)
+                else:
+                    slots.release()
+            finally:
+                inbox.task_done()
+
+    async def run(self, jobs):
+        """feed jobs into the pipeline and wait until every job has left it"""
+        slots = asyncio.Semaphore(self.in_flight)
+        queues = [asyncio.Queue() for _ in self.stages]
+        workers = []
+        for idx, stage in enumerate(self.stages):
+            outbox = queues[idx + 1] if idx + 1 < len(queues) else None
+            for _ in range(stage.workers):
+                workers.append(
+                    asyncio.create_task(self._work(idx, queues[idx], outbox, slots))
+                )
+
+        try:
+            for job in jobs:
+                await slots.acquire()
+                await queues[0].put(job)
+            # a job reaches queue i+1 before it's marked done in queue i
+            for queue in queues:
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return self.failed
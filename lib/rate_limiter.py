@@ -0,0 +1,50 @@
+"""Async token bucket shared by all callers of one remote API"""
+
+import asyncio
+import time
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter.
+
+    rate: tokens refilled per second
+    burst: bucket capacity, i.e. how many calls may go out back to back
+    Waiters are served in FIFO order. `pause` blocks every caller until the
+    given delay has passed, used when the server answers with Retry-After.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """stop handing out tokens for `seconds`, and drop the ones left"""
+        now = self._clock()
+        self._refill(now)
+        self._tokens = 0.0
+        self._blocked_until = max(self._blocked_until, now + seconds)
+
+    async def acquire(self, tokens: int = 1):
+        """wait until `tokens` are available and take them"""
+        async with self._lock:
+            while True:
+                now = self._clock()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return
+                    wait = (tokens - self._tokens) / self.rate
+                await asyncio.sleep(wait)
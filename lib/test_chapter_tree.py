@@ -0,0 +1,116 @@
+"""unit test for ChapterTree"""
+
+import json
+import os
+import random
+import unittest
+from collections import defaultdict
+
+from api.weread import Chapter
+from lib.chapter_tree import ChapterTree
+
+MAX_LEVEL = 3
+# gen/mount/remove/expand orders of random books, frozen from the previous
+# treelib implementation: {"chapters": [[uid, level]], "marks": [uid], "dfs": [uid]}
+GOLDEN = os.path.join(os.path.dirname(__file__), "test_chapter_tree.json")
+
+
+def to_records(chapter_list):
+    """chapter dicts as weread returns them -> Chapter records"""
+    return [Chapter.from_dict(chapter) for chapter in chapter_list]
+
+
+def chapter_tree_dfs(chapter_list, bookmark_list):
+    """gen/mount/remove/walk as done in sync_read"""
+    tree = ChapterTree.from_chapters(to_records(chapter_list), MAX_LEVEL)
+    d = defaultdict(list)
+    for data in bookmark_list:
+        d[data.get("chapterUid", 1)].append(data)
+    for key, value in d.items():
+        node = tree.get_node(key)
+        if node:
+            node.data.marks = value
+    tree.prune(lambda node: node.data.marks is not None)
+    return [node.uid for node in tree.walk()]
+
+
+def random_book(rnd, num_chapters):
+    """chapters with random levels (including out of range ones) and bookmarks"""
+    uids = list(range(1, num_chapters + 1))
+    if rnd.random() < 0.3:  # uids not in reading order
+        rnd.shuffle(uids)
+    chapters = [{"chapterUid": uid, "level": rnd.randint(0, 5)} for uid in uids]
+    bookmarks = [
+        {"chapterUid": rnd.randint(1, num_chapters + 2), "bookmarkId": f"bm_{i}"}
+        for i in range(rnd.randint(0, num_chapters))
+    ]
+    return chapters, bookmarks
+
+
+class TestChapterTree(unittest.TestCase):
+    """test ChapterTree"""
+
+    def test_dfs_order(self):
+        """stale parents, pruning and missing chapters"""
+        chapters = [
+            {"chapterUid": 1, "level": 1},
+            {"chapterUid": 2, "level": 2},
+            {"chapterUid": 3, "level": 2},
+            {"chapterUid": 4, "level": 3},
+            {"chapterUid": 5, "level": 1},
+            {"chapterUid": 6, "level": 3},  # hangs under 3, the latest level 2
+            {"chapterUid": 7, "level": 0},
+            {"chapterUid": 8, "level": 9},  # clamped to 3, hangs under 3 too
+        ]
+        bookmarks = [{"chapterUid": uid} for uid in (2, 6, 8, 99)]
+        self.assertEqual(chapter_tree_dfs(chapters, bookmarks), [1, 2, 3, 6, 8])
+
+    def test_siblings_sorted_by_uid(self):
+        """siblings come out in uid order, like treelib"""
+        chapters = [{"chapterUid": uid, "level": 1} for uid in (30, 10, 20)]
+        bookmarks = [{"chapterUid": uid} for uid in (10, 20, 30)]
+        self.assertEqual(chapter_tree_dfs(chapters, bookmarks), [10, 20, 30])
+
+    def test_prune_removes_index(self):
+        """pruned chapters can't be looked up anymore"""
+        tree = ChapterTree.from_chapters(
+            to_records([{"chapterUid": 1, "level": 1}, {"chapterUid": 2, "level": 2}]),
+            MAX_LEVEL,
+        )
+        tree.prune(lambda node: False)
+        self.assertEqual(len(tree), 0)
+        self.assertIsNone(tree.get_node(2))
+        self.assertEqual(list(tree.walk()), [])
+
+    def test_duplicated_uid(self):
+        """duplicated chapter uids are rejected, as treelib did"""
+        with self.assertRaises(ValueError):
+            ChapterTree.from_chapters(
+                to_records(
+                    [{"chapterUid": 1, "level": 1}, {"chapterUid": 1, "level": 2}]
+                ),
+                MAX_LEVEL,
+            )
+
+    def test_large_book(self):
+        """thousands of chapters stay fast"""
+        rnd = random.Random(3)
+        chapters, bookmarks = random_book(rnd, 20000)
+        order = chapter_tree_dfs(chapters, bookmarks)
+        self.assertLessEqual(len(order), 20000)
+
+    def test_equivalent_to_treelib(self):
+        """same output as the previous treelib implementation"""
+        with open(GOLDEN, encoding="utf-8") as f:
+            cases = json.load(f)
+        self.assertTrue(cases)
+        for case in cases:
+            chapters = [
+                {"chapterUid": uid, "level": level} for uid, level in case["chapters"]
+            ]
+            bookmarks = [{"chapterUid": uid} for uid in case["marks"]]
+            self.assertEqual(chapter_tree_dfs(chapters, bookmarks), case["dfs"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""unit test for Metrics"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from lib.metrics import Metrics, endpoint_of
+
+
+class FakeClock(object):
+    """clock advanced by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMetrics(unittest.TestCase):
+    """test Metrics"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.metrics = Metrics(clock=self.clock)
+        self.metrics.reset("sync_read")
+
+    def test_endpoint(self):
+        """object ids are folded into {id}"""
+        self.assertEqual(
+            endpoint_of(
+                "patch", "/v1/blocks/3f1c0a3e-52c4-4b5a-9d6e-0123456789ab/children"
+            ),
+            "PATCH /v1/blocks/{id}/children",
+        )
+        self.assertEqual(endpoint_of("GET", "/web/book/info"), "GET /web/book/info")
+
+    def test_timer(self):
+        """calls of a phase add up, max kept"""
+        for seconds in (1.0, 3.0):
+            with self.metrics.timer("write"):
+                self.clock.now += seconds
+        phase = self.metrics.phases["write"]
+        self.assertEqual((phase.count, phase.total, phase.max), (2, 4.0, 3.0))
+
+    def test_counters(self):
+        """labelled counters, summed by total"""
+        self.metrics.incr("notion.calls", endpoint="GET /v1/pages/{id}")
+        self.metrics.incr("notion.calls", 2, endpoint="POST /v1/pages")
+        self.metrics.incr("notion.retries")
+        self.assertEqual(self.metrics.get("notion.calls", endpoint="POST /v1/pages"), 2)
+        self.assertEqual(self.metrics.total("notion.calls"), 3)
+        self.assertEqual(self.metrics.get("notion.retries"), 1)
+        self.assertIn("notion.calls{endpoint=POST /v1/pages}", self.metrics.summary())
+
+    def test_sqlite_trace(self):
+        """statements are counted by verb"""
+        connection = sqlite3.connect(":memory:")
+        connection.set_trace_callback(self.metrics.count_sql)
+        connection.execute("create table t (a)")
+        connection.executemany("insert into t values (?)", [(1,), (2,)])
+        connection.execute("select * from t").fetchall()
+        connection.close()
+        self.assertEqual(self.metrics.get("sqlite.ops", op="CREATE"), 1)
+        self.assertGreaterEqual(self.metrics.get("sqlite.ops", op="INSERT"), 1)
+        self.assertEqual(self.metrics.get("sqlite.ops", op="SELECT"), 1)
+
+    def test_write(self):
+        """JSON by default, Prometheus textfile for *.prom"""
+        with self.metrics.timer("fetch"):
+            self.clock.now += 0.5
+        self.metrics.incr("notion.calls", endpoint='GET "x"')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics.json")
+            self.metrics.write(path)
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.assertEqual(data["command"], "sync_read")
+            self.assertEqual(data["phases"]["fetch"]["total"], 0.5)
+
+            path = os.path.join(tmp, "metrics.prom")
+            self.metrics.write(path)
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+        self.assertIn(
+            'sync_notion_phase_seconds{command="sync_read",phase="fetch"} 0.5', text
+        )
+        self.assertIn("# TYPE sync_notion_notion_calls_total counter", text)
+        self.assertIn(
+            'sync_notion_notion_calls_total{command="sync_read",endpoint="GET \\"x\\""} 1',
+            text,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,14 @@
 """unit test for DBWeReadRecord"""
+import os
+import random
+import sqlite3
+import tempfile
 import unittest
 from datetime import datetime, timedelta
 
-from lib.db_weread_record import DBWeReadRecord
+from bench.bench_page_block_list import linear_chapter_position, lookups, synthetic_page
+from lib.db_weread_record import BookRecord, DBWeReadCache, DBWeReadRecord
+from lib.page_block_list import PageBlockList
 # from lib.db_weread_record import DBWeReadRecord # 替换your_module_name为实际的模块名
 
 class TestDBReadRecord(unittest.TestCase):
@@ -61,5 +67,274 @@ class TestDBReadRecord(unittest.TestCase):
         results = self.db_reader.query(book_id, bookmark_id)
         self.assertEqual(len(results), 1)
 
+    def test_insert_many(self):
+        """test batch insert"""
+        book_id = '4567'
+        rows = [('chapter1', 'block_1'), ('bookmark_1', 'block_2'), ('chapter1', 'block_1')]
+
+        inserted = self.db_reader.insert_many(book_id, rows)
+        self.assertEqual(inserted, 2)
+        self.assertEqual(len(self.db_reader.query(book_id, 'chapter1')), 1)
+        self.assertEqual(len(self.db_reader.query(book_id, 'bookmark_1')), 1)
+        self.assertFalse(self.db_reader.connection.in_transaction)
+
+    def test_transaction(self):
+        """writes inside a transaction scope are committed once on exit"""
+        book_id = '7890'
+        with self.db_reader.transaction():
+            self.db_reader.delete_book(book_id)
+            with self.db_reader.transaction():
+                self.db_reader.insert(book_id, 'chapter1', 'block_1')
+            self.db_reader.insert_many(book_id, [('bookmark_1', 'block_2')])
+            self.assertTrue(self.db_reader.connection.in_transaction)
+        self.assertFalse(self.db_reader.connection.in_transaction)
+        self.assertEqual(len(self.db_reader.query(book_id, 'bookmark_1')), 1)
+
+    def test_transaction_commit_on_error(self):
+        """records written before an error are kept"""
+        book_id = '7891'
+        with self.assertRaises(RuntimeError):
+            with self.db_reader.transaction():
+                self.db_reader.insert(book_id, 'chapter1', 'block_1')
+                raise RuntimeError("append failed")
+        self.assertFalse(self.db_reader.connection.in_transaction)
+        self.assertEqual(len(self.db_reader.query(book_id, 'chapter1')), 1)
+
+
+    def test_load_book(self):
+        """load all records of a book into bookmark/block maps"""
+        self.db_reader.insert_many('111', [(3, 'block_3'), ('bookmark_1', 'block_b1')])
+        self.db_reader.insert('222', 3, 'block_other')
+
+        records = self.db_reader.load_book('111')
+        self.assertEqual(records.block_of(3), 'block_3')
+        self.assertEqual(records.block_of('3'), 'block_3')
+        self.assertEqual(records.block_of('bookmark_1'), 'block_b1')
+        self.assertIsNone(records.block_of('bookmark_2'))
+        self.assertEqual(records.bookmark_of('block_3'), '3')
+        self.assertIsNone(records.bookmark_of('block_other'))
+
+        records.remove(3)
+        self.assertIsNone(records.block_of(3))
+        self.assertIsNone(records.bookmark_of('block_3'))
+
+    def test_resv(self):
+        """resv (e.g. table row digest) is loaded with the records and updatable"""
+        self.db_reader.insert_many('111', [('_stat.day_:1', 'row_1', 'd1'), ('x', 'block_x')])
+        records = self.db_reader.load_book('111')
+        self.assertEqual(records.resv_of('_stat.day_:1'), 'd1')
+        self.assertIsNone(records.resv_of('x'))
+
+        self.db_reader.update_resv('111', [('_stat.day_:1', 'row_1', 'd2')])
+        self.assertEqual(self.db_reader.load_book('111').resv_of('_stat.day_:1'), 'd2')
+
+
+    def test_page_cache(self):
+        """BookId -> page id mapping"""
+        self.assertIsNone(self.db_reader.query_page('b1'))
+
+        self.db_reader.upsert_page('b1', 'page_1', '2024-05-01T10:00:00.000Z')
+        row = self.db_reader.query_page('b1')
+        self.assertEqual(row['page_id'], 'page_1')
+        self.assertEqual(row['last_edited_time'], '2024-05-01T10:00:00.000Z')
+
+        self.db_reader.upsert_page('b1', 'page_2')
+        self.assertEqual(self.db_reader.query_page('b1')['page_id'], 'page_2')
+
+        self.db_reader.upsert_page('b2', 'page_3')
+        self.assertEqual(
+            {k: row['page_id'] for k, row in self.db_reader.query_pages().items()},
+            {'b1': 'page_2', 'b2': 'page_3'})
+
+        self.db_reader.delete_page('b1')
+        self.assertIsNone(self.db_reader.query_page('b1'))
+
+    def test_page_fingerprint(self):
+        """fingerprint survives a refresh of the same page, reset for a new page"""
+        self.db_reader.upsert_page('b1', 'page_1', fingerprint='{"Sort": "x"}')
+        self.db_reader.upsert_page('b1', 'page_1', '2024-05-01T10:00:00.000Z')
+        self.assertEqual(self.db_reader.query_page('b1')['fingerprint'], '{"Sort": "x"}')
+
+        self.db_reader.upsert_page('b1', 'page_2')
+        self.assertIsNone(self.db_reader.query_page('b1')['fingerprint'])
+
+    def test_layout(self):
+        """page layout, verified_at kept unless given"""
+        self.assertIsNone(self.db_reader.query_layout('b1'))
+
+        verified_at = datetime(2024, 5, 1, 10)
+        self.db_reader.save_layout('b1', 'page_1', '[]', 't1', verified_at)
+        self.db_reader.save_layout('b1', 'page_1', '[["x"]]', 't2')
+        row = self.db_reader.query_layout('b1')
+        self.assertEqual(row['blocks'], '[["x"]]')
+        self.assertEqual(row['edited_time'], 't2')
+        self.assertEqual(row['verified_at'], verified_at)
+
+        self.db_reader.delete_layout('b1')
+        self.assertIsNone(self.db_reader.query_layout('b1'))
+
+    def test_journal(self):
+        """journal keeps the finished stage when a book is registered again"""
+        self.assertEqual(self.db_reader.journal_pending(), {})
+
+        self.db_reader.journal_begin([('b1', 10), ('b2', 20)])
+        self.db_reader.journal_stage('b1', 'page')
+        self.db_reader.journal_begin([('b1', 11)])
+        pending = self.db_reader.journal_pending()
+        self.assertEqual(sorted(pending), ['b1', 'b2'])
+        self.assertEqual((pending['b1']['sort'], pending['b1']['stage']), (11, 'page'))
+        self.assertEqual(pending['b2']['stage'], 'pending')
+
+        self.db_reader.journal_done('b1')
+        self.assertEqual(list(self.db_reader.journal_pending()), ['b2'])
+
+    def test_sync_key(self):
+        """sync keys are replaced as a whole"""
+        self.assertIsNone(self.db_reader.query_sync_key('b1'))
+        self.db_reader.save_sync_key('b1', 10, 20, 3)
+        self.db_reader.save_sync_key('b1', 11, 21, 5)
+        row = self.db_reader.query_sync_key('b1')
+        self.assertEqual((row['bookmark_key'], row['review_key'], row['marks']), (11, 21, 5))
+        self.db_reader.delete_sync_key('b1')
+        self.assertIsNone(self.db_reader.query_sync_key('b1'))
+
+
+class TestDBReadRecordMigrate(unittest.TestCase):
+    """schema migrations"""
+
+    def test_fresh_db(self):
+        """a new db is created at the latest version"""
+        db = DBWeReadRecord(':memory:')
+        self.assertEqual(db.schema_version(), len(DBWeReadRecord.Migrations))
+        db.create_table()  # idempotent
+        self.assertEqual(db.schema_version(), len(DBWeReadRecord.Migrations))
+        # the response cache lives in its own db
+        tables = [
+            row['name'] for row in db.connection.execute(
+                "select name from sqlite_master where type='table'"
+            )
+        ]
+        self.assertNotIn(DBWeReadRecord.CacheTabName, tables)
+        del db
+
+    def test_upgrade_in_place(self):
+        """a db created before versioning is upgraded and keeps its rows"""
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = os.path.join(tmp, 'sync.db')
+            conn = sqlite3.connect(db_name)
+            conn.execute(DBWeReadRecord.SqlCreate)
+            conn.execute(
+                f"insert into {DBWeReadRecord.TabName}(book_id, bookmark_id, block_id)"
+                " values ('b1', '3', 'block_3')"
+            )
+            conn.commit()
+            conn.close()
+
+            db = DBWeReadRecord(db_name)
+            self.assertEqual(db.schema_version(), len(DBWeReadRecord.Migrations))
+            indexes = [
+                row['name'] for row in db.connection.execute(
+                    "select name from sqlite_master where type='index'"
+                )
+            ]
+            self.assertIn(f"idx_{DBWeReadRecord.TabName}_block", indexes)
+            self.assertEqual(db.query_by_block('b1', 'block_3')[0]['bookmark_id'], '3')
+            del db
+
+
+class TestDBWeReadCache(unittest.TestCase):
+    """response cache, a db of its own"""
+
+    def test_cache(self):
+        """cache misses on another stamp or when expired, prune by age and size"""
+        cache = DBWeReadCache(':memory:')
+        cache.save_cache('bookinfo', 'b1', 100, '["isbn"]')
+        self.assertEqual(cache.query_cache('bookinfo', 'b1', 100), '["isbn"]')
+        self.assertIsNone(cache.query_cache('bookinfo', 'b1', 101))
+        self.assertIsNone(cache.query_cache('chapterInfos', 'b1', 100))
+        future = datetime.now() + timedelta(days=1)
+        self.assertIsNone(cache.query_cache('bookinfo', 'b1', 100, future))
+
+        cache.save_cache('bookinfo', 'b2', 0, 'x' * 10)
+        cache.save_cache('bookinfo', 'b3', 0, 'y' * 10)
+        # newest first: b3 and b2 fit into 20 bytes, b1 is evicted
+        self.assertEqual(cache.prune_cache(max_bytes=20), 1)
+        self.assertIsNone(cache.query_cache('bookinfo', 'b1', 100))
+        self.assertEqual(cache.query_cache('bookinfo', 'b3', 0), 'y' * 10)
+
+        self.assertEqual(cache.prune_cache(expire_before=future), 2)
+        del cache
+
+
+class TestDBReadRecordPragma(unittest.TestCase):
+    """journal mode / synchronous options"""
+
+    def test_wal(self):
+        """WAL journal mode on a file database"""
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DBWeReadRecord(os.path.join(tmp, 'sync.db'), 'wal', 'normal')
+            mode = db.connection.execute('PRAGMA journal_mode').fetchone()[0]
+            sync = db.connection.execute('PRAGMA synchronous').fetchone()[0]
+            self.assertEqual(mode, 'wal')
+            self.assertEqual(sync, 1)  # NORMAL
+            del db
+
+    def test_close_checkpoints_wal(self):
+        """closing a WAL database leaves every record in the main file"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sync.db')
+            db = DBWeReadRecord(path, 'wal')
+            db.insert('b1', 'm1', 'block_1')
+            self.assertGreater(os.path.getsize(path + '-wal'), 0)
+            db.close()
+            self.assertFalse(os.path.exists(path + '-wal'))
+
+            # the main file alone, as committed by the Github Action
+            copy = os.path.join(tmp, 'copy.db')
+            with open(path, 'rb') as src, open(copy, 'wb') as dst:
+                dst.write(src.read())
+            db = DBWeReadRecord(copy)
+            self.assertEqual(len(db.query('b1', 'm1')), 1)
+            del db
+
+    def test_invalid_mode(self):
+        """unknown pragma values are rejected"""
+        with self.assertRaises(ValueError):
+            DBWeReadRecord(':memory:', journal_mode='wal; drop table x')
+
+
+class TestPageBlockListIndex(unittest.TestCase):
+    """indexed chapter lookup against the linear scan, timed in bench/"""
+
+    def test_synthetic_page(self):
+        """indexed lookup matches the linear scan on a 5k-block page"""
+        blocks, records, max_uid = synthetic_page()
+        page_block_list = PageBlockList(None, 'book_bench', blocks, records=records)
+        for uid in lookups(max_uid, 200):
+            self.assertEqual(
+                page_block_list.found_chapter_position(uid),
+                linear_chapter_position(page_block_list.blocks, uid),
+            )
+
+    def test_equivalence_random(self):
+        """random small pages, every uid"""
+        rnd = random.Random(11)
+        types = ['heading_1', 'heading_2', 'heading_3', 'paragraph', 'quote', 'divider']
+        for _ in range(200):
+            records = BookRecord('book_rand')
+            blocks = []
+            for idx in range(rnd.randint(0, 12)):
+                block_id = f'b{idx}'
+                blocks.append({'id': block_id, 'type': rnd.choice(types)})
+                if rnd.random() < 0.6:
+                    records.add(rnd.choice([rnd.randint(-1, 8), '_stat_']), block_id)
+            page_block_list = PageBlockList(None, 'book_rand', blocks, records=records)
+            for uid in range(-2, 11):
+                self.assertEqual(
+                    page_block_list.found_chapter_position(uid),
+                    linear_chapter_position(page_block_list.blocks, uid),
+                )
+
+
 if __name__ == '__main__':
     unittest.main()
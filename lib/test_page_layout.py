@@ -0,0 +1,32 @@
+"""unit test for PageLayout"""
+
+import unittest
+
+from lib.page_layout import PageLayout
+
+
+def blocks(*ids):
+    """blocks in list_page_blocks format"""
+    return [{"id": _id, "type": "paragraph"} for _id in ids]
+
+
+class TestPageLayout(unittest.TestCase):
+    """test PageLayout"""
+
+    def test_insert_after(self):
+        """appends go to the end, or right after the anchor block"""
+        layout = PageLayout(blocks("a", "b"))
+        layout.insert_after(None, blocks("c"))
+        layout.insert_after("a", blocks("a1", "a2"))
+        self.assertEqual([b["id"] for b in layout.blocks], ["a", "a1", "a2", "b", "c"])
+        self.assertTrue(layout.valid)
+
+    def test_unknown_block(self):
+        """an unknown anchor invalidates the layout"""
+        layout = PageLayout(blocks("a"))
+        layout.insert_after("x", blocks("c"))
+        self.assertFalse(layout.valid)
+
+
+if __name__ == "__main__":
+    unittest.main()
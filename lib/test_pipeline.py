@@ -0,0 +1,75 @@
+"""unit test for Pipeline"""
+
+import asyncio
+import unittest
+
+from lib.pipeline import Pipeline, Stage
+
+
+class TestPipeline(unittest.TestCase):
+    """test Pipeline"""
+
+    def test_stage_order(self):
+        """every job goes through the stages in order"""
+        trace = []
+
+        def stage(name):
+            async def handler(job):
+                await asyncio.sleep(0.001 * (job % 3))
+                trace.append((job, name))
+
+            return Stage(name, handler, workers=2)
+
+        pipeline = Pipeline([stage("fetch"), stage("plan"), stage("write")], 3)
+        failed = asyncio.run(pipeline.run(range(10)))
+
+        self.assertEqual(failed, [])
+        for job in range(10):
+            self.assertEqual(
+                [name for _job, name in trace if _job == job],
+                ["fetch", "plan", "write"],
+            )
+
+    def test_overlap_and_in_flight(self):
+        """stages overlap but never more than in_flight jobs are inside"""
+        active = set()
+        peak = []
+        overlapped = []
+
+        async def fetch(job):
+            if active:
+                overlapped.append(job)
+            active.add(job)
+            peak.append(len(active))
+            await asyncio.sleep(0.001)
+
+        async def write(job):
+            await asyncio.sleep(0.005)
+            active.discard(job)
+
+        pipeline = Pipeline([Stage("fetch", fetch, 4), Stage("write", write, 4)], 2)
+        asyncio.run(pipeline.run(range(8)))
+
+        self.assertLessEqual(max(peak), 2)
+        self.assertTrue(overlapped)
+
+    def test_failed_job(self):
+        """a failed job is dropped and doesn't block the others"""
+        written = []
+
+        async def fetch(job):
+            if job == 1:
+                raise ValueError("boom")
+
+        async def write(job):
+            written.append(job)
+
+        pipeline = Pipeline([Stage("fetch", fetch), Stage("write", write)], 1)
+        failed = asyncio.run(pipeline.run(range(3)))
+
+        self.assertEqual(written, [0, 2])
+        self.assertEqual([(name, job) for name, job, _e in failed], [("fetch", 1)])
+
+
+if __name__ == "__main__":
+    unittest.main()
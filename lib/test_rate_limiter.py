@@ -0,0 +1,56 @@
+"""unit test for TokenBucket"""
+
+import asyncio
+import time
+import unittest
+
+from lib.rate_limiter import TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+    """test TokenBucket"""
+
+    def test_burst(self):
+        """a full bucket hands out `burst` tokens without waiting"""
+
+        async def run():
+            bucket = TokenBucket(rate=1, burst=3)
+            start = time.monotonic()
+            for _ in range(3):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        self.assertLess(asyncio.run(run()), 0.05)
+
+    def test_rate(self):
+        """once the bucket is empty, callers are spaced by 1/rate"""
+
+        async def run():
+            bucket = TokenBucket(rate=50, burst=1)
+            start = time.monotonic()
+            await asyncio.gather(*(bucket.acquire() for _ in range(6)))
+            return time.monotonic() - start
+
+        # first token is free, the next 5 wait 20ms each
+        self.assertGreaterEqual(asyncio.run(run()), 0.09)
+
+    def test_pause(self):
+        """pause blocks every caller for the given delay"""
+
+        async def run():
+            bucket = TokenBucket(rate=1000, burst=10)
+            bucket.pause(0.1)
+            start = time.monotonic()
+            await bucket.acquire()
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(asyncio.run(run()), 0.09)
+
+    def test_invalid_rate(self):
+        """rate must be positive"""
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
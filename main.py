@@ -6,7 +6,7 @@ import logging
 
 import fire
 
-from sync_read import sync_read
+from sync_read import sync_read, apply_plan
 from sync_trending import sync_trending
 from sync_producthunt import sync_producthunt
 
@@ -16,6 +16,7 @@ if __name__ == "__main__":
     fire.Fire(
         {
             "sync_read": sync_read,
+            "apply": apply_plan,
             "sync_trending": sync_trending,
             "sync_producthunt": sync_producthunt,
         }
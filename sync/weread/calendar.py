@@ -1,12 +1,20 @@
 """sync reading log to calendar database"""
 
+import asyncio
+import logging
 from datetime import datetime
 from notion_client import AsyncClient
+from api import notion
 from api.notion import BlockHelper
 
 
-def query_filter(book_id: str, date: float):
-    """query filter for calendar database"""
+def read_date(date: float) -> str:
+    """reading day of a weread timestamp, timezone discarded"""
+    return datetime.fromtimestamp(date).strftime("%Y-%m-%d")
+
+
+def query_filter(book_id: str, start: str, end: str):
+    """query filter for calendar database: one book, reading days in [start, end]"""
     return {
         "and": [
             {
@@ -18,17 +26,54 @@ def query_filter(book_id: str, date: float):
             {
                 "property": "ReadDate",
                 "date": {
-                    "equals": datetime.fromtimestamp(date).strftime("%Y-%m-%d"),
+                    "on_or_after": start,
+                },
+            },
+            {
+                "property": "ReadDate",
+                "date": {
+                    "on_or_before": end,
                 },
             },
         ]
     }
 
 
+def diff_days(days: dict, pages: list):
+    """
+    compare weread reading days with the calendar pages of the book
+    :param days: reading day -> read time
+    :param pages: calendar pages in the same date range
+    :return: (days to create [(day, read_time)], pages to update [(page_id, read_time)])
+    """
+    existing = {}
+    for page in pages:
+        properties = page.get("properties", {})
+        date = (properties.get("ReadDate", {}).get("date") or {}).get("start")
+        if date:
+            # 同一天有多条记录时只维护第一条
+            existing.setdefault(date[:10], page)
+
+    creating, updating = [], []
+    for day, read_time in sorted(days.items()):
+        page = existing.get(day)
+        if page is None:
+            creating.append((day, read_time))
+            continue
+        _old = page.get("properties", {}).get("ReadTime", {}).get("number")
+        if _old != read_time:
+            updating.append((page["id"], read_time))
+    return creating, updating
+
+
 async def sync_to_calener(
     client: AsyncClient, calendar_data_source_id: str, read_detail: dict
 ):
-    """sync reading log to calendar database"""
+    """sync reading log to calendar database
+
+    one range query per book, diffed in memory; missing days are created and
+    changed ones updated concurrently
+    """
     if not client or not read_detail:
         return
     rdetail = read_detail.get("readDetail")
@@ -37,43 +82,48 @@ async def sync_to_calener(
     if not rdetail or not book_info:
         return
 
-    # from latest to oldest
-    records = sorted(
-        rdetail.get("data", []), key=lambda x: x.get("readDate") or 0, reverse=True
-    )
+    days = {}
+    for record in rdetail.get("data", []):
+        if record.get("readDate"):
+            days[read_date(record.get("readDate"))] = record.get("readTime", 0)
+    if not days:
+        return
 
-    # No batch-updating API exist😢
     book_id = book_info.get("bookId")
-    for record in records:
-        date = record.get("readDate")
-        read_time = record.get("readTime", 0)
-
-        response = await client.data_sources.query(
-            data_source_id=calendar_data_source_id,
-            filter=query_filter(book_id, date),
-        )
-        if len(response["results"]) > 0:
-            result = response["results"][0]
-            _old = result.get("properties", {}).get("ReadTime", {}).get("number", 0)
-            if _old < read_time:
-                properties = {"ReadTime": BlockHelper.number(read_time)}
-                await client.pages.update(page_id=result["id"], properties=properties)
-
-            # 每日更新，仅更新最近一次即可
-            break
+    pages = await notion.query_all(
+        client,
+        calendar_data_source_id,
+        filter=query_filter(book_id, min(days), max(days)),
+    )
+    creating, updating = diff_days(days, pages)
 
-        properties = {
-            "Name": BlockHelper.title(book_info.get("title", "")),
-            "BookId": BlockHelper.rich_text(book_id),
-            "ReadDate": {
-                "date": {"start": datetime.fromtimestamp(date).strftime("%Y-%m-%d")}
-            },  # Discard timezone
-            "ReadTime": BlockHelper.number(read_time),
-        }
-        await client.pages.create(
-            parent={
-                "data_source_id": calendar_data_source_id,
-                "type": "data_source_id",
+    # No batch-updating API exist😢
+    parent = {"data_source_id": calendar_data_source_id, "type": "data_source_id"}
+    writes = [
+        client.pages.create(
+            parent=parent,
+            properties={
+                "Name": BlockHelper.title(book_info.get("title", "")),
+                "BookId": BlockHelper.rich_text(book_id),
+                "ReadDate": {"date": {"start": day}},
+                "ReadTime": BlockHelper.number(read_time),
             },
-            properties=properties,
+        )
+        for day, read_time in creating
+    ]
+    writes.extend(
+        client.pages.update(
+            page_id=page_id, properties={"ReadTime": BlockHelper.number(read_time)}
+        )
+        for page_id, read_time in updating
+    )
+    results = await asyncio.gather(*writes, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logging.error(
+            "calendar of book %s: %d of %d writes failed, first: %s",
+            book_id,
+            len(errors),
+            len(results),
+            errors[0],
         )
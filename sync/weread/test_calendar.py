@@ -0,0 +1,43 @@
+"""unit test for calendar diffing"""
+
+import unittest
+
+from sync.weread.calendar import diff_days
+
+
+def page(page_id, day, read_time):
+    """calendar page with ReadDate / ReadTime"""
+    return {
+        "id": page_id,
+        "properties": {
+            "ReadDate": {"date": {"start": day}},
+            "ReadTime": {"number": read_time},
+        },
+    }
+
+
+class TestDiffDays(unittest.TestCase):
+    """test diff_days"""
+
+    def test_diff(self):
+        """missing days are created, changed ones updated, older days included"""
+        days = {"2024-05-01": 60, "2024-05-02": 120, "2024-05-03": 30}
+        pages = [
+            page("p1", "2024-05-01", 30),
+            page("p2", "2024-05-02", 120),
+            page("p3", "2024-05-02", 1),  # duplicated day, ignored
+        ]
+        creating, updating = diff_days(days, pages)
+        self.assertEqual(creating, [("2024-05-03", 30)])
+        self.assertEqual(updating, [("p1", 60)])
+
+    def test_datetime_start(self):
+        """ReadDate with a time part still matches the day"""
+        creating, updating = diff_days(
+            {"2024-05-01": 60}, [page("p1", "2024-05-01T00:00:00.000+08:00", 60)]
+        )
+        self.assertEqual((creating, updating), ([], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,12 +3,12 @@
 """
 
 import logging
-import time
 import requests
 from pyquery import PyQuery as pq
 from notion_client import AsyncClient
 
 from api import notion
+from lib.metrics import METRICS, endpoint_of, report_run
 from config import CONFIG
 from api.notion import BlockHelper
 
@@ -43,8 +43,6 @@ comments={self.comments} votes={self.votes} url={self.url} cover={self.cover}>""
 
 async def query_page(client: AsyncClient, data_source_id: str, name: str) -> bool:
     """check page exist or not"""
-    time.sleep(0.3)
-
     response = await client.data_sources.query(
         data_source_id=data_source_id,
         filter={"property": "Name", "rich_text": {"equals": name}},
@@ -86,6 +84,8 @@ def _scrape() -> list[ProductItem]:
 
     url = "https://www.producthunt.com/all"
     req = requests.get(url, headers=headers, timeout=60)
+    METRICS.incr("http.calls", endpoint=endpoint_of("GET", url))
+    METRICS.incr("http.bytes_in", len(req.content))
     if req.status_code != 200:
         logging.error("access product hunt error. %d", req.status_code)
         return []
@@ -174,33 +174,39 @@ async def _sync(
     for prod in products:
         if _filter_product(prod):
             logging.info("filter product: %s", prod.name)
+            METRICS.incr("producthunt.filtered")
             continue
 
-        time.sleep(0.3)  # avoid rate limit for notion API
-        if await query_page(client, data_source_id, prod.name):
+        with METRICS.timer("query"):
+            exist = await query_page(client, data_source_id, prod.name)
+        if exist:
             continue
 
         # insert to db
         logging.info(prod)
 
-        _id = await _append_page(client, data_source_id, prod)
+        with METRICS.timer("insert"):
+            _id = await _append_page(client, data_source_id, prod)
+        METRICS.incr("producthunt.inserted")
         print(_id)
 
 
 async def sync_producthunt(notion_token, database_id):
     """sync product hunt to notion"""
-    client = AsyncClient(auth=notion_token, log_level=logging.ERROR)
-    data_sources_id = await notion.get_datasource_id(client, database_id)
-    if not data_sources_id:
-        logging.error("database %s has no data source", database_id)
-        return
-
-    products = _scrape()
-    if not products:
-        logging.error(
-            "ph scape error",
-        )
-        return
+    with report_run("sync_producthunt", CONFIG.get("metrics", "Output", fallback="")):
+        client = notion.create_client(notion_token)
+        data_sources_id = await notion.get_datasource_id(client, database_id)
+        if not data_sources_id:
+            logging.error("database %s has no data source", database_id)
+            return
+
+        with METRICS.timer("scrape"):
+            products = _scrape()
+        if not products:
+            logging.error(
+                "ph scape error",
+            )
+            return
 
-    logging.info("ph scape total num [%s]", len(products))
-    await _sync(client, data_sources_id, products)
+        logging.info("ph scape total num [%s]", len(products))
+        await _sync(client, data_sources_id, products)
@@ -2,35 +2,45 @@
 author: alex-guoba
 """
 
+import asyncio
 import logging
 import re
-import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import hashlib
+import json
 from collections import defaultdict
 
-from treelib.tree import Tree
-from notion_client import AsyncClient
+from notion_client import AsyncClient, APIErrorCode, APIResponseError
 
 from api import notion, weread
 from api.notion import BlockHelper
+from api.weread import Chapter, Mark, merge_marks
 
-from lib.db_weread_record import DBWeReadRecord
+from lib.chapter_tree import ChapterTree
+from lib import fastjson
+from lib.db_weread_record import BookRecord, DBWeReadCache, DBWeReadRecord
+from lib.metrics import METRICS, report_run
 from lib.page_block_list import PageBlockList
+from lib.page_layout import PageLayout
+from lib.pipeline import Pipeline, Stage
 from lib.serverchan import sc_send
 
 from config import CONFIG
 from sync.weread.calendar import sync_to_calener
 
-ROOT_NODE_ID = "#root"
-BOOK_MARK_KEY = "#bookmarks"
 NOTION_MAX_LEVEL = 3
+# page属性摘要中icon使用的key，不会与notion属性名冲突
+PAGE_ICON_KEY = "#icon"
+# 写入计划文件格式版本
+PLAN_VERSION = 2
 
 
 class BlockItem:
     """Just for enveloping the child block"""
 
-    def __init__(self, after=None, bookmark=None, block=None, child=None) -> None:
+    def __init__(
+        self, after=None, bookmark=None, block=None, child=None, resv=None
+    ) -> None:
         """
         初始化方法，用于创建一个新的Block对象。
         Args:
@@ -38,6 +48,7 @@ class BlockItem:
             bookmark (str, optional): 对应的bookmarkid，需要与bid一起写入db时使用
             block (str, optional): Block的内容
             child (list, optional): 子Block对象的列表，默认为None。
+            resv (str, optional): 与bookmark一起写入db的附加信息，如表格行内容摘要
         Returns:
             None
 
@@ -46,16 +57,141 @@ class BlockItem:
         self.bookmark = bookmark
         self.block = block
         self.child = child if child else []
+        self.resv = resv
         self.bid = None
 
     def set_bid(self, bid):
         """set block id after appending to notion success"""
         self.bid = bid
 
+    def to_dict(self) -> dict:
+        """json form, saved in the write plan"""
+        return {
+            "after": self.after,
+            "bookmark": self.bookmark,
+            "block": self.block,
+            "child": self.child,
+            "resv": self.resv,
+            "bid": self.bid,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BlockItem":
+        """load from the write plan"""
+        item = cls(
+            after=data.get("after"),
+            bookmark=data.get("bookmark"),
+            block=data.get("block"),
+            child=data.get("child"),
+            resv=data.get("resv"),
+        )
+        item.set_bid(data.get("bid"))
+        return item
+
+
+class BookJob:
+    """Book travelling through the fetch -> plan -> write pipeline"""
+
+    def __init__(self, entry: dict) -> None:
+        self.entry = entry
+        self.book = entry.get("book")
+        self.book_id = self.book.get("bookId")
+        self.sort = entry["sort"]
+
+        # filled by fetch stage
+        self.chapters = []
+        # 章节列表来自本地缓存，可能缺少之后新增的章节
+        self.chapters_cached = False
+        self.bookmarks = []
+        self.summary = []
+        self.bookinfo = ("", 0, "", "")
+        self.read_info = {}
+        # 划线及笔记总数，增量拉取时bookmarks只包括synckey之后的变化
+        self.mark_count = 0
+        self.delta = False
+        # 写入完成后记录的(bookmark_key, review_key, mark_count)
+        self.sync_keys: tuple | None = None
+
+        # filled by plan stage, appended to the page section by section
+        self.pid = None
+        # page属性的写入计划，无需写入时为None，见plan_page
+        self.page: dict | None = None
+        self.sections: list[list[BlockItem]] = []
+        # 阅读明细：追加到已有表格的行(table id, rows)，以及原位更新的行
+        self.table_rows: list[tuple[str, list[BlockItem]]] = []
+        self.row_updates: list[BlockItem] = []
+        # 列出已有表格得到的行记录 [(bookmark_id, block_id, resv), ...]
+        self.recorded: list[tuple] = []
+        # 信任本地页面结构时使用，verified_at为本次列出全部block核对的时间
+        self.layout: PageLayout | None = None
+        self.verified_at = None
+        # 按增量新建了page，缺少之前的划线，保留写入日志待下次全量补齐
+        self.incomplete = False
+        # 找不到章节未写入的划线数，不保存synckey，下次全量拉取
+        self.unmounted = 0
+
+    def to_dict(self) -> dict:
+        """json form of a planned book, saved in the write plan"""
+        return {
+            "entry": self.entry,
+            "chapters": [chapter.to_dict() for chapter in self.chapters],
+            "bookmarks": [mark.to_dict() for mark in self.bookmarks],
+            "summary": [mark.to_dict() for mark in self.summary],
+            "bookinfo": list(self.bookinfo),
+            "read_info": self.read_info,
+            "mark_count": self.mark_count,
+            "delta": self.delta,
+            "sync_keys": self.sync_keys,
+            "pid": self.pid,
+            "page": self.page,
+            "sections": [[item.to_dict() for item in items] for items in self.sections],
+            "table_rows": [
+                [table_id, [item.to_dict() for item in rows]]
+                for table_id, rows in self.table_rows
+            ],
+            "row_updates": [item.to_dict() for item in self.row_updates],
+            "recorded": [list(row) for row in self.recorded],
+            "layout": None if self.layout is None else self.layout.blocks,
+            "verified_at": self.verified_at.isoformat() if self.verified_at else None,
+            "incomplete": self.incomplete,
+            "unmounted": self.unmounted,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BookJob":
+        """load a planned book from the write plan"""
+        job = cls(data["entry"])
+        job.chapters = [Chapter.from_dict(chapter) for chapter in data["chapters"]]
+        job.bookmarks = [Mark.from_dict(mark) for mark in data["bookmarks"]]
+        job.summary = [Mark.from_dict(mark) for mark in data["summary"]]
+        job.bookinfo = tuple(data["bookinfo"])
+        job.read_info = data["read_info"]
+        job.mark_count = data.get("mark_count", len(job.bookmarks))
+        job.delta = data.get("delta", False)
+        if data.get("sync_keys"):
+            job.sync_keys = tuple(data["sync_keys"])
+        job.incomplete = data.get("incomplete", False)
+        job.unmounted = data.get("unmounted", 0)
+        job.pid = data["pid"]
+        job.page = data["page"]
+        job.sections = [
+            [BlockItem.from_dict(item) for item in items] for items in data["sections"]
+        ]
+        job.table_rows = [
+            (table_id, [BlockItem.from_dict(item) for item in rows])
+            for table_id, rows in data["table_rows"]
+        ]
+        job.row_updates = [BlockItem.from_dict(item) for item in data["row_updates"]]
+        job.recorded = [tuple(row) for row in data["recorded"]]
+        if data["layout"] is not None:
+            job.layout = PageLayout(data["layout"])
+        if data["verified_at"]:
+            job.verified_at = datetime.fromisoformat(data["verified_at"])
+        return job
+
 
 async def get_page_info(client: AsyncClient, data_source_id: str, book_id: str):
     """查询原page信息，并返回pageinfo和pid"""
-    time.sleep(0.3)
     response = await client.data_sources.query(
         data_source_id=data_source_id,
         filter={"property": "BookId", "rich_text": {"equals": book_id}},
@@ -70,28 +206,36 @@ async def get_page_info(client: AsyncClient, data_source_id: str, book_id: str):
     return pageinfo, pid
 
 
-def inherit_properties(page):
-    """
-    从传入的 page 字典中提取 properties 字段，并返回一个新的字典，其中不包含类型为 'formula' 的属性。
-    Args:
-        page (dict): 包含页面信息的字典，其中包含名为 'properties' 的字段，该字段是一个字典，包含页面属性的键值对。
-    Returns:
-        dict: 一个新的字典，包含从原始 'properties' 字段中提取的、类型不为 'formula' 的页面属性键值对。
-    """
-    properties = {}
-    if page:
-        for k, v in page["properties"].items():
-            if v.get("type") == "formula":
-                continue
-            properties[k] = v
-    return properties
+class BookPageIndex:
+    """BookId -> page，运行开始时一次分页拉取database中的全部page"""
 
+    def __init__(self, pages: list) -> None:
+        self.pages = {}
+        self._latest_sort = 0
+        for page in pages:
+            properties = page.get("properties", {})
+            sort = properties.get("Sort", {}).get("number")
+            if sort is not None:
+                self._latest_sort = max(self._latest_sort, sort)
+            book_id = notion.plain_text(properties.get("BookId"))
+            if book_id:
+                self.pages.setdefault(book_id, page)
 
-async def create_or_update_page(
-    client: AsyncClient,
-    data_source_id: str,
-    pageinfo,
-    pid,
+    @classmethod
+    async def load(cls, client: AsyncClient, data_source_id: str):
+        """拉取全部page并建立索引"""
+        return cls(await notion.query_all(client, data_source_id))
+
+    def get(self, book_id: str):
+        """书籍对应的page，不存在时返回None"""
+        return self.pages.get(book_id)
+
+    def latest_sort(self) -> int:
+        """database中的最新更新时间"""
+        return self._latest_sort
+
+
+def book_properties(
     book_name="",
     book_id="",
     cover="",
@@ -105,29 +249,23 @@ async def create_or_update_page(
     intro="",
     read_info=None,
 ):
-    """插入到notion"""
-    parent = {"data_source_id": data_source_id, "type": "data_source_id"}
-
-    properties = inherit_properties(pageinfo)
-
-    properties.update(
-        {
-            "BookName": BlockHelper.title(book_name),
-            "BookId": BlockHelper.rich_text(book_id),
-            "ISBN": BlockHelper.rich_text(isbn),
-            "URL": BlockHelper.url(
-                f"https://weread.qq.com/web/reader/{calculate_book_str_id(book_id)}"
-            ),
-            "Author": BlockHelper.rich_text(author),
-            "Sort": BlockHelper.number(sort),
-            "Rating": BlockHelper.number(rating),
-            "Cover": BlockHelper.files("Cover", cover),
-            "NoteCount": BlockHelper.number(note_count),
-            "ReviewCount": BlockHelper.number(review_count),
-            "Category": BlockHelper.rich_text(category),
-            "Intro": BlockHelper.rich_text(intro),
-        }
-    )
+    """书籍page的属性"""
+    properties = {
+        "BookName": BlockHelper.title(book_name),
+        "BookId": BlockHelper.rich_text(book_id),
+        "ISBN": BlockHelper.rich_text(isbn),
+        "URL": BlockHelper.url(
+            f"https://weread.qq.com/web/reader/{calculate_book_str_id(book_id)}"
+        ),
+        "Author": BlockHelper.rich_text(author),
+        "Sort": BlockHelper.number(sort),
+        "Rating": BlockHelper.number(rating),
+        "Cover": BlockHelper.files("Cover", cover),
+        "NoteCount": BlockHelper.number(note_count),
+        "ReviewCount": BlockHelper.number(review_count),
+        "Category": BlockHelper.rich_text(category),
+        "Intro": BlockHelper.rich_text(intro),
+    }
 
     if read_info:
         marked_status = read_info.get("markedStatus", 0)
@@ -149,39 +287,181 @@ async def create_or_update_page(
         if read_info.get("finishedDate"):
             properties["FinishAt"] = BlockHelper.date(read_info.get("finishedDate"))
 
-    if pid is None:
-        response = await client.pages.create(
-            parent=parent, icon=BlockHelper.icon(cover), properties=properties
-        )
-        return response["id"], True
+    return properties
+
 
-    response = await client.pages.update(
-        page_id=pid, icon=BlockHelper.icon(cover), properties=properties
+def content_digest(value) -> str:
+    """json内容的稳定摘要"""
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def page_fingerprint(properties, icon) -> dict:
+    """每个属性及icon的摘要(key -> hash)，用于判断哪些属性需要更新"""
+    payload = dict(properties)
+    payload[PAGE_ICON_KEY] = icon
+    return {key: content_digest(value) for key, value in payload.items()}
+
+
+def is_page_gone(error: APIResponseError) -> bool:
+    """page已被删除（或移入回收站）"""
+    if error.code == APIErrorCode.ObjectNotFound:
+        return True
+    return error.code == APIErrorCode.ValidationError and "archived" in str(error)
+
+
+def book_fields(job: BookJob) -> dict:
+    """book_properties的参数"""
+    book_dict = job.book
+    isbn, rating, category, intro = job.bookinfo
+    return dict(
+        book_name=book_dict.get("title"),
+        book_id=job.book_id,
+        cover=book_dict.get("cover"),
+        sort=job.sort,
+        author=book_dict.get("author"),
+        isbn=isbn,
+        rating=rating,
+        category=category,
+        note_count=job.entry.get("noteCount"),
+        review_count=job.entry.get("reviewCount"),
+        intro=intro,
+        read_info=job.read_info,
     )
-    return pid, False
 
 
-async def list_page_blocks(client: AsyncClient, pid: str):
-    """query page blocks (children not included)"""
-    response = await client.blocks.children.list(block_id=pid)
+async def locate_book_page(
+    client: AsyncClient,
+    data_source_id: str,
+    store: DBWeReadRecord,
+    book_id: str,
+    index: BookPageIndex | None = None,
+):
+    """查找书籍page，只读
+    page来自预先拉取的index；未拉取时直接使用本地记录的page id，没有记录时才查询database。
+    记录的page已被删除时由write_page发现并重新创建
+    :return: (page_id, last_edited_time)，page不存在时为(None, None)
+    """
+    if index is not None:
+        page = index.get(book_id)
+        return (page["id"], page.get("last_edited_time")) if page else (None, None)
+
+    cached = store.query_page(book_id)
+    if cached:
+        # 本地记录的编辑时间不含同步之外的修改，需要时由plan_book查询
+        return cached["page_id"], None
+
+    pageinfo, pid = await get_page_info(client, data_source_id, book_id)
+    return pid, pageinfo.get("last_edited_time") if pageinfo else None
+
+
+def plan_page(store: DBWeReadRecord, job: BookJob) -> dict | None:
+    """
+    page属性的写入计划：新建page时写入全部属性；
+    已有page只写入与上次写入的摘要不同的属性，全部相同时返回None。
+    未记录摘要时写入全部属性，用户在notion中添加的其他属性不受影响
+    :return: {"properties": ..., "icon": 无变化时为None, "fingerprint": 写入后的摘要}
+    """
+    properties = book_properties(**book_fields(job))
+    icon = BlockHelper.icon(job.book.get("cover"))
+    fingerprint = page_fingerprint(properties, icon)
+    if job.pid is None:
+        return {"properties": properties, "icon": icon, "fingerprint": fingerprint}
+
+    last = {}
+    cached = store.query_page(job.book_id)
+    if (
+        CONFIG.getboolean("weread.sync", "PropertyFingerprint", fallback=True)
+        and cached
+        and cached["page_id"] == job.pid
+        and cached["fingerprint"]
+    ):
+        last = json.loads(cached["fingerprint"])
+
+    changed = {k: v for k, v in properties.items() if last.get(k) != fingerprint[k]}
+    if last.get(PAGE_ICON_KEY) == fingerprint[PAGE_ICON_KEY]:
+        icon = None
+    if not changed and icon is None:
+        return None
+    return {"properties": changed, "icon": icon, "fingerprint": fingerprint}
+
+
+async def write_page(
+    client: AsyncClient, data_source_id: str, store: DBWeReadRecord, job: BookJob
+):
+    """执行page属性的写入计划
+    page在计划之后被删除时重新创建，并按空page重新生成blocks
+    """
+    if job.page is None:
+        return
+
+    page = None
+    if job.pid is not None:
+        kwargs = {"icon": job.page["icon"]} if job.page["icon"] else {}
+        try:
+            page = await client.pages.update(
+                page_id=job.pid, properties=job.page["properties"], **kwargs
+            )
+            if page.get("in_trash") or page.get("archived"):
+                page = None
+        except APIResponseError as error:
+            if not is_page_gone(error):
+                raise
+        if page is None:
+            logging.info("page of book %s is gone", job.book_id)
+            # 重新创建失败时，下次运行查询database而不是再次使用失效的page id
+            store.delete_page(job.book_id)
+            job.pid = None
+            job.page = plan_page(store, job)
+            await plan_blocks(client, job, BookRecord(job.book_id), [])
+
+    if page is None:
+        parent = {"data_source_id": data_source_id, "type": "data_source_id"}
+        page = await client.pages.create(
+            parent=parent, icon=job.page["icon"], properties=job.page["properties"]
+        )
+        job.pid = page["id"]
+        # 新page，原有的同步记录作废
+        store.delete_book(job.book_id)
+
+    store.upsert_page(
+        job.book_id,
+        page["id"],
+        page.get("last_edited_time"),
+        json.dumps(job.page["fingerprint"]),
+    )
+
+
+async def list_children(client: AsyncClient, block_id: str) -> list:
+    """query all child blocks of a block, page by page"""
+    response = await client.blocks.children.list(block_id=block_id)
     children = response["results"] if len(response.get("results")) > 0 else []
     while response.get("has_more"):
         response = await client.blocks.children.list(
-            block_id=pid, start_cursor=response["next_cursor"]
+            block_id=block_id, start_cursor=response["next_cursor"]
         )
         children += response["results"] if len(response.get("results")) > 0 else []
+    return children
+
+
+async def list_page_blocks(client: AsyncClient, pid: str):
+    """query page blocks (children not included)"""
+    children = await list_children(client, pid)
     # remove other fileds in blocks
     tailor = list(map(lambda x: {"id": x.get("id"), "type": x.get("type")}, children))
     return tailor
 
 
-async def append_children(client: AsyncClient, pid, after, children):
-    """append child block to page. Notion API limit 100 blocker per appending"""
+async def append_children(
+    client: AsyncClient, pid, after, children, layout: PageLayout | None = None
+):
+    """append child block to page, packed by the notion request limits
+    layout: top-level layout of the page, updated with the appended blocks
+    """
     results = []
-    print("appending ", len(children), " blocks after ", after)
-    for i in range(0, len(children) // 100 + 1):
-        time.sleep(0.3)
-        subchild = children[i * 100 : (i + 1) * 100]
+    logging.debug("appending %d blocks after %s", len(children), after)
+    for subchild in notion.pack_blocks(children):
         response = None
         if after:
             response = await client.blocks.children.append(
@@ -192,49 +472,109 @@ async def append_children(client: AsyncClient, pid, after, children):
                 block_id=pid, children=subchild
             )
         # Notion will return all the blocks start from the appending block. So we need to filter the result.
-        results.extend(response.get("results")[: len(subchild)])
+        _results = response.get("results")[: len(subchild)]
+        results.extend(_results)
+        METRICS.incr("notion.blocks_appended", len(_results))
+        if layout is not None:
+            layout.insert_after(after, _results)
+        if after and _results:
+            # keep the order of the following requests
+            after = _results[-1].get("id")
     return results if len(results) == len(children) else []
 
 
+def group_blocks(appending: list[BlockItem]):
+    """
+    group consecutive items appended after the same block.
+    children are nested into their parent block, the ones exceeding the notion
+    children limit (e.g. long tables) are left to be appended to the parent later.
+    return: ([(after, [block, ...]), ...], [overflow children of each item])
+    """
+    groups = []
+    overflow = []
+    for item in appending:
+        block, rest = notion.nest_children(item.block, item.child)
+        overflow.append(rest)
+        if groups and groups[-1][0] == item.after:
+            groups[-1][1].append(block)
+        else:
+            groups.append((item.after, [block]))
+    return groups, overflow
+
+
 async def append_blocks(
     client: AsyncClient,
     pid: str,
     appending: list[BlockItem],
-    store: DBWeReadRecord,
-    book_id: str,
+    layout: PageLayout | None = None,
 ):
-    """append child block to page by group"""
-    batch = []
-    block_id = None
-    result = []
-    for item in appending:
-        if not batch:
-            block_id = item.after
-            batch.append(item.block)
-            continue
-        if block_id == item.after:
-            batch.append(item.block)
-            continue
-        _result = await append_children(client, pid, block_id, batch)
-        result.extend(_result)
-
-        block_id = item.after
-        batch = [item.block]
+    """append child block to page by group (see group_blocks), return the items
+    whose overflow children failed
+    """
+    groups, overflow = group_blocks(appending)
+    start = 0
+    for block_id, batch in groups:
+        result = await append_children(client, pid, block_id, batch, layout)
+        # 逐组回填block id，后面的组失败时已追加的block仍可落库
+        for item, block in zip(appending[start : start + len(batch)], result):
+            item.set_bid(block.get("id"))
+        start += len(batch)
+
+    parents = [
+        (item, overflow[idx])
+        for idx, item in enumerate(appending)
+        if overflow[idx] and item.bid
+    ]
 
-    if len(batch) > 0:
-        _result = await append_children(client, pid, block_id, batch)
-        result.extend(_result)
+    # 子block分别挂在不同的父block下，互不依赖，并发追加（共用notion限速）
+    results = await asyncio.gather(
+        *(append_children(client, item.bid, None, rest) for item, rest in parents),
+        return_exceptions=True,
+    )
+    failed = []
+    for (item, rest), _result in zip(parents, results):
+        if isinstance(_result, BaseException):
+            logging.error(
+                "append %d children to block %s (bookmark %s) failed: %s",
+                len(rest),
+                item.bid,
+                item.bookmark,
+                _result,
+            )
+            failed.append(item)
+    return failed
+
+
+def save_blocks(store: DBWeReadRecord, book_id: str, appending: list[BlockItem]):
+    """write appended bookmark -> block mapping to db"""
+    store.insert_many(
+        book_id,
+        [
+            (block.bookmark, block.bid, block.resv)
+            for block in appending
+            if block.bookmark and block.bid
+        ],
+    )
 
-    for idx, item in enumerate(appending):
-        bid = result[idx].get("id")
-        item.set_bid(bid)
-        if item.child:
-            await append_children(client, bid, None, item.child)
 
-    # write to db
-    for block in appending:
-        if block.bookmark and block.bid:
-            store.insert(book_id, block.bookmark, block.bid)
+async def update_rows(client: AsyncClient, updates: list[BlockItem]):
+    """原位更新表格行，互不依赖，并发执行；返回更新成功的行"""
+    results = await asyncio.gather(
+        *(
+            client.blocks.update(block_id=item.bid, table_row=item.block["table_row"])
+            for item in updates
+        ),
+        return_exceptions=True,
+    )
+    updated = []
+    for item, result in zip(updates, results):
+        if isinstance(result, BaseException):
+            logging.error(
+                "update row %s (%s) failed: %s", item.bid, item.bookmark, result
+            )
+            continue
+        updated.append(item)
+    return updated
 
 
 async def get_db_latest_sort(client: AsyncClient, data_source_id: str) -> int:
@@ -254,52 +594,33 @@ async def get_db_latest_sort(client: AsyncClient, data_source_id: str) -> int:
     return 0
 
 
-def gen_chapter_tree(chapter_list):
-    """生成章节树"""
-    tree = Tree()
-    root = tree.create_node(identifier=ROOT_NODE_ID)  # root node
-    p = {}
-    for chapter in chapter_list:
-        level = chapter.get("level", 1)
-        if level <= 0:
-            level = 1
-        elif level > NOTION_MAX_LEVEL:  # 目前仅支持header1-3
-            level = NOTION_MAX_LEVEL
-
-        parent = p.get(level - 1, root)  # 取最近一次更新节点
-        chapter_uid = chapter.get("chapterUid")
-        p[level] = tree.create_node(
-            tag=chapter_uid, identifier=chapter_uid, parent=parent, data=chapter
-        )
-    return tree
+def gen_chapter_tree(chapter_list) -> ChapterTree:
+    """生成章节树，目前仅支持header1-3"""
+    return ChapterTree.from_chapters(chapter_list, NOTION_MAX_LEVEL)
 
 
-def mount_bookmarks(chapter_tree, bookmark_list):
-    """挂载划线、评论到对应的树节点"""
+def mount_bookmarks(chapter_tree, bookmark_list: list[Mark]) -> list[Mark]:
+    """挂载划线、评论到对应的树节点，返回找不到章节、未挂载的划线"""
     d = defaultdict(list)
-    for data in bookmark_list:
-        uid = data.get("chapterUid", 1)
-        d[uid].append(data)
+    for mark in bookmark_list:
+        d[mark.key[0]].append(mark)
 
+    unmounted = []
     for key, value in d.items():
         node = chapter_tree.get_node(key)
         if not node:
             logging.error("chapter info not found [%s].", key)
+            unmounted.extend(value)
             continue
 
         # mount bookmark list to chapter list
-        node.data[BOOK_MARK_KEY] = value
+        node.data.marks = value
+    return unmounted
 
 
-def remove_empty_chapter(chapter_tree):
+def remove_empty_chapter(chapter_tree: ChapterTree):
     """从底向上，删除章节树中的空节点"""
-    max_depth = chapter_tree.depth()
-    for d in range(max_depth, 0, -1):
-        nodes = list(chapter_tree.filter_nodes(lambda x: chapter_tree.depth(x) == d))
-
-        for n in nodes:
-            if n.data.get(BOOK_MARK_KEY) is None and n.is_leaf():
-                chapter_tree.remove_node(n.identifier)
+    chapter_tree.prune(lambda node: node.data.marks is not None)
 
 
 def content_block(text: str, style: str, color: str, review_id: str) -> dict:
@@ -325,12 +646,13 @@ def content_block(text: str, style: str, color: str, review_id: str) -> dict:
 
 
 def made_page_blocks(
-    store, blocks, bookID, chapters_list, bookmark_list
-) -> list[BlockItem]:
-    """generate page blocks to appending"""
+    records: BookRecord, blocks, chapters_list, bookmark_list
+) -> tuple[list[BlockItem], list[Mark]]:
+    """generate page blocks to appending, and the marks without a chapter"""
     appending: list[BlockItem] = []
+    unmounted: list[Mark] = []
 
-    page_block_list = PageBlockList(store, bookID, blocks)
+    page_block_list = PageBlockList(None, records.book_id, blocks, records=records)
 
     # 添加目录
     if not blocks:
@@ -340,83 +662,63 @@ def made_page_blocks(
 
     if len(chapters_list) > 0:
         chapter_tree = gen_chapter_tree(chapters_list)
-        mount_bookmarks(chapter_tree, bookmark_list)
+        unmounted = mount_bookmarks(chapter_tree, bookmark_list)
         remove_empty_chapter(chapter_tree)
 
-        for n in chapter_tree.expand_tree(mode=Tree.DEPTH):
-            if chapter_tree[n].is_root():
-                continue
-
-            data = chapter_tree[n].data
-            chapter_uid = data.get("chapterUid")
+        for node in chapter_tree.walk():
+            chapter = node.data
+            chapter_uid = chapter.uid
 
-            block_id = None
-            _records = store.query(bookID, chapter_uid)
-            if len(_records) > 0:
-                block_id = _records[0]["block_id"]
-            else:
+            block_id = records.block_of(chapter_uid)
+            if block_id is None:
                 # find a suitable position to insert
                 block_id = page_block_list.found_chapter_position(chapter_uid)
                 appending.append(
                     BlockItem(
                         after=block_id,
                         bookmark=chapter_uid,
-                        block=BlockHelper.heading(data.get("level"), data.get("title")),
+                        block=BlockHelper.heading(chapter.level, chapter.title),
                     )
                 )
 
-            for i in data.get(BOOK_MARK_KEY, []):
-                bookmark_id = i.get("bookmarkId") or i.get("reviewId")
-                _records = store.query(bookID, bookmark_id)
-                if len(_records) > 0:
+            for mark in chapter.marks or []:
+                if records.block_of(mark.id) is not None:
                     continue
                 appending.append(
                     BlockItem(
                         after=block_id,
-                        bookmark=bookmark_id,
+                        bookmark=mark.id,
                         block=content_block(
-                            i.get("markText"),
-                            i.get("style"),
-                            i.get("colorStyle"),
-                            i.get("reviewId"),
+                            mark.text, mark.style, mark.color, mark.review_id
                         ),
                         child=(
-                            [BlockHelper.quote(i.get("abstract"))]
-                            if i.get("abstract")
+                            [BlockHelper.quote(mark.abstract)]
+                            if mark.abstract
                             else None
                         ),
                     )
                 )
     else:
         # no chapter info
-        for data in bookmark_list:
-            bookmark_id = data.get("bookmarkId") or data.get("reviewId")
-            _records = store.query(bookID, bookmark_id)
-            if len(_records) > 0:
+        for mark in bookmark_list:
+            if records.block_of(mark.id) is not None:
                 continue
             appending.append(
                 BlockItem(
-                    bookmark=bookmark_id,
+                    bookmark=mark.id,
                     block=content_block(
-                        data.get("markText"),
-                        data.get("style"),
-                        data.get("colorStyle"),
-                        data.get("reviewId"),
+                        mark.text, mark.style, mark.color, mark.review_id
                     ),
                     child=(
-                        [BlockHelper.quote(data.get("abstract"))]
-                        if data.get("abstract")
-                        else None
+                        [BlockHelper.quote(mark.abstract)] if mark.abstract else None
                     ),
                 )
             )
 
-    return appending
+    return appending, unmounted
 
 
-def made_comment_blocks(
-    store: DBWeReadRecord, book_id: str, summary: list
-) -> list[BlockItem]:
+def made_comment_blocks(records: BookRecord, summary: list[Mark]) -> list[BlockItem]:
     """generate extra stat blocks to appending"""
     appending: list[BlockItem] = []
 
@@ -425,60 +727,109 @@ def made_comment_blocks(
         return appending
 
     bookmark_id = "_comment_"
-    block_id = None
-    _records = store.query(book_id, bookmark_id)
-    if len(_records) == 0:
+    block_id = records.block_of(bookmark_id)
+    if block_id is None:
         appending.extend(
             (
                 BlockItem(block=BlockHelper.divider()),
                 BlockItem(block=BlockHelper.heading(1, "点评"), bookmark=bookmark_id),
             )
         )
-    else:
-        block_id = _records[0]["block_id"]
 
-    for i in summary:
-        # print("summary:", i)
-        bookmark_id = i.get("review").get("reviewId")
-        _records = store.query(book_id, bookmark_id)
-        if len(_records) > 0:
+    for mark in summary:
+        if records.block_of(mark.id) is not None:
             continue
         appending.append(
             BlockItem(
                 after=block_id,
-                bookmark=bookmark_id,
-                block=content_block(
-                    i.get("review").get("content"),
-                    i.get("style"),
-                    i.get("colorStyle"),
-                    i.get("review").get("reviewId"),
-                ),
+                bookmark=mark.id,
+                block=content_block(mark.text, mark.style, mark.color, mark.review_id),
             )
         )
 
     return appending
 
 
-async def made_readinfo_blocks(
-    client: AsyncClient,
-    store: DBWeReadRecord,
-    book_id: str,
-    rinfo: dict,
-    bookmark_count: int,
-) -> list[BlockItem]:
-    """generate extra stat blocks to appending"""
+# 阅读明细表格：(表格的bookmark_id, 行的bookmark_id前缀)
+STAT_TABLES = (("_stat.total_", "_stat.total_"), ("_stat.detail_", "_stat.day_"))
+
+
+def readinfo_rows(rdetail: dict, bookmark_count: int):
+    """阅读明细表格的内容：(总计各行, 每日各行)，每行为单元格文本列表，首列为行的key"""
+    longest_reading_time = weread.str_reading_time(rdetail.get("longestReadingTime", 0))
+    longest_reading_date = datetime.fromtimestamp(
+        rdetail.get("longestReadingDate")
+    ).strftime("%Y/%m/%d")
+    total = [
+        ["累积阅读天数", str(rdetail.get("totalReadDay", 0)) + "天"],
+        ["最长连续阅读天数", str(rdetail.get("continueReadDays", 0)) + "天"],
+        ["单日阅读最久", f"{longest_reading_time} ({longest_reading_date})"],
+        ["阅读笔记条数", str(bookmark_count) + "条"],
+    ]
+    daily = [
+        [
+            datetime.fromtimestamp(data.get("readDate")).strftime("%Y/%m/%d"),
+            weread.str_reading_time(data.get("readTime", 0)),
+        ]
+        for data in rdetail.get("data")
+    ]
+    return total, daily
+
+
+def row_cells(row: dict) -> list[str]:
+    """notion表格行的单元格文本"""
+    return [
+        "".join(text.get("plain_text", "") for text in cell)
+        for cell in row["table_row"]["cells"]
+    ]
+
+
+async def record_table_rows(
+    client: AsyncClient, records: BookRecord, table_key: str, row_key: str
+) -> list[tuple]:
+    """
+    表格行的block未记录时（表格随行一起创建，或由旧版本创建），列出一次表格的全部行，
+    按首列记录行的block及内容摘要，首行表头记录为 `{table_key}:header`。
+    记录只加入records，由write stage落库
+    :return: 新增的记录 [(bookmark_id, block_id, resv), ...]
+    """
+    header_key = f"{table_key}:header"
+    table_id = records.block_of(table_key)
+    if table_id is None or records.block_of(header_key) is not None:
+        return []
+
+    rows = []
+    for idx, row in enumerate(await list_children(client, table_id)):
+        if row.get("type") != "table_row":
+            continue
+        cells = row_cells(row)
+        key = header_key if idx == 0 else f"{row_key}:{cells[0]}"
+        if records.block_of(key) is None:
+            records.add(key, row["id"], content_digest(cells))
+            rows.append((key, row["id"], content_digest(cells)))
+    return rows
+
+
+def made_readinfo_blocks(records: BookRecord, rinfo: dict, bookmark_count: int):
+    """generate extra stat blocks to appending
+
+    已有的表格不再删除重建：总计表按行比较摘要原位更新，明细表只追加新日期的行，
+    当天等已有日期的阅读时长变化时原位更新
+    :return: (追加到page的blocks, 追加到已有表格的行[(table_id, rows)], 原位更新的行)
+    """
     appending: list[BlockItem] = []
+    table_rows: list[tuple[str, list[BlockItem]]] = []
+    updates: list[BlockItem] = []
     rdetail = rinfo.get("readDetail")
 
     if not rdetail:
-        return appending
+        return appending, table_rows, updates
     if not CONFIG.getboolean("weread.format", "EnableReadingDetail"):
-        return appending
+        return appending, table_rows, updates
 
     bookmark_id = "_stat_"
-    block_id = None
-    _records = store.query(book_id, bookmark_id)
-    if len(_records) == 0:
+    block_id = records.block_of(bookmark_id)
+    if block_id is None:
         appending.extend(
             (
                 BlockItem(block=BlockHelper.divider()),
@@ -487,64 +838,49 @@ async def made_readinfo_blocks(
                 ),
             )
         )
-    else:
-        block_id = _records[0]["block_id"]
-
-    # 总计
-    bookmark_id = "_stat.total_"
-    _records = store.query(book_id, bookmark_id)
-    if len(_records):
-        store.delete_bookmark(book_id, bookmark_id)
-        await client.blocks.delete(block_id=_records[0]["block_id"])
 
-    longest_reading_time = weread.str_reading_time(rdetail.get("longestReadingTime", 0))
-    longest_reading_date = datetime.fromtimestamp(
-        rdetail.get("longestReadingDate")
-    ).strftime("%Y/%m/%d")
-    appending.append(
-        BlockItem(
-            after=block_id,
-            bookmark=bookmark_id,
-            block=BlockHelper.table(2, ["维度", "指标"], True),
-            child=[
-                BlockHelper.table_row(
-                    ["累积阅读天数", str(rdetail.get("totalReadDay", 0)) + "天"]
-                ),
-                BlockHelper.table_row(
-                    ["最长连续阅读天数", str(rdetail.get("continueReadDays", 0)) + "天"]
-                ),
-                BlockHelper.table_row(
-                    ["单日阅读最久", f"{longest_reading_time} ({longest_reading_date})"]
-                ),
-                BlockHelper.table_row(["阅读笔记条数", str(bookmark_count) + "条"]),
-            ],
-        )
-    )
-
-    # 明细
-    bookmark_id = "_stat.detail_"
-    _records = store.query(book_id, bookmark_id)
-    if len(_records):
-        store.delete_bookmark(book_id, bookmark_id)
-        await client.blocks.delete(block_id=_records[0]["block_id"])
-    item = BlockItem(
-        after=block_id,
-        bookmark=bookmark_id,
-        block=BlockHelper.table(2, ["日期", "阅读时长"], True),
-        child=[],
-    )
-    for daily in rdetail.get("data"):
-        item.child.append(
-            BlockHelper.table_row(
-                [
-                    datetime.fromtimestamp(daily.get("readDate")).strftime("%Y/%m/%d"),
-                    weread.str_reading_time(daily.get("readTime", 0)),
-                ]
+    total, daily = readinfo_rows(rdetail, bookmark_count)
+    headers = (["维度", "指标"], ["日期", "阅读时长"])
+    for (table_key, row_key), header, rows in zip(STAT_TABLES, headers, (total, daily)):
+        table_id = records.block_of(table_key)
+        if table_id is None:
+            item = BlockItem(
+                after=block_id,
+                bookmark=table_key,
+                block=BlockHelper.table(2, header, True),
+                child=[BlockHelper.table_row(cells) for cells in rows],
             )
-        )
-    appending.append(item)
+            appending.append(item)
+            continue
 
-    return appending
+        new_rows = []
+        # 新行追加到前一个已有行之后，保持与微信读书一致的顺序
+        anchor = records.block_of(f"{table_key}:header")
+        for cells in rows:
+            key = f"{row_key}:{cells[0]}"
+            digest = content_digest(cells)
+            row_id = records.block_of(key)
+            if row_id is None:
+                new_rows.append(
+                    BlockItem(
+                        after=anchor,
+                        bookmark=key,
+                        block=BlockHelper.table_row(cells),
+                        resv=digest,
+                    )
+                )
+                continue
+            anchor = row_id
+            if records.resv_of(key) != digest:
+                item = BlockItem(
+                    bookmark=key, block=BlockHelper.table_row(cells), resv=digest
+                )
+                item.set_bid(row_id)
+                updates.append(item)
+        if new_rows:
+            table_rows.append((table_id, new_rows))
+
+    return appending, table_rows, updates
 
 
 def transform_id(book_id):
@@ -602,116 +938,725 @@ def send_wxnotify(wxnotify_key, read_stat):
     sc_send(wxnotify_key, "Sync-Notion阅读笔记通知", content)
 
 
-async def sync_read(
-    weread_cookie, notion_token, database_id, calendar_db_id=None, wxnotify_key=None
+# get_bookinfo请求失败时的返回值，不缓存
+EMPTY_BOOKINFO = ("", 0, "", "")
+
+
+def cache_stamp(job: BookJob) -> int:
+    """响应缓存的版本。笔记列表中的sort随每条划线变化，只用书籍本身的更新时间"""
+    return job.book.get("updateTime", 0)
+
+
+def cache_expire_before() -> datetime:
+    """早于该时间写入的响应缓存视为过期"""
+    return datetime.now() - timedelta(
+        days=CONFIG.getint("weread.cache", "TTLDays", fallback=30)
+    )
+
+
+def response_cache(store: DBWeReadCache | None) -> DBWeReadCache | None:
+    """开启[weread.cache]时返回缓存所在的本地库"""
+    if CONFIG.getboolean("weread.cache", "Enabled", fallback=True):
+        return store
+    return None
+
+
+def cache_get(store: DBWeReadCache | None, endpoint: str, job: BookJob):
+    """缓存的响应，store为None或未命中时返回None"""
+    if store is None:
+        return None
+    value = store.query_cache(
+        endpoint, job.book_id, cache_stamp(job), cache_expire_before()
+    )
+    if value is None:
+        return None
+    METRICS.incr("weread.cache", endpoint=endpoint, result="hit")
+    value = fastjson.loads(value)
+    if endpoint == "chapterInfos":
+        return [Chapter.from_dict(chapter) for chapter in value]
+    return value
+
+
+def cache_put(store: DBWeReadCache | None, endpoint: str, job: BookJob, value):
+    """缓存响应，空结果(请求失败)不缓存"""
+    if store is not None and value and value != EMPTY_BOOKINFO:
+        METRICS.incr("weread.cache", endpoint=endpoint, result="miss")
+        store.save_cache(
+            endpoint,
+            job.book_id,
+            cache_stamp(job),
+            fastjson.dumps(value, default=lambda record: record.to_dict()),
+        )
+
+
+async def cached_fetch(store: DBWeReadCache | None, endpoint: str, job: BookJob, fetch):
+    """
+    章节列表、书籍详情几乎不变，按书籍更新时间缓存在本地缓存库中
+    store: 为None时不使用缓存
+    fetch: 缓存未命中时调用
+    """
+    value = cache_get(store, endpoint, job)
+    if value is None:
+        value = await fetch()
+        cache_put(store, endpoint, job, value)
+    return value
+
+
+async def prefetch_chapters(
+    wreader: weread.AsyncWeReadAPI, jobs: list[BookJob], store: DBWeReadCache | None
+) -> dict:
+    """
+    缓存未命中的书籍分批拉取章节列表，一次请求多本，代替每本书一次请求
+    :return: {book_id: 章节列表}，拉取失败的书籍不在其中，由fetch阶段单独拉取
+    """
+    chapters = {}
+    missing = []
+    for job in jobs:
+        value = cache_get(store, "chapterInfos", job)
+        if value is None:
+            missing.append(job)
+        else:
+            chapters[job.book_id] = value
+            job.chapters_cached = True
+    if not missing:
+        return chapters
+
+    fetched = await wreader.get_chapter_lists(
+        [job.book_id for job in missing],
+        CONFIG.getint("weread.sync", "ChapterBatch", fallback=50),
+    )
+    for job in missing:
+        value = fetched.get(job.book_id)
+        if value is not None:
+            chapters[job.book_id] = value
+            cache_put(store, "chapterInfos", job, value)
+    return chapters
+
+
+def is_reset(response: dict, synckey: int) -> bool:
+    """增量请求失败，或服务端返回的synckey比请求的小(重置)"""
+    return synckey > 0 and (
+        response["synckey"] is None or response["synckey"] < synckey
+    )
+
+
+async def fetch_marks(
+    wreader: weread.AsyncWeReadAPI, job: BookJob, store: DBWeReadRecord | None
 ):
-    """sync weread reading notes to notion"""
-    client = AsyncClient(auth=notion_token, log_level=logging.ERROR)
+    """
+    拉取划线及笔记。page及synckey都已记录时只拉取synckey之后的变化，
+    synckey被重置或请求失败时全量拉取。synckey在整本书写入完成后才记录，见write_book
+    :return: (bookmarks, summary, reviews)
+    """
+    book_id = job.book_id
+    state = None
+    if (
+        store is not None
+        and CONFIG.getboolean("weread.sync", "DeltaFetch", fallback=True)
+        and store.query_page(book_id)
+    ):
+        state = store.query_sync_key(book_id)
+    bookmark_key, review_key = (
+        (state["bookmark_key"], state["review_key"]) if state else (0, 0)
+    )
 
-    data_source_id = await notion.get_datasource_id(client, database_id)
-    if not data_source_id:
-        logging.error("database %s has no data source", database_id)
+    bookmarks, reviews = await asyncio.gather(
+        wreader.get_bookmark_delta(book_id, bookmark_key),
+        wreader.get_review_delta(book_id, review_key),
+    )
+    if state is not None and (
+        is_reset(bookmarks, bookmark_key) or is_reset(reviews, review_key)
+    ):
+        logging.info("synckey of book %s was reset, fetch all", book_id)
+        METRICS.incr("weread.delta", result="reset")
+        state = None
+        bookmarks, reviews = await asyncio.gather(
+            wreader.get_bookmark_delta(book_id, 0),
+            wreader.get_review_delta(book_id, 0),
+        )
+
+    marks = bookmarks["updated"] + reviews["updated"]
+    job.delta = state is not None
+    if job.delta:
+        METRICS.incr("weread.delta", result="delta")
+        # 增量中只有未同步过的算新增，删除的只计已同步过的
+        records = store.load_book(book_id)
+        added = {mark.id for mark in marks} - records.blocks.keys()
+        removed = set(bookmarks["removed"] + reviews["removed"]) & records.blocks.keys()
+        job.mark_count = max(0, state["marks"] + len(added) - len(removed))
+    else:
+        job.mark_count = len(marks)
+    if bookmarks["synckey"] is not None and reviews["synckey"] is not None:
+        job.sync_keys = (bookmarks["synckey"], reviews["synckey"], job.mark_count)
+    return bookmarks["updated"], reviews["summary"], reviews["updated"]
+
+
+async def fetch_book(
+    wreader: weread.AsyncWeReadAPI,
+    job: BookJob,
+    store: DBWeReadRecord | None = None,
+    chapters: list | None = None,
+    cache: DBWeReadCache | None = None,
+):
+    """fetch stage: 并发拉取书籍章节、划线、笔记及阅读信息
+    store: 本地同步记录，用于增量拉取划线、笔记
+    chapters: 预先批量拉取的章节列表，为None时单独拉取，见prefetch_chapters
+    cache: 接口响应缓存，章节列表及书籍详情优先从中读取，为None时不缓存
+    """
+    logging.info("Start to synch book %s", job.book_id)
+    book_id = job.book_id
+
+    async def get_chapters():
+        if chapters is not None:
+            return chapters
+        value = cache_get(cache, "chapterInfos", job)
+        if value is not None:
+            job.chapters_cached = True
+            return value
+        value = await wreader.get_chapter_list(book_id)
+        cache_put(cache, "chapterInfos", job, value)
+        return value
+
+    (
+        job.chapters,
+        (bookmark_list, job.summary, reviews),
+        bookinfo,
+        job.read_info,
+    ) = await asyncio.gather(
+        get_chapters(),
+        fetch_marks(wreader, job, store),
+        cached_fetch(cache, "bookinfo", job, lambda: wreader.get_bookinfo(book_id)),
+        wreader.get_read_info(book_id),
+    )
+    job.bookinfo = tuple(bookinfo)
+
+    # converge bookmark and chapter review, both sorted by the api
+    job.bookmarks = merge_marks(bookmark_list, reviews)
+
+    # 缓存的章节列表中没有划线、笔记所在章节时(如连载新章节)，重新拉取一次；
+    # 刚拉取的列表中仍没有的(如上传的书籍、已删除的章节)，重新拉取也不会有
+    uids = {chapter.uid for chapter in job.chapters}
+    if job.chapters_cached and any(
+        mark.chapter_uid not in uids
+        for mark in job.bookmarks
+        if mark.chapter_uid is not None
+    ):
+        job.chapters = await wreader.get_chapter_list(book_id)
+        job.chapters_cached = False
+        cache_put(cache, "chapterInfos", job, job.chapters)
+
+
+def stored_layout(row, pid: str, edited_time) -> list | None:
+    """本地记录的page顶层block结构
+    page在同步之外被编辑过、记录的不是当前page或到了定期核对时间时返回None，需要重新列出
+    """
+    if row is None or row["page_id"] != pid or not edited_time:
+        return None
+    if edited_time > row["edited_time"]:
+        return None
+    verify_days = CONFIG.getint("weread.sync", "VerifyDays", fallback=7)
+    if row["verified_at"] is None or datetime.now() - row["verified_at"] >= timedelta(
+        days=verify_days
+    ):
+        return None
+    return [{"id": _id, "type": _type} for _id, _type in json.loads(row["blocks"])]
+
+
+async def save_layout(client: AsyncClient, store: DBWeReadRecord, job: BookJob):
+    """记录同步完成后page的顶层block结构，以及包含本次修改的最后编辑时间"""
+    if not job.layout.valid:
+        store.delete_layout(job.book_id)
         return
+    page = await client.pages.retrieve(page_id=job.pid)
+    store.save_layout(
+        job.book_id,
+        job.pid,
+        json.dumps([[block["id"], block["type"]] for block in job.layout.blocks]),
+        page.get("last_edited_time"),
+        job.verified_at,
+    )
 
-    calendar_data_source_id = ""
-    if calendar_db_id:
-        calendar_data_source_id = await notion.get_datasource_id(client, calendar_db_id)
 
-    latest_sort = await get_db_latest_sort(client, data_source_id)
+async def plan_blocks(
+    client: AsyncClient, job: BookJob, records: BookRecord, blocks: list
+):
+    """按page现有的blocks及同步记录，生成待追加、更新的blocks"""
+    if job.delta and not records.blocks:
+        # 增量拉取的划线不全，新page先写入这部分，下次全量拉取补齐
+        job.incomplete = True
+    if CONFIG.getboolean("weread.sync", "TrustLayout", fallback=False):
+        job.layout = PageLayout(blocks)
+
+    job.recorded = []
+    for table_key, row_key in STAT_TABLES:
+        job.recorded.extend(
+            await record_table_rows(client, records, table_key, row_key)
+        )
 
-    wreader = weread.WeReadAPI(weread_cookie)
-    store = DBWeReadRecord("./var/sync_read.db")
-    read_stat = []
+    appending, unmounted = made_page_blocks(
+        records, blocks, job.chapters, job.bookmarks
+    )
+    job.unmounted = len(unmounted)
+    job.sections = [appending, made_comment_blocks(records, job.summary)]
+    appending, job.table_rows, job.row_updates = made_readinfo_blocks(
+        records, job.read_info, job.mark_count
+    )
+    job.sections.append(appending)
 
-    books = wreader.get_notebooklist()
-    for _book in books:
-        sort = _book["sort"]
-        if sort <= latest_sort:  # 笔记无更新，跳过
-            continue
 
-        book_dict = _book.get("book")
-        book_id = book_dict.get("bookId")
-
-        logging.info("Start to synch book %s", book_id)
-
-        chapters_list = wreader.get_chapter_list(book_id)
-        bookmark_list = wreader.get_bookmark_list(book_id)
-        summary, reviews = wreader.get_review_list(book_id)
-
-        # converge bookmark and chapter review
-        bookmark_list.extend(reviews)
-        bookmark_list = sorted(
-            bookmark_list,
-            key=lambda x: (
-                x.get("chapterUid", 1),
-                (
-                    0
-                    if (x.get("range", "") == "" or x.get("range").split("-")[0] == "")
-                    else int(x.get("range").split("-")[0])
-                ),
-            ),
-        )
+async def plan_book(
+    client: AsyncClient,
+    data_source_id: str,
+    store: DBWeReadRecord,
+    job: BookJob,
+    index: BookPageIndex | None = None,
+):
+    """plan stage: 生成page属性及blocks的写入计划，只读取notion及本地记录"""
+    book_id = job.book_id
+
+    job.pid, edited_time = await locate_book_page(
+        client, data_source_id, store, book_id, index
+    )
 
-        isbn, rating, category, intro = wreader.get_bookinfo(book_id)
-        read_info = wreader.get_read_info(book_id)
-
-        # delete before insert again
-        pageinfo, pid = await get_page_info(client, data_source_id, book_id)
-        pid, created = await create_or_update_page(
-            client,
-            data_source_id,
-            pageinfo,
-            pid,
-            book_name=book_dict.get("title"),
-            book_id=book_id,
-            cover=book_dict.get("cover"),
-            sort=sort,
-            author=book_dict.get("author"),
-            isbn=isbn,
-            rating=rating,
-            category=category,
-            note_count=_book.get("noteCount"),
-            review_count=_book.get("reviewCount"),
-            intro=intro,
-            read_info=read_info,
+    blocks = None
+    if job.pid is not None:
+        try:
+            blocks = await plan_layout(client, store, job, edited_time)
+        except APIResponseError as error:
+            if not is_page_gone(error):
+                raise
+            # 本地记录的page已被删除，按新page生成计划
+            logging.info("page of book %s is gone", book_id)
+            job.pid = None
+    job.page = plan_page(store, job)
+
+    if job.pid is None:
+        job.verified_at = datetime.now()
+        await plan_blocks(client, job, BookRecord(book_id), [])
+        return
+    await plan_blocks(client, job, store.load_book(book_id), blocks)
+
+
+async def plan_layout(
+    client: AsyncClient, store: DBWeReadRecord, job: BookJob, edited_time
+) -> list:
+    """
+    page现有的顶层blocks，信任本地页面结构且page未在同步之外被编辑时使用本地记录
+    edited_time: 本次写入之前page的最后编辑时间，未知时(未预先拉取index)查询page
+    """
+    layout_row = None
+    if CONFIG.getboolean("weread.sync", "TrustLayout", fallback=False):
+        layout_row = store.query_layout(job.book_id)
+    if layout_row is not None and edited_time is None:
+        page = await client.pages.retrieve(page_id=job.pid)
+        edited_time = page.get("last_edited_time")
+    blocks = stored_layout(layout_row, job.pid, edited_time)
+    if blocks is None:
+        blocks = await list_page_blocks(client, job.pid)
+        job.verified_at = datetime.now()
+    return blocks
+
+
+async def write_book(
+    client: AsyncClient,
+    data_source_id: str,
+    store: DBWeReadRecord,
+    job: BookJob,
+    read_stat: list,
+    calendar_data_source_id: str = "",
+):
+    """write stage: 执行写入计划，按顺序追加各部分blocks，保证同一page内的先后关系
+    各阶段完成后记入写入日志，中断时下次运行续写，见 sync_books
+    """
+    await write_page(client, data_source_id, store, job)
+    store.journal_stage(job.book_id, "page")
+    if job.recorded:
+        store.insert_many(job.book_id, job.recorded)
+
+    async def append_saved(pid, appending, layout=None):
+        try:
+            return await append_blocks(client, pid, appending, layout)
+        finally:
+            # 每次追加后立即提交，进程中途退出时最多丢失一次追加的记录
+            with store.transaction():
+                save_blocks(store, job.book_id, appending)
+
+    failed = []
+    updated = []
+    done = False
+    try:
+        for appending in job.sections:
+            failed.extend(await append_saved(job.pid, appending, job.layout))
+        for table_id, rows in job.table_rows:
+            failed.extend(await append_saved(table_id, rows))
+        updated = await update_rows(client, job.row_updates)
+        done = True
+    finally:
+        with store.transaction():
+            store.update_resv(
+                job.book_id, [(item.bookmark, item.bid, item.resv) for item in updated]
+            )
+            if job.layout is not None and not done:
+                # 页面结构不确定，下次重新列出
+                store.delete_layout(job.book_id)
+            if done:
+                store.journal_stage(job.book_id, "blocks")
+
+    if job.layout is not None:
+        await save_layout(client, store, job)
+
+    if failed:
+        logging.warning(
+            "book %s: children of %d blocks were not appended", job.book_id, len(failed)
         )
 
-        blocks = []
-        if not created:
-            blocks = await list_page_blocks(client, pid)
-        else:
-            store.delete_book(book_id)
-
-        appending = made_page_blocks(
-            store,
-            blocks,
-            book_id,
-            chapters_list,
-            bookmark_list,
+    # 新增的章节及划线、笔记
+    appending = job.sections[0] if job.sections else []
+    if len(appending) > 0:
+        read_stat.append(
+            {
+                "count": len(appending),
+                "book_name": job.book.get("title"),
+            }
         )
-        await append_blocks(client, pid, appending, store, book_id)
 
-        appending = made_comment_blocks(
-            store,
-            book_id,
-            summary,
+    if calendar_data_source_id:
+        with METRICS.timer("calendar"):
+            await sync_to_calener(client, calendar_data_source_id, job.read_info)
+
+    with store.transaction():
+        if job.incomplete:
+            logging.warning(
+                "page of book %s was created from a delta fetch, completed next run",
+                job.book_id,
+            )
+            store.delete_sync_key(job.book_id)
+            return
+        if job.unmounted:
+            # 增量拉取不会再返回这些划线，章节补齐后要靠全量拉取写入
+            logging.warning(
+                "%d marks of book %s have no chapter, fully fetched next run",
+                job.unmounted,
+                job.book_id,
+            )
+            store.delete_sync_key(job.book_id)
+        elif job.sync_keys:
+            store.save_sync_key(job.book_id, *job.sync_keys)
+        store.journal_done(job.book_id)
+
+
+def plan_stats(job: BookJob, calendar: bool = False) -> dict:
+    """
+    按notion的请求限制估算执行写入计划需要的请求数、新建block数及请求体字节数
+    page已被删除等执行时才能确定的情况不计入，日历只计入一次查询
+    """
+    requests = defaultdict(int)
+    blocks = 0
+    payload = 0
+
+    def appends(items: list):
+        nonlocal blocks, payload
+        groups, overflow = group_blocks(items)
+        for chunk in [c for _after, batch in groups for c in notion.pack_blocks(batch)]:
+            requests["blocks.children.append"] += 1
+            blocks += sum(notion.count_blocks(block) for block in chunk)
+            payload += sum(notion.payload_size(block) for block in chunk)
+        for rest in overflow:
+            for chunk in notion.pack_blocks(rest):
+                requests["blocks.children.append"] += 1
+                blocks += sum(notion.count_blocks(block) for block in chunk)
+                payload += sum(notion.payload_size(block) for block in chunk)
+
+    if job.page is not None:
+        requests["pages.create" if job.pid is None else "pages.update"] += 1
+        payload += notion.payload_size(
+            {"properties": job.page["properties"], "icon": job.page["icon"]}
+        )
+    for items in job.sections:
+        appends(items)
+    for _table_id, rows in job.table_rows:
+        appends(rows)
+    for item in job.row_updates:
+        requests["blocks.update"] += 1
+        payload += notion.payload_size(item.block)
+    if job.layout is not None:
+        requests["pages.retrieve"] += 1
+    if calendar:
+        requests["data_sources.query"] += 1
+
+    return {
+        "requests": dict(requests),
+        "total_requests": sum(requests.values()),
+        "blocks": blocks,
+        "bytes": payload,
+    }
+
+
+def save_plan(
+    path: str, data_source_id: str, calendar_data_source_id: str, jobs: list
+) -> dict:
+    """保存写入计划，返回汇总"""
+    books = []
+    summary = {
+        "books": len(jobs),
+        "requests": defaultdict(int),
+        "blocks": 0,
+        "bytes": 0,
+    }
+    for job in jobs:
+        stats = plan_stats(job, bool(calendar_data_source_id))
+        for key, value in stats["requests"].items():
+            summary["requests"][key] += value
+        summary["blocks"] += stats["blocks"]
+        summary["bytes"] += stats["bytes"]
+        books.append(
+            {
+                "book_id": job.book_id,
+                "title": job.book.get("title"),
+                "stats": stats,
+                "job": job.to_dict(),
+            }
         )
-        await append_blocks(client, pid, appending, store, book_id)
+    summary["requests"] = dict(summary["requests"])
+    summary["total_requests"] = sum(summary["requests"].values())
+
+    plan = {
+        "version": PLAN_VERSION,
+        "created_at": datetime.now().isoformat(),
+        "data_source_id": data_source_id,
+        "calendar_data_source_id": calendar_data_source_id,
+        "summary": summary,
+        "books": books,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=1)
+    return summary
+
+
+def open_store() -> DBWeReadRecord:
+    """本地同步记录"""
+    return DBWeReadRecord(
+        "./var/sync_read.db",
+        journal_mode=CONFIG.get("weread.store", "JournalMode", fallback=None),
+        synchronous=CONFIG.get("weread.store", "Synchronous", fallback=None),
+    )
+
+
+def open_cache() -> DBWeReadCache | None:
+    """
+    微信读书接口响应缓存，与同步记录分开存放：同步记录会被提交回仓库，缓存不提交
+    未开启[weread.cache]时返回None
+    """
+    if not CONFIG.getboolean("weread.cache", "Enabled", fallback=True):
+        return None
+    return DBWeReadCache(
+        CONFIG.get("weread.cache", "Path", fallback="./var/weread_cache.db")
+    )
 
-        appending = await made_readinfo_blocks(
-            client, store, book_id, read_info, len(bookmark_list)
+
+async def sync_books(
+    client: AsyncClient,
+    wreader: weread.AsyncWeReadAPI,
+    store: DBWeReadRecord,
+    database_id: str,
+    calendar_db_id=None,
+    plan=None,
+    cache: DBWeReadCache | None = None,
+) -> list:
+    """sync_read的主体，notion、微信读书客户端及本地记录由调用方创建，可替换为本地模拟
+    plan: 只生成写入计划并保存到该文件（JSON），不修改notion
+    cache: 微信读书接口响应缓存所在的本地库，见open_cache；为None时不缓存
+    return: 各书新增的笔记数，用于通知
+    """
+    read_stat = []
+    cache = response_cache(cache)
+    data_source_id = await notion.get_datasource_id(client, database_id)
+    if not data_source_id:
+        logging.error("database %s has no data source", database_id)
+        return read_stat
+
+    calendar_data_source_id = ""
+    if calendar_db_id:
+        calendar_data_source_id = await notion.get_datasource_id(client, calendar_db_id)
+
+    index = None
+    if CONFIG.getboolean("weread.sync", "PrefetchPages", fallback=True):
+        with METRICS.timer("index"):
+            index = await BookPageIndex.load(client, data_source_id)
+        latest_sort = index.latest_sort()
+        # 只记录新增、重建的page；编辑时间每次写入后都会变化且由index提供，
+        # 不据此改写本地记录，无变化的运行不改动数据库
+        recorded = store.query_pages()
+        with store.transaction():
+            for book_id, page in index.pages.items():
+                row = recorded.get(book_id)
+                if row is None or row["page_id"] != page["id"]:
+                    store.upsert_page(book_id, page["id"], page.get("last_edited_time"))
+    else:
+        latest_sort = await get_db_latest_sort(client, data_source_id)
+
+    with METRICS.timer("notebooks"):
+        books = await wreader.get_notebooklist()
+    # page的Sort在blocks之前写入，中断的书籍可能已不在水位之上，按写入日志续写
+    pending = store.journal_pending()
+    jobs = [
+        BookJob(_book)
+        for _book in books
+        if _book["sort"] > latest_sort or _book["bookId"] in pending
+    ]
+    resumed = sum(1 for job in jobs if job.book_id in pending)
+    if resumed:
+        logging.info("resume %d unfinished books of the last run", resumed)
+        METRICS.incr("journal.resumed", resumed)
+    if plan is None:
+        with store.transaction():
+            # 已从笔记列表中移除的书籍无需续写
+            for book_id in pending.keys() - {_book["bookId"] for _book in books}:
+                store.journal_done(book_id)
+            store.journal_begin([(job.book_id, job.sort) for job in jobs])
+
+    with METRICS.timer("chapters"):
+        chapters = await prefetch_chapters(wreader, jobs, cache)
+
+    concurrency = CONFIG.getint("weread.sync", "Concurrency", fallback=4)
+    stages = [
+        Stage(
+            "fetch",
+            lambda job: fetch_book(
+                wreader, job, store, chapters.get(job.book_id), cache
+            ),
+            concurrency,
+        ),
+        Stage(
+            "plan",
+            lambda job: plan_book(client, data_source_id, store, job, index),
+            concurrency,
+        ),
+    ]
+    if plan is None:
+        stages.append(
+            Stage(
+                "write",
+                lambda job: write_book(
+                    client,
+                    data_source_id,
+                    store,
+                    job,
+                    read_stat,
+                    calendar_data_source_id,
+                ),
+                concurrency,
+            )
+        )
+    failed = await Pipeline(stages, in_flight=concurrency).run(jobs)
+    if cache is not None:
+        cache.prune_cache(
+            cache_expire_before(),
+            CONFIG.getint("weread.cache", "MaxMB", fallback=64) * 1024 * 1024,
         )
-        await append_blocks(client, pid, appending, store, book_id)
-        if len(appending) > 0:
-            read_stat.append(
-                {
-                    "count": len(appending),
-                    "book_name": book_dict.get("title"),
-                }
+
+    if plan is not None:
+        failed_jobs = {id(job) for _stage, job, _e in failed}
+        planned = [job for job in jobs if id(job) not in failed_jobs]
+        summary = save_plan(plan, data_source_id, calendar_data_source_id, planned)
+        logging.info("plan saved to %s: %s", plan, json.dumps(summary))
+    return read_stat
+
+
+async def sync_read(
+    weread_cookie,
+    notion_token,
+    database_id,
+    calendar_db_id=None,
+    wxnotify_key=None,
+    plan=None,
+):
+    """sync weread reading notes to notion
+    plan: 只生成写入计划并保存到该文件（JSON），不修改notion，之后用 apply 执行
+    """
+    with report_run("sync_read", CONFIG.get("metrics", "Output", fallback="")):
+        client = notion.create_client(notion_token)
+
+        concurrency = CONFIG.getint("weread.sync", "Concurrency", fallback=4)
+        # 每本书同时请求5个接口
+        wreader = weread.AsyncWeReadAPI(weread_cookie, max_connections=concurrency * 5)
+        store = open_store()
+        cache = open_cache()
+        await wreader.open()
+        try:
+            read_stat = await sync_books(
+                client,
+                wreader,
+                store,
+                database_id,
+                calendar_db_id,
+                plan,
+                cache=cache,
             )
+        finally:
+            await wreader.aclose()
+            # 关闭时WAL写回库文件，Github Action随后提交的是完整的映射库
+            store.close()
+            if cache is not None:
+                cache.close()
+
+    if wxnotify_key is not None and len(read_stat) != 0:
+        send_wxnotify(wxnotify_key, read_stat)
+
 
-        if calendar_data_source_id:
-            await sync_to_calener(client, calendar_data_source_id, read_info)
+async def apply_plan(notion_token, plan, wxnotify_key=None):
+    """执行 sync_read --plan 保存的写入计划"""
+    with open(plan, "r", encoding="utf-8") as f:
+        saved = json.load(f)
+    if saved.get("version") != PLAN_VERSION:
+        logging.error("unsupported plan version %s", saved.get("version"))
+        return
+
+    with report_run("apply", CONFIG.get("metrics", "Output", fallback="")):
+        client = notion.create_client(notion_token)
+        store = open_store()
+        data_source_id = saved["data_source_id"]
+        calendar_data_source_id = saved["calendar_data_source_id"]
+        jobs = [BookJob.from_dict(book["job"]) for book in saved["books"]]
+        # 计划生成后已部分写入的书籍，计划中的blocks已过时，交由下次sync_read续写
+        pending = store.journal_pending()
+        partial = [
+            job.book_id
+            for job in jobs
+            if job.book_id in pending and pending[job.book_id]["stage"] != "pending"
+        ]
+        if partial:
+            logging.warning(
+                "skip %d partially written books, run sync_read to resume them: %s",
+                len(partial),
+                ", ".join(partial),
+            )
+            jobs = [job for job in jobs if job.book_id not in partial]
+        store.journal_begin([(job.book_id, job.sort) for job in jobs])
+
+        concurrency = CONFIG.getint("weread.sync", "Concurrency", fallback=4)
+        read_stat = []
+        pipeline = Pipeline(
+            [
+                Stage(
+                    "write",
+                    lambda job: write_book(
+                        client,
+                        data_source_id,
+                        store,
+                        job,
+                        read_stat,
+                        calendar_data_source_id,
+                    ),
+                    concurrency,
+                )
+            ],
+            in_flight=concurrency,
+        )
+        try:
+            await pipeline.run(jobs)
+        finally:
+            store.close()
 
     if wxnotify_key is not None and len(read_stat) != 0:
         send_wxnotify(wxnotify_key, read_stat)
@@ -3,7 +3,6 @@
 """
 
 import logging
-import time
 import requests
 from pyquery import PyQuery as pq
 from github import Github
@@ -13,6 +12,7 @@ from notion_client import AsyncClient
 
 from config import CONFIG
 from api import notion
+from lib.metrics import METRICS, endpoint_of, report_run
 
 
 class TrendItem:
@@ -39,6 +39,7 @@ class TrendItem:
             auth = Auth.Token(git_token)
         git = Github(auth=auth)
 
+        METRICS.incr("github.calls")
         try:
             repo = git.get_repo(self._repo_path())
         # pylint: disable-next=broad-except
@@ -53,8 +54,6 @@ class TrendItem:
 
 async def query_page(client: AsyncClient, data_source_id: str, title: str) -> bool:
     """检查是否已经插入过 如果已经插入了就忽略"""
-    time.sleep(0.3)
-
     response = await client.data_sources.query(
         data_source_id=data_source_id,
         filter={"property": "Title", "rich_text": {"equals": title}},
@@ -94,6 +93,8 @@ def _scrape(language: str) -> list[TrendItem]:
 
     url = f"https://github.com/trending/{language}".format(language=language)
     req = requests.get(url, headers=headers, timeout=10)
+    METRICS.incr("http.calls", endpoint=endpoint_of("GET", url))
+    METRICS.incr("http.bytes_in", len(req.content))
     if req.status_code != 200:
         logging.error("git trending error. %d", req.status_code)
         return result
@@ -139,46 +140,53 @@ async def _sync(
     git_token: str | None = None,
 ) -> None:
     for trend in trends:
-        time.sleep(0.3)  # avoid rate limit for notion API
-        exist = await query_page(client, data_source_id, trend.title)
+        with METRICS.timer("query"):
+            exist = await query_page(client, data_source_id, trend.title)
         if exist:
             continue
         # insert to db
         logging.info(trend)
 
         if git_token:
-            trend.fullfill_repo_info(git_token)
+            with METRICS.timer("github"):
+                trend.fullfill_repo_info(git_token)
 
         if _filter_repo(trend):
             logging.info("ignore %s", trend.title)
+            METRICS.incr("trending.filtered")
             continue
 
-        await insert_page(client, data_source_id, language, trend)
+        with METRICS.timer("insert"):
+            await insert_page(client, data_source_id, language, trend)
+        METRICS.incr("trending.inserted")
 
 
 async def sync_trending(notion_token, database_id, git_token=None):
     """sync github trending to notion"""
-    client = AsyncClient(auth=notion_token, log_level=logging.ERROR)
+    with report_run("sync_trending", CONFIG.get("metrics", "Output", fallback="")):
+        client = notion.create_client(notion_token)
 
-    data_sources_id = await notion.get_datasource_id(client, database_id)
-    if not data_sources_id:
-        logging.error("database %s has no data source", database_id)
-        return
+        data_sources_id = await notion.get_datasource_id(client, database_id)
+        if not data_sources_id:
+            logging.error("database %s has no data source", database_id)
+            return
 
-    languages = list(
-        map(
-            lambda x: x.strip(), CONFIG.get("trending.language", "Languages").split(",")
+        languages = list(
+            map(
+                lambda x: x.strip(),
+                CONFIG.get("trending.language", "Languages").split(","),
+            )
         )
-    )
-    for language in languages:
-        if not language:
-            continue
+        for language in languages:
+            if not language:
+                continue
 
-        logging.info("sync %s", language)
+            logging.info("sync %s", language)
 
-        trends = _scrape(language)
-        if not trends:
-            logging.error("language [%s] error", language)
-            continue
+            with METRICS.timer("scrape"):
+                trends = _scrape(language)
+            if not trends:
+                logging.error("language [%s] error", language)
+                continue
 
-        await _sync(client, data_sources_id, language, trends, git_token)
+            await _sync(client, data_sources_id, language, trends, git_token)